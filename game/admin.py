@@ -1,10 +1,16 @@
 from django.contrib import admin
-from game.models import Game, Character, Scene, Moment, Block, Action, AfterEffect
+from game.models import Game, GameVersion, Character, Scene, Moment, Block, Action, AfterEffect
 
 
 @admin.register(Game)
 class GameAdmin(admin.ModelAdmin):
-    list_display = ('name', 'status', 'author', 'created_at')
+    list_display = ('name', 'status', 'author', 'published_version', 'created_at')
+
+
+@admin.register(GameVersion)
+class GameVersionAdmin(admin.ModelAdmin):
+    list_display = ('game', 'number', 'created_at')
+    exclude = ('data', )
 
 
 @admin.register(Character)
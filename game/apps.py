@@ -3,3 +3,8 @@ from django.apps import AppConfig
 
 class GameConfig(AppConfig):
     name = 'game'
+
+    def ready(self):
+        import game.signals  # noqa
+        import game.catalogue  # noqa
+        import game.graph  # noqa
@@ -0,0 +1,223 @@
+"""
+Game export and import.
+
+An archive is newline-delimited json: a header line, then one line per
+row, table by table, parents first:
+
+    {"format": "gamebook", "version": 1}
+    {"model": "game", "pk": 1, "fields": {...}}
+    {"model": "scene", "pk": 5, "fields": {"name": ..., ...}}
+    ...
+
+Foreign keys hold pks of the exporting database and are remapped on
+import, property pks inside conditions too. Export reads rows in chunks
+with `iterator()`, import writes them with `bulk_create` in batches.
+"""
+import json
+import logging
+
+from django.db import connection, transaction
+
+from game.invalidation import invalidate
+from game.models import Game, Scene, Moment, Character, Property, Block, Action, AfterEffect
+
+
+logger = logging.getLogger(__name__)
+
+
+FORMAT = 'gamebook'
+VERSION = 1
+
+# (name, model, fields, {foreign key field: name of the referenced table})
+TABLES = (
+    ('scene', Scene, ('name', 'order', 'description'), {}),
+    ('moment', Moment, ('scene', 'name', 'order', 'description'), {'scene': 'scene'}),
+    ('character', Character, ('name', 'description', 'start_scene'), {'start_scene': 'scene'}),
+    ('property', Property, ('character', 'scene', 'name', 'value'),
+     {'character': 'character', 'scene': 'scene'}),
+    ('block', Block, ('scene', 'moment', 'order', 'content', 'condition'),
+     {'scene': 'scene', 'moment': 'moment'}),
+    ('action', Action, ('scene', 'moment', 'order', 'content', 'condition'),
+     {'scene': 'scene', 'moment': 'moment'}),
+    ('aftereffect', AfterEffect,
+     ('action', 'go_to_scene', 'go_to_moment', 'set_property', 'set_property_value'),
+     {'action': 'action', 'go_to_scene': 'scene', 'go_to_moment': 'moment',
+      'set_property': 'property'}),
+)
+TABLES_BY_NAME = {table[0]: table for table in TABLES}
+
+
+class ArchiveError(ValueError):
+    pass
+
+
+def _line(data):
+    return json.dumps(data, ensure_ascii=False, separators=(',', ':')) + '\n'
+
+
+def _columns(fields, foreign_keys):
+    return ['%s_id' % field if field in foreign_keys else field for field in fields]
+
+
+def export_game(game, chunk_size=2000):
+    """Yield archive lines of the game."""
+    yield _line({'format': FORMAT, 'version': VERSION})
+    yield _line({
+        'model': 'game',
+        'pk': game.pk,
+        'fields': {'name': game.name, 'description': game.description},
+    })
+
+    for name, model, fields, foreign_keys in TABLES:
+        if model is AfterEffect:
+            queryset = model.objects.filter(action__game=game)
+        else:
+            queryset = model.objects.filter(game=game)
+        columns = _columns(fields, foreign_keys)
+        for row in queryset.order_by('pk').values_list('pk', *columns).iterator(chunk_size=chunk_size):
+            yield _line({
+                'model': name,
+                'pk': row[0],
+                'fields': dict(zip(fields, row[1:])),
+            })
+
+
+def remap_condition(condition, property_pks):
+    """
+    Condition json with property pks of the new game. Conditions that do
+    not parse are kept as is, they never match in the exported game
+    either. A clause on a property missing from the archive raises
+    ArchiveError, like any other reference to a missing row.
+    """
+    if not condition or not condition.strip():
+        return condition
+    try:
+        clauses = json.loads(condition)
+        if not isinstance(clauses, list):
+            return condition
+        pks = [int(clause[0]) for clause in clauses]
+    except (ValueError, TypeError, KeyError, IndexError):
+        return condition
+
+    remapped = []
+    for pk, clause in zip(pks, clauses):
+        if pk not in property_pks:
+            raise ArchiveError("condition refers to missing property %s" % pk)
+        remapped.append([property_pks[pk]] + list(clause[1:]))
+    return json.dumps(remapped)
+
+
+class Importer(object):
+
+    def __init__(self, author, batch_size=1000):
+        self.author = author
+        self.batch_size = batch_size
+        self.game = None
+        self.pks = {name: {} for name in TABLES_BY_NAME}
+        self.table = None
+        self.batch = []
+        self.counts = {}
+
+    def add(self, data):
+        model_name = data.get('model')
+        if model_name == 'game':
+            if self.game is not None:
+                raise ArchiveError("Archive holds more than one game")
+            self.game = Game.objects.create(
+                author=self.author,
+                name=data['fields']['name'],
+                description=data['fields'].get('description', ''),
+                status=Game.STATUS_DRAFT
+            )
+            return
+
+        if self.game is None:
+            raise ArchiveError("Archive rows before the game")
+        if model_name not in TABLES_BY_NAME:
+            raise ArchiveError("Unknown model %r" % model_name)
+
+        if model_name != self.table:
+            self.flush()
+            self.table = model_name
+        self.batch.append(data)
+        if len(self.batch) >= self.batch_size:
+            self.flush()
+
+    def build(self, name, model, fields, foreign_keys, data):
+        values = {}
+        for field in fields:
+            value = data['fields'].get(field)
+            if field in foreign_keys:
+                if value is not None:
+                    try:
+                        value = self.pks[foreign_keys[field]][value]
+                    except KeyError:
+                        raise ArchiveError(
+                            "%s %s refers to missing %s %s" %
+                            (name, data['pk'], foreign_keys[field], value)
+                        )
+                values['%s_id' % field] = value
+            elif field == 'condition':
+                try:
+                    values[field] = remap_condition(value, self.pks['property'])
+                except ArchiveError as e:
+                    raise ArchiveError("%s %s %s" % (name, data['pk'], e))
+            elif value is not None:
+                values[field] = value
+        if model is not AfterEffect:
+            values['game'] = self.game
+        return model(**values)
+
+    def flush(self):
+        if not self.batch:
+            return
+        name, model, fields, foreign_keys = TABLES_BY_NAME[self.table]
+        objs = [self.build(name, model, fields, foreign_keys, data) for data in self.batch]
+
+        if connection.features.can_return_ids_from_bulk_insert:
+            model.objects.bulk_create(objs)
+        else:
+            for obj in objs:
+                obj.save()
+
+        pks = self.pks[name]
+        for data, obj in zip(self.batch, objs):
+            pks[data['pk']] = obj.pk
+        self.counts[name] = self.counts.get(name, 0) + len(objs)
+        self.batch = []
+
+
+def import_game(lines, author, batch_size=1000):
+    """
+    Create a draft game of `author` from archive lines.
+    Returns (game, {table name: rows imported}).
+    """
+    lines = iter(lines)
+    try:
+        header = json.loads(next(lines))
+    except (StopIteration, ValueError):
+        raise ArchiveError("Archive has no header")
+    if header.get('format') != FORMAT:
+        raise ArchiveError("Not a gamebook archive")
+    if header.get('version') != VERSION:
+        raise ArchiveError("Unsupported archive version %s" % header.get('version'))
+
+    importer = Importer(author, batch_size)
+    with transaction.atomic():
+        for number, line in enumerate(lines, 2):
+            if not line.strip():
+                continue
+            try:
+                data = json.loads(line)
+            except ValueError as e:
+                raise ArchiveError("Line %s is not valid json: %s" % (number, e))
+            importer.add(data)
+        importer.flush()
+
+        if importer.game is None:
+            raise ArchiveError("Archive holds no game")
+        # bulk_create sends no signals
+        invalidate(importer.game.pk)
+
+    logger.info("Game %s imported: %s" % (importer.game.pk, importer.counts))
+    return importer.game, importer.counts
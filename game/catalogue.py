@@ -0,0 +1,109 @@
+"""
+Catalogue of published games.
+
+The list of published games with their scene and character counts is
+built with one query, kept in the django cache and in a per-process LRU
+and served to the web listing and the telegram bot. Content edits never
+touch it: the version moves forward only when a game's status, name,
+description or published version changes, or a published game gains or
+loses a scene or character (see game.signals and Game.publish).
+"""
+import logging
+import time
+from collections import namedtuple
+
+from django.apps import apps
+from django.conf import settings
+from django.core.cache import cache
+from django.core.paginator import Paginator
+from django.db.models import Count
+
+from gamebook import metrics
+from gamebook.lru import LRUCache
+
+
+logger = logging.getLogger(__name__)
+
+
+VERSION_KEY = 'game.catalogue-version'
+
+CatalogueEntry = namedtuple(
+    'CatalogueEntry', 'pk name description scene_count character_count'
+)
+
+
+class Catalogue(object):
+    __slots__ = ('version', 'entries')
+
+    def __init__(self, version, entries):
+        self.version = version
+        self.entries = entries
+
+    def __len__(self):
+        return len(self.entries)
+
+    def __iter__(self):
+        return iter(self.entries)
+
+    def get_page(self, number, per_page=None):
+        """django Page of entries, invalid numbers give the nearest page."""
+        if per_page is None:
+            per_page = getattr(settings, 'GAME_CATALOGUE_PAGE_SIZE', 10)
+        return Paginator(self.entries, per_page).get_page(number)
+
+
+def catalogue_version():
+    version = cache.get(VERSION_KEY)
+    if version is None:
+        version = int(time.time() * 1000000)
+        if not cache.add(VERSION_KEY, version, None):
+            version = cache.get(VERSION_KEY, version)
+    return version
+
+
+def build_catalogue(version):
+    Game = apps.get_model('game', 'Game')
+    entries = tuple(
+        CatalogueEntry(*row) for row in
+        Game.objects.filter(status=Game.STATUS_PUBLISHED)
+        .annotate(
+            scene_count=Count('scenes', distinct=True),
+            character_count=Count('characters', distinct=True),
+        )
+        .order_by('pk')
+        .values_list('pk', 'name', 'description', 'scene_count', 'character_count')
+    )
+    return Catalogue(version, entries)
+
+
+_catalogues = LRUCache(maxsize=2)
+
+
+def get_catalogue():
+    version = catalogue_version()
+    key = 'game.catalogue-v{}'.format(version)
+
+    catalogue = _catalogues.get(key)
+    if catalogue is not None:
+        metrics.cache_hit('catalogue')
+        return catalogue
+
+    catalogue = cache.get(key)
+    if catalogue is None:
+        metrics.cache_miss('catalogue')
+        logger.debug("Build catalogue v%s" % version)
+        catalogue = build_catalogue(version)
+        cache.set(
+            key, catalogue,
+            getattr(settings, 'GAME_CATALOGUE_CACHE_TIMEOUT', 60 * 60 * 24)
+        )
+    else:
+        metrics.cache_hit('catalogue')
+
+    _catalogues.set(key, catalogue)
+    return catalogue
+
+
+def forget_catalogue(game_id):
+    cache.set(VERSION_KEY, int(time.time() * 1000000), None)
+    _catalogues.clear()
@@ -0,0 +1,290 @@
+"""
+Compiled game.
+
+Read-only snapshot of a game's story graph used at play time. It is built
+with one query per table, kept in the django cache and in a per-process LRU,
+and keyed by the game content version (see game.invalidation).
+
+Sessions of a published game play its pinned GameVersion instead, compiled
+from the rows stored with the version and cached forever.
+"""
+import logging
+from collections import namedtuple
+
+from django.apps import apps
+from django.conf import settings
+from django.core.cache import cache
+
+from game.conditions import AnyOf, ConditionError, NEVER, compile_condition
+from game.invalidation import cache_key, content_version, on_invalidate
+from gamebook import metrics
+from gamebook.lru import LRUCache
+
+
+logger = logging.getLogger(__name__)
+
+
+SceneRecord = namedtuple('SceneRecord', 'pk name default_moment_pk')
+MomentRecord = namedtuple('MomentRecord', 'pk scene_pk name block_pks action_pks')
+BlockRecord = namedtuple('BlockRecord', 'pk moment_pk content predicate')
+ActionRecord = namedtuple('ActionRecord', 'pk moment_pk content predicate effects')
+EffectRecord = namedtuple(
+    'EffectRecord',
+    'go_to_scene_pk go_to_moment_pk set_property_pk set_property_value'
+)
+PropertyRecord = namedtuple('PropertyRecord', 'pk value character_pk')
+CharacterRecord = namedtuple('CharacterRecord', 'pk name start_scene_pk')
+
+
+class CompiledGame(object):
+    __slots__ = (
+        'game_pk', 'version', 'characters', 'scenes', 'moments', 'blocks',
+        'actions', 'properties', 'first_scene_pk',
+    )
+
+    def __init__(self, game_pk, version, characters, scenes, moments, blocks,
+                 actions, properties, first_scene_pk):
+        self.game_pk = game_pk
+        self.version = version
+        self.characters = characters
+        self.scenes = scenes
+        self.moments = moments
+        self.blocks = blocks
+        self.actions = actions
+        self.properties = properties
+        self.first_scene_pk = first_scene_pk
+
+    def __repr__(self):
+        return "<CompiledGame %s v%s>" % (self.game_pk, self.version)
+
+    def get_blocks(self, moment_pk):
+        moment = self.moments.get(moment_pk)
+        if moment is None:
+            return ()
+        return tuple(self.blocks[pk] for pk in moment.block_pks)
+
+    def get_actions(self, moment_pk):
+        moment = self.moments.get(moment_pk)
+        if moment is None:
+            return ()
+        return tuple(self.actions[pk] for pk in moment.action_pks)
+
+    def get_action(self, moment_pk, action_pk):
+        """Action `action_pk` if it belongs to the moment, otherwise None."""
+        action = self.actions.get(action_pk)
+        if action is None or action.moment_pk != moment_pk:
+            return None
+        return action
+
+    def get_default_moment_pk(self, scene_pk):
+        scene = self.scenes.get(scene_pk)
+        if scene is None:
+            return None
+        return scene.default_moment_pk
+
+    def get_start_pks(self, character_pk):
+        """(scene pk, moment pk) where the character starts to play."""
+        character = self.characters.get(character_pk)
+        scene_pk = character and character.start_scene_pk or self.first_scene_pk
+        return scene_pk, self.get_default_moment_pk(scene_pk)
+
+
+def _compile_predicate(model_name, pk, condition):
+    try:
+        return compile_condition(condition, AnyOf)
+    except ConditionError as e:
+        logger.error("Broken condition in %s %s: %s" % (model_name, pk, e))
+        return NEVER
+
+
+def load_game_data(game):
+    """
+    Story rows of the game, one query per table. Plain lists, so the
+    result can be serialized (see GameVersion) and compiled later.
+    """
+    Character = apps.get_model('game', 'Character')
+    Scene = apps.get_model('game', 'Scene')
+    Moment = apps.get_model('game', 'Moment')
+    Block = apps.get_model('game', 'Block')
+    Action = apps.get_model('game', 'Action')
+    AfterEffect = apps.get_model('game', 'AfterEffect')
+    Property = apps.get_model('game', 'Property')
+
+    def rows(queryset):
+        return [list(row) for row in queryset]
+
+    return {
+        'characters': rows(
+            Character.objects.filter(game=game).order_by('pk')
+            .values_list('pk', 'name', 'start_scene_id')
+        ),
+        'scenes': rows(
+            Scene.objects.filter(game=game).order_by('order', 'pk')
+            .values_list('pk', 'name')
+        ),
+        'moments': rows(
+            Moment.objects.filter(game=game).order_by('order', 'pk')
+            .values_list('pk', 'scene_id', 'name')
+        ),
+        'blocks': rows(
+            Block.objects.filter(game=game, moment__isnull=False)
+            .order_by('order', 'pk')
+            .values_list('pk', 'moment_id', 'content', 'condition')
+        ),
+        'actions': rows(
+            Action.objects.filter(game=game, moment__isnull=False)
+            .order_by('order', 'pk')
+            .values_list('pk', 'moment_id', 'content', 'condition')
+        ),
+        'effects': rows(
+            AfterEffect.objects.filter(action__game=game).order_by('pk')
+            .values_list('action_id', 'go_to_scene_id', 'go_to_moment_id',
+                         'set_property_id', 'set_property_value')
+        ),
+        'properties': rows(
+            Property.objects.filter(game=game).order_by('pk')
+            .values_list('pk', 'value', 'character_id')
+        ),
+    }
+
+
+def compile_game_data(game_pk, version, data):
+    """
+    CompiledGame from the rows returned by `load_game_data`. Blocks and
+    actions of a missing moment can never be shown and are left out.
+    """
+    scene_rows = data['scenes']
+    moment_rows = data['moments']
+
+    block_pks = {pk: [] for pk, scene_pk, name in moment_rows}
+    action_pks = {pk: [] for pk, scene_pk, name in moment_rows}
+    default_moments = {}
+    for pk, scene_pk, name in moment_rows:
+        default_moments.setdefault(scene_pk, pk)
+
+    blocks = {}
+    for pk, moment_pk, content, condition in data['blocks']:
+        if moment_pk not in block_pks:
+            continue
+        blocks[pk] = BlockRecord(
+            pk, moment_pk, content,
+            _compile_predicate('block', pk, condition)
+        )
+        block_pks[moment_pk].append(pk)
+
+    effects = {}
+    for action_pk, scene_pk, moment_pk, property_pk, value in data['effects']:
+        effects.setdefault(action_pk, []).append(
+            EffectRecord(scene_pk, moment_pk, property_pk, value)
+        )
+
+    actions = {}
+    for pk, moment_pk, content, condition in data['actions']:
+        if moment_pk not in action_pks:
+            continue
+        actions[pk] = ActionRecord(
+            pk, moment_pk, content,
+            _compile_predicate('action', pk, condition),
+            tuple(effects.get(pk, ()))
+        )
+        action_pks[moment_pk].append(pk)
+
+    return CompiledGame(
+        game_pk=game_pk,
+        version=version,
+        characters={
+            pk: CharacterRecord(pk, name, start_scene_pk)
+            for pk, name, start_scene_pk in data['characters']
+        },
+        scenes={
+            pk: SceneRecord(pk, name, default_moments.get(pk))
+            for pk, name in scene_rows
+        },
+        moments={
+            pk: MomentRecord(
+                pk, scene_pk, name,
+                tuple(block_pks[pk]), tuple(action_pks[pk])
+            )
+            for pk, scene_pk, name in moment_rows
+        },
+        blocks=blocks,
+        actions=actions,
+        properties={
+            pk: PropertyRecord(pk, value, character_pk)
+            for pk, value, character_pk in data['properties']
+        },
+        first_scene_pk=scene_rows[0][0] if scene_rows else None,
+    )
+
+
+def build_compiled_game(game):
+    return compile_game_data(game.pk, content_version(game), load_game_data(game))
+
+
+_compiled_games = LRUCache(
+    maxsize=getattr(settings, 'GAME_COMPILED_CACHE_SIZE', 32)
+)
+
+
+def get_compiled_game(game):
+    key = cache_key('compiled', game.pk, content_version(game))
+
+    compiled = _compiled_games.get(key)
+    if compiled is not None:
+        metrics.cache_hit('compiled')
+        return compiled
+
+    compiled = cache.get(key)
+    if compiled is None:
+        metrics.cache_miss('compiled')
+        logger.debug("Compile game %s" % game)
+        compiled = build_compiled_game(game)
+        cache.set(
+            key, compiled,
+            getattr(settings, 'GAME_COMPILED_CACHE_TIMEOUT', 60 * 60 * 24)
+        )
+    else:
+        metrics.cache_hit('compiled')
+
+    _compiled_games.set(key, compiled)
+    return compiled
+
+
+def version_key(version_pk):
+    return 'game.version-{}'.format(version_pk)
+
+
+def get_version_compiled(version_pk):
+    """
+    Compiled game of a published version. Versions never change, so the
+    result is cached without a timeout and needs no invalidation.
+    """
+    key = version_key(version_pk)
+
+    compiled = _compiled_games.get(key)
+    if compiled is not None:
+        metrics.cache_hit('version')
+        return compiled
+
+    compiled = cache.get(key)
+    if compiled is None:
+        metrics.cache_miss('version')
+        GameVersion = apps.get_model('game', 'GameVersion')
+        version = GameVersion.objects.get(pk=version_pk)
+        logger.debug("Compile game version %s" % version)
+        compiled = compile_game_data(
+            version.game_id, version.content_version, version.get_data()
+        )
+        cache.set(key, compiled, None)
+    else:
+        metrics.cache_hit('version')
+
+    _compiled_games.set(key, compiled)
+    return compiled
+
+
+@on_invalidate
+def forget_compiled_game(game_id):
+    """Free local memory held by stale versions of the game."""
+    prefix = cache_key('compiled', game_id, '')
+    _compiled_games.delete_matching(lambda key: key.startswith(prefix))
@@ -0,0 +1,206 @@
+"""
+Condition engine.
+
+Conditions of blocks and actions are stored as json lists of
+``[property_pk, operator, value]`` clauses. They are compiled once into
+predicate objects and evaluated against an in-memory mapping of
+``{property_pk: value}``, so checking a condition never touches the database.
+
+Property values are stored as strings. When both sides of a clause are
+numbers they are compared as numbers (``'9' < '10'``), otherwise as strings.
+"""
+import json
+import logging
+import math
+import operator
+
+from gamebook.lru import LRUCache
+
+
+logger = logging.getLogger(__name__)
+
+
+OPERATORS = {
+    '==': operator.eq,
+    '!=': operator.ne,
+    '>=': operator.ge,
+    '>': operator.gt,
+    '<=': operator.le,
+    '<': operator.lt,
+}
+
+
+class ConditionError(ValueError):
+    pass
+
+
+def _number(value):
+    try:
+        number = float(value)
+    except (TypeError, ValueError):
+        return None
+    return number if math.isfinite(number) else None
+
+
+def compare(operator_name, left, right):
+    """Apply a condition operator, numerically if both values are numbers."""
+    left_number = _number(left)
+    if left_number is not None:
+        right_number = _number(right)
+        if right_number is not None:
+            return OPERATORS[operator_name](left_number, right_number)
+    return OPERATORS[operator_name](left, right)
+
+
+class Clause(object):
+    __slots__ = ('property_pk', 'operator', 'value')
+
+    def __init__(self, property_pk, operator, value):
+        if operator not in OPERATORS:
+            raise ConditionError("Unknown condition operator %r" % operator)
+        self.property_pk = int(property_pk)
+        self.operator = operator
+        # property values are stored as strings, see `compare`
+        self.value = str(value)
+
+    def __repr__(self):
+        return "Clause(%s %s %r)" % (self.property_pk, self.operator, self.value)
+
+    def __call__(self, values):
+        try:
+            session_value = values[self.property_pk]
+        except KeyError:
+            return False
+        return compare(self.operator, session_value, self.value)
+
+    @property
+    def properties(self):
+        return frozenset((self.property_pk, ))
+
+
+class Combinator(object):
+    __slots__ = ('predicates', )
+
+    def __init__(self, predicates):
+        self.predicates = tuple(predicates)
+
+    def __repr__(self):
+        return "%s(%s)" % (
+            self.__class__.__name__,
+            ", ".join(repr(p) for p in self.predicates)
+        )
+
+    @property
+    def properties(self):
+        result = frozenset()
+        for predicate in self.predicates:
+            result |= predicate.properties
+        return result
+
+
+class AnyOf(Combinator):
+    __slots__ = ()
+
+    def __call__(self, values):
+        for predicate in self.predicates:
+            if predicate(values):
+                return True
+        return False
+
+
+class AllOf(Combinator):
+    __slots__ = ()
+
+    def __call__(self, values):
+        for predicate in self.predicates:
+            if not predicate(values):
+                return False
+        return True
+
+
+class Always(object):
+    __slots__ = ()
+
+    def __repr__(self):
+        return "Always()"
+
+    def __call__(self, values):
+        return True
+
+    @property
+    def properties(self):
+        return frozenset()
+
+
+class Never(Always):
+    __slots__ = ()
+
+    def __repr__(self):
+        return "Never()"
+
+    def __call__(self, values):
+        return False
+
+
+ALWAYS = Always()
+NEVER = Never()
+
+
+def compile_condition(condition_text, combinator=AnyOf):
+    """
+    Turn stored condition json into a predicate.
+    An empty condition is always true, whatever the combinator is.
+    """
+    if not condition_text or not condition_text.strip():
+        return ALWAYS
+
+    try:
+        clauses = json.loads(condition_text)
+    except ValueError as e:
+        raise ConditionError("Condition is not valid json: %s" % e)
+
+    if not clauses:
+        return ALWAYS
+
+    if not isinstance(clauses, list):
+        raise ConditionError("Condition must be a list of clauses")
+
+    predicates = []
+    for clause in clauses:
+        try:
+            property_pk, condition_type, condition_value = clause
+        except (TypeError, ValueError):
+            raise ConditionError("Bad condition clause %r" % (clause, ))
+        try:
+            predicates.append(Clause(property_pk, condition_type, condition_value))
+        except (TypeError, ValueError) as e:
+            raise ConditionError("Bad condition clause %r: %s" % (clause, e))
+
+    return combinator(predicates)
+
+
+_predicates = LRUCache(maxsize=4096)
+
+
+def get_predicate(instance, combinator=AnyOf):
+    """
+    Compiled predicate of a Block or Action, cached per row version.
+    A broken condition is logged once and never matches.
+    """
+    key = (
+        instance._meta.label_lower,
+        instance.pk,
+        instance.updated_at,
+        combinator.__name__,
+    )
+    predicate = _predicates.get(key)
+    if predicate is None:
+        try:
+            predicate = compile_condition(instance.condition, combinator)
+        except ConditionError as e:
+            logger.error("Broken condition in %s %s: %s" % (
+                instance._meta.label_lower, instance.pk, e
+            ))
+            predicate = NEVER
+        _predicates.set(key, predicate)
+    return predicate
@@ -0,0 +1,195 @@
+"""
+Story graph analysis.
+
+Nodes of the story graph are moments. Every action adds an edge from its
+moment to the moment the character ends up in after the action's after
+effects (entering a scene means entering its default moment). Play starts
+in the default moment of each character's start scene.
+
+The graph is built from the compiled game (see game.compiled), so it costs
+no queries per node, and the analysis is cached per game content version.
+All walks are iterative, deep graphs do not hit the recursion limit.
+"""
+import logging
+
+from django.conf import settings
+from django.core.cache import cache
+
+from game.compiled import get_compiled_game
+from game.invalidation import cache_key, content_version, on_invalidate
+from gamebook.lru import LRUCache
+
+
+logger = logging.getLogger(__name__)
+
+
+class StoryGraph(object):
+    """Adjacency of moments: {moment_pk: (target moment pks)}."""
+    __slots__ = ('edges', 'start_pks')
+
+    def __init__(self, edges, start_pks):
+        self.edges = edges
+        self.start_pks = start_pks
+
+    def __len__(self):
+        return len(self.edges)
+
+
+class GraphReport(object):
+    __slots__ = (
+        'version', 'moments', 'reachable', 'unreachable_moments',
+        'unreachable_scenes', 'dead_ends', 'cycles', 'components',
+    )
+
+    def __init__(self, **kwargs):
+        for name in self.__slots__:
+            setattr(self, name, kwargs[name])
+
+    @property
+    def is_ok(self):
+        return not (self.unreachable_moments or self.dead_ends)
+
+
+def action_target(compiled, action):
+    """Moment the character is in after the action, None if it does not move."""
+    target = None
+    for effect in action.effects:
+        if effect.go_to_scene_pk:
+            target = compiled.get_default_moment_pk(effect.go_to_scene_pk)
+        if effect.go_to_moment_pk:
+            target = effect.go_to_moment_pk
+    return target
+
+
+def build_graph(game, compiled=None):
+    if compiled is None:
+        compiled = get_compiled_game(game)
+
+    edges = {}
+    for moment_pk, moment in compiled.moments.items():
+        targets = []
+        for action_pk in moment.action_pks:
+            target = action_target(compiled, compiled.actions[action_pk])
+            if target is not None and target in compiled.moments and target not in targets:
+                targets.append(target)
+        edges[moment_pk] = tuple(targets)
+
+    start_pks = []
+    for character_pk in compiled.characters:
+        scene_pk, moment_pk = compiled.get_start_pks(character_pk)
+        if moment_pk is not None and moment_pk not in start_pks:
+            start_pks.append(moment_pk)
+
+    return StoryGraph(edges, tuple(start_pks))
+
+
+def reachable_from(graph, start_pks):
+    seen = set(start_pks)
+    stack = list(start_pks)
+    while stack:
+        for target in graph.edges.get(stack.pop(), ()):
+            if target not in seen:
+                seen.add(target)
+                stack.append(target)
+    return seen
+
+
+def strongly_connected_components(graph):
+    """Tarjan's algorithm without recursion. Returns a list of tuples of moment pks."""
+    index = {}
+    lowlink = {}
+    on_stack = set()
+    stack = []
+    components = []
+    counter = 0
+
+    for root in graph.edges:
+        if root in index:
+            continue
+        work = [(root, iter(graph.edges[root]))]
+        index[root] = lowlink[root] = counter
+        counter += 1
+        stack.append(root)
+        on_stack.add(root)
+
+        while work:
+            node, targets = work[-1]
+            for target in targets:
+                if target not in index:
+                    index[target] = lowlink[target] = counter
+                    counter += 1
+                    stack.append(target)
+                    on_stack.add(target)
+                    work.append((target, iter(graph.edges.get(target, ()))))
+                    break
+                if target in on_stack:
+                    lowlink[node] = min(lowlink[node], index[target])
+            else:
+                work.pop()
+                if work:
+                    parent = work[-1][0]
+                    lowlink[parent] = min(lowlink[parent], lowlink[node])
+                if lowlink[node] == index[node]:
+                    component = []
+                    while True:
+                        member = stack.pop()
+                        on_stack.discard(member)
+                        component.append(member)
+                        if member == node:
+                            break
+                    components.append(tuple(component))
+    return components
+
+
+def analyze(game, compiled=None):
+    if compiled is None:
+        compiled = get_compiled_game(game)
+    graph = build_graph(game, compiled)
+    reachable = reachable_from(graph, graph.start_pks)
+    components = strongly_connected_components(graph)
+
+    reachable_scenes = {compiled.moments[pk].scene_pk for pk in reachable}
+    return GraphReport(
+        version=compiled.version,
+        moments=len(graph),
+        reachable=frozenset(reachable),
+        unreachable_moments=tuple(pk for pk in graph.edges if pk not in reachable),
+        unreachable_scenes=tuple(pk for pk in compiled.scenes if pk not in reachable_scenes),
+        dead_ends=tuple(
+            pk for pk, moment in compiled.moments.items() if not moment.action_pks
+        ),
+        cycles=tuple(
+            component for component in components
+            if len(component) > 1 or component[0] in graph.edges[component[0]]
+        ),
+        components=len(components),
+    )
+
+
+_reports = LRUCache(maxsize=getattr(settings, 'GAME_GRAPH_CACHE_SIZE', 32))
+
+
+def get_report(game):
+    key = cache_key('graph', game.pk, content_version(game))
+
+    report = _reports.get(key)
+    if report is not None:
+        return report
+
+    report = cache.get(key)
+    if report is None:
+        logger.debug("Analyze story graph of game %s" % game)
+        report = analyze(game)
+        cache.set(
+            key, report,
+            getattr(settings, 'GAME_GRAPH_CACHE_TIMEOUT', 60 * 60 * 24)
+        )
+
+    _reports.set(key, report)
+    return report
+
+
+@on_invalidate
+def forget_report(game_id):
+    prefix = cache_key('graph', game_id, '')
+    _reports.delete_matching(lambda key: key.startswith(prefix))
@@ -0,0 +1,141 @@
+"""
+Invalidation of cached game content.
+
+Every cache of game content (compiled game, catalogue, analysis results)
+keys its entries with the game content version, so a bump of the version
+makes all of them miss at once, in every process. The version is
+`Game.updated_at`: it is read together with the game row for free and
+`invalidate` moves it forward on any change of the game's rows
+(see game.signals). Signals use `invalidate_on_commit`, so a transaction
+that changes many rows of a game bumps its version once, when it commits.
+
+Code that changes rows bypassing model signals (queryset.update,
+bulk_create) must call `invalidate` itself.
+"""
+import logging
+
+from django.apps import apps
+from django.db import transaction
+from django.utils import timezone
+
+
+logger = logging.getLogger(__name__)
+
+
+_listeners = []
+
+
+def content_version(game):
+    return int(game.updated_at.timestamp() * 1000000)
+
+
+def cache_key(name, game_pk, version, *parts):
+    key = 'game.{}-{}-v{}'.format(name, game_pk, version)
+    if parts:
+        key += '-' + '-'.join(str(part) for part in parts)
+    return key
+
+
+def on_invalidate(callback):
+    """
+    Register `callback(game_id)` to be called after a game is invalidated.
+    Can be used as a decorator.
+    """
+    _listeners.append(callback)
+    return callback
+
+
+def invalidate(game_id, touch=True):
+    """
+    Bump the content version of a game and notify listeners.
+    `touch=False` is for changes of the Game row itself, which already
+    moved `updated_at` forward.
+    """
+    if not game_id:
+        return
+
+    if touch:
+        Game = apps.get_model('game', 'Game')
+        Game.objects.filter(pk=game_id).update(updated_at=timezone.now())
+
+    _notify(game_id)
+
+
+def _notify(game_id):
+    for callback in _listeners:
+        try:
+            callback(game_id)
+        except Exception:
+            logger.exception(
+                "Invalidation listener %s failed for game %s" %
+                (callback, game_id)
+            )
+
+
+class PendingInvalidations(object):
+    """
+    Games changed in the current transaction, invalidated together by
+    calling the instance once it commits.
+    """
+    __slots__ = ('games', 'action_ids')
+
+    def __init__(self):
+        self.games = {}
+        self.action_ids = set()
+
+    def add(self, game_id, touch):
+        self.games[game_id] = self.games.get(game_id, False) or touch
+
+    def __call__(self):
+        if self.action_ids:
+            Action = apps.get_model('game', 'Action')
+            for game_id in (Action.objects.filter(pk__in=self.action_ids)
+                            .values_list('game_id', flat=True).distinct()):
+                self.add(game_id, True)
+
+        touched = [game_id for game_id, touch in self.games.items() if touch]
+        if touched:
+            Game = apps.get_model('game', 'Game')
+            Game.objects.filter(pk__in=touched).update(updated_at=timezone.now())
+
+        for game_id in self.games:
+            _notify(game_id)
+
+
+def _pending():
+    """Invalidations waiting for the commit of the current transaction."""
+    connection = transaction.get_connection()
+    pending = getattr(connection, 'game_invalidations', None)
+    # on_commit callbacks are dropped when the transaction (or the
+    # savepoint that registered them) rolls back
+    if pending is None or not any(
+            func is pending for sids, func in connection.run_on_commit):
+        pending = connection.game_invalidations = PendingInvalidations()
+        transaction.on_commit(pending)
+    return pending
+
+
+def invalidate_on_commit(game_id=None, touch=True, action_id=None):
+    """
+    `invalidate` once the current transaction commits, every game at most
+    once per transaction. The game may be given by the pk of one of its
+    actions, it is looked up on commit together with the others. Outside
+    of a transaction the game is invalidated at once.
+    """
+    if not (game_id or action_id):
+        return
+
+    if not transaction.get_connection().in_atomic_block:
+        if not game_id:
+            Action = apps.get_model('game', 'Action')
+            game_id = Action.objects.filter(pk=action_id).values_list(
+                'game_id', flat=True
+            ).first()
+        invalidate(game_id, touch)
+        return
+
+    pending = _pending()
+    if game_id:
+        pending.add(game_id, touch)
+    else:
+        pending.action_ids.add(action_id)
@@ -0,0 +1,46 @@
+import time
+
+from django.core.management.base import BaseCommand, CommandError
+
+from game.compiled import get_compiled_game
+from game.graph import analyze
+from game.models import Game
+
+
+class Command(BaseCommand):
+    help = "Report unreachable moments, dead ends and loops of a game's story"
+
+    def add_arguments(self, parser):
+        parser.add_argument('game_pk', type=int)
+
+    def handle(self, *args, **options):
+        try:
+            game = Game.objects.get(pk=options['game_pk'])
+        except Game.DoesNotExist:
+            raise CommandError("Game %s does not exist" % options['game_pk'])
+
+        compiled = get_compiled_game(game)
+        started = time.perf_counter()
+        report = analyze(game, compiled)
+        elapsed = time.perf_counter() - started
+
+        def names(pks):
+            return ", ".join(
+                "%s (%s)" % (compiled.moments[pk].name, pk) for pk in pks
+            ) or "-"
+
+        self.stdout.write("%s: %s moments, %s reachable, %s components, analyzed in %.3f s" % (
+            game, report.moments, len(report.reachable), report.components, elapsed
+        ))
+        self.stdout.write("Unreachable moments: %s" % names(report.unreachable_moments))
+        self.stdout.write("Unreachable scenes: %s" % (", ".join(
+            "%s (%s)" % (compiled.scenes[pk].name, pk) for pk in report.unreachable_scenes
+        ) or "-"))
+        self.stdout.write("Dead ends: %s" % names(report.dead_ends))
+        for cycle in report.cycles:
+            self.stdout.write("Loop: %s" % names(cycle))
+
+        if report.is_ok:
+            self.stdout.write(self.style.SUCCESS("Story graph is fine"))
+        else:
+            self.stdout.write(self.style.WARNING("Story graph has problems"))
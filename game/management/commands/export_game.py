@@ -0,0 +1,34 @@
+import gzip
+import sys
+
+from django.core.management.base import BaseCommand, CommandError
+
+from game.archive import export_game
+from game.models import Game
+
+
+class Command(BaseCommand):
+    help = "Export a game as a newline-delimited json archive"
+
+    def add_arguments(self, parser):
+        parser.add_argument('game_pk', type=int)
+        parser.add_argument(
+            '--output',
+            help="Archive file, gzipped if it ends with .gz (default: stdout)"
+        )
+
+    def handle(self, *args, **options):
+        try:
+            game = Game.objects.get(pk=options['game_pk'])
+        except Game.DoesNotExist:
+            raise CommandError("Game %s does not exist" % options['game_pk'])
+
+        output = options['output']
+        if not output:
+            sys.stdout.writelines(export_game(game))
+            return
+
+        opener = gzip.open if output.endswith('.gz') else open
+        with opener(output, 'wt', encoding='utf-8') as f:
+            f.writelines(export_game(game))
+        self.stderr.write(self.style.SUCCESS("Game %s exported to %s" % (game, output)))
@@ -0,0 +1,36 @@
+import gzip
+import time
+
+from django.contrib.auth import get_user_model
+from django.core.management.base import BaseCommand, CommandError
+
+from game.archive import ArchiveError, import_game
+
+
+class Command(BaseCommand):
+    help = "Import a game archive made by export_game as a draft game"
+
+    def add_arguments(self, parser):
+        parser.add_argument('path', help="Archive file, gzipped if it ends with .gz")
+        parser.add_argument('--author', required=True, help="Username of the game author")
+        parser.add_argument('--batch-size', type=int, default=1000)
+
+    def handle(self, *args, **options):
+        User = get_user_model()
+        try:
+            author = User.objects.get(username=options['author'])
+        except User.DoesNotExist:
+            raise CommandError("User %s does not exist" % options['author'])
+
+        opener = gzip.open if options['path'].endswith('.gz') else open
+        started = time.perf_counter()
+        try:
+            with opener(options['path'], 'rt', encoding='utf-8') as f:
+                game, counts = import_game(f, author, options['batch_size'])
+        except ArchiveError as e:
+            raise CommandError(e)
+
+        self.stdout.write(", ".join("%s: %s" % item for item in sorted(counts.items())))
+        self.stdout.write(self.style.SUCCESS(
+            "Game %s (%s) imported in %.1f s" % (game, game.pk, time.perf_counter() - started)
+        ))
@@ -0,0 +1,37 @@
+# Generated by Django 2.0.4 on 2026-10-18 13:00
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('game', '0001_initial'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='GameVersion',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('created_at', models.DateTimeField(auto_now_add=True, verbose_name='Date created')),
+                ('number', models.PositiveIntegerField(verbose_name='number')),
+                ('content_version', models.BigIntegerField(verbose_name='content version')),
+                ('data', models.BinaryField(verbose_name='data')),
+                ('game', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='versions', to='game.Game', verbose_name='game')),
+            ],
+            options={
+                'ordering': ['game', 'number'],
+            },
+        ),
+        migrations.AlterUniqueTogether(
+            name='gameversion',
+            unique_together={('game', 'number')},
+        ),
+        migrations.AddField(
+            model_name='game',
+            name='published_version',
+            field=models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='+', to='game.GameVersion', verbose_name='published version'),
+        ),
+    ]
@@ -1,12 +1,17 @@
 import json
 import logging
+import zlib
 
-from django.db import models
-from django.db.models import Q
+from django.db import models, transaction
+from django.db.models import Max
 from django.conf import settings
 from django.utils.translation import ugettext_lazy as _
 from django.urls import reverse
 from play.models import Session, SessionCharacter
+from game.catalogue import forget_catalogue
+from game.compiled import get_version_compiled, load_game_data
+from game.conditions import AnyOf, get_predicate
+from game.invalidation import content_version
 
 
 logger = logging.getLogger(__name__)
@@ -29,6 +34,14 @@ class Game(models.Model):
                                verbose_name=_('author'),
                                related_name='created_games',
                                on_delete=models.CASCADE)
+    published_version = models.ForeignKey(to='GameVersion',
+                                          verbose_name=_('published version'),
+                                          related_name='+',
+                                          null=True, blank=True,
+                                          on_delete=models.SET_NULL)
+
+    # what the catalogue shows of a game, see game.catalogue
+    CATALOGUE_FIELDS = ('status', 'name', 'description', 'published_version_id')
 
     class Meta:
         ordering = ['pk']
@@ -36,6 +49,26 @@ class Game(models.Model):
     def __str__(self):
         return self.name
 
+    @classmethod
+    def from_db(cls, db, field_names, values):
+        instance = super().from_db(db, field_names, values)
+        instance.remember_catalogue_fields()
+        return instance
+
+    def refresh_from_db(self, *args, **kwargs):
+        super().refresh_from_db(*args, **kwargs)
+        self.remember_catalogue_fields()
+
+    def get_catalogue_fields(self):
+        return tuple(getattr(self, field) for field in self.CATALOGUE_FIELDS)
+
+    def remember_catalogue_fields(self):
+        """Values the catalogue was built from, None if some are deferred."""
+        if self.get_deferred_fields().intersection(self.CATALOGUE_FIELDS):
+            self._catalogue_fields = None
+        else:
+            self._catalogue_fields = self.get_catalogue_fields()
+
     def get_absolute_url(self):
         return reverse('game_detail', args=(self.pk, ))
 
@@ -48,16 +81,47 @@ class Game(models.Model):
     def can_create_new_scene(self):
         return True
 
+    def publish(self):
+        """
+        Snapshot the current draft into a new version. Sessions started from
+        now on play this version, running sessions keep their own.
+        """
+        with transaction.atomic():
+            # numbers of concurrent publications must not clash, and the
+            # snapshot is stamped with the version of the rows it reads
+            self.updated_at = Game.objects.select_for_update().filter(
+                pk=self.pk
+            ).values_list('updated_at', flat=True).get()
+            number = self.versions.aggregate(number=Max('number'))['number'] or 0
+            version = GameVersion.from_game(self, number + 1)
+            version.save()
+
+            # no save(): it would move updated_at and with it the content
+            # version, while publishing changes no content of the draft
+            Game.objects.filter(pk=self.pk).update(
+                published_version=version,
+                status=self.STATUS_PUBLISHED
+            )
+            self.published_version = version
+            self.status = self.STATUS_PUBLISHED
+            self.remember_catalogue_fields()
+
+            transaction.on_commit(lambda: forget_catalogue(self.pk))
+
+        logger.info("Game %s published as version %s" % (self.pk, version.number))
+        return version
+
     def get_user_game(self, user):
         session, created = Session.objects.get_or_create(
             user=user,
             game=self,
-            status=Session.STATUS_ACTIVE
+            status=Session.STATUS_ACTIVE,
+            defaults={'game_version_id': self.published_version_id}
         )
 
         if created:
-            for character in self.characters.all():
-                session_character = character.create_new(session)
+            for character_pk in session.compiled_game.characters:
+                session_character = SessionCharacter.start(session, character_pk)
 
                 if not session.active_character:
                     session.active_character = session_character
@@ -86,22 +150,53 @@ class Character(models.Model):
         return "%s (%s)" % (self.name, self.game)
 
     def get_absolute_url(self):
-        return reverse('character_detail', args=(self.game.pk, self.pk, ))
+        return reverse('character_detail', args=(self.game_id, self.pk, ))
 
     def create_new(self, session):
-        if self.start_scene:
-            start_scene = self.start_scene
-        else:
-            start_scene = self.game.scenes.first()
+        return SessionCharacter.start(session, self.pk)
+
 
-        session_character = SessionCharacter(
-            character=self,
-            session=session,
-            current_scene=start_scene,
-            current_moment=start_scene.get_default_moment()
+class GameVersion(models.Model):
+    """
+    Published snapshot of a game. `data` is zlib compressed json of the
+    story rows (see game.compiled.load_game_data). Versions are never
+    changed, the author keeps editing the draft rows.
+    """
+
+    created_at = models.DateTimeField(_("Date created"), auto_now_add=True)
+    game = models.ForeignKey(to='Game', verbose_name=_('game'),
+                             related_name='versions',
+                             on_delete=models.CASCADE)
+    number = models.PositiveIntegerField(verbose_name=_('number'))
+    content_version = models.BigIntegerField(verbose_name=_('content version'))
+    data = models.BinaryField(verbose_name=_('data'))
+
+    class Meta:
+        ordering = ['game', 'number']
+        unique_together = (
+            ("game", "number"),
+        )
+
+    def __str__(self):
+        return "%s v%s" % (self.game_id, self.number)
+
+    @classmethod
+    def from_game(cls, game, number):
+        return cls(
+            game=game,
+            number=number,
+            content_version=content_version(game),
+            data=zlib.compress(
+                json.dumps(load_game_data(game)).encode('utf-8')
+            )
         )
-        session_character.save()
-        return session_character
+
+    def get_data(self):
+        return json.loads(zlib.decompress(bytes(self.data)).decode('utf-8'))
+
+    @property
+    def compiled_game(self):
+        return get_version_compiled(self.pk)
 
 
 class Property(models.Model):
@@ -130,29 +225,11 @@ class Property(models.Model):
         return "%s (%s)" % (self.name, self.type)
 
     def get_session_value(self, session_character):
-        try:
-            query = Q(character__isnull=True)
-            query.add(Q(character=session_character.character), Q.OR)
-            query.add(Q(property=self), Q.AND)
-            query.add(Q(session=session_character.session), Q.AND)
-
-            session_property = SessionProperty.objects.get(query)
-
-            return session_property.value
-        except SessionProperty.DoesNotExist:
-            return self.value
-
-    def set_value(self, value, session_character=None):
-        session_data, created = SessionProperty.objects.get_or_create(
-            property=self,
-            Session=session_character.session,
-            defaults={
-                'current_value': value,
-                'character': session_character
-            }
-        )
-        if not created:
-            session_data.current_value = value
+        return session_character.state.get(self.pk, self.value)
+
+    def set_value(self, value, session_character):
+        session_character.state.set(self.pk, value)
+        session_character.state.flush()
 
 
 class Scene(models.Model):
@@ -171,7 +248,7 @@ class Scene(models.Model):
         return "%s" % self.name
 
     def get_absolute_url(self):
-        return reverse('scene_detail', args=(self.game.pk, self.pk, ))
+        return reverse('scene_detail', args=(self.game_id, self.pk, ))
 
     def get_default_moment(self):
         return self.moments.first()
@@ -195,7 +272,7 @@ class Moment(models.Model):
         return "%s: %s" % (self.scene, self.name)
 
     def get_absolute_url(self):
-        return reverse('moment_detail', args=(self.game.pk, self.scene.pk, self.pk, ))
+        return reverse('moment_detail', args=(self.game_id, self.scene_id, self.pk, ))
 
     def get_blocks_for_character(self, session_character):
         result = []
@@ -234,38 +311,8 @@ class Block(models.Model):
         return "%s: %s" % (self.moment, self.content[:50])
 
     def check_condition(self, session_character):
-        condition_dict = json.loads(self.condition)
-        if not condition_dict:
-            return True
-
-        for condition in condition_dict:
-            property_pk, condition_type, condition_value = condition
-            try:
-                property = Property.objects.get(pk=property_pk)
-                session_value = property.get_session_value(session_character)
-            except Property.DoesNotExist:
-                return False
-
-            if condition_type == "==":
-                if session_value == condition_value:
-                    return True
-            elif condition_type == ">=":
-                if session_value >= condition_value:
-                    return True
-            elif condition_type == ">":
-                if session_value > condition_value:
-                    return True
-            elif condition_type == "<=":
-                if session_value <= condition_value:
-                    return True
-            elif condition_type == "<":
-                if session_value < condition_value:
-                    return True
-            elif condition_type == "!=":
-                if session_value != condition_value:
-                    return True
-
-        return False
+        predicate = get_predicate(self, AnyOf)
+        return predicate(session_character.get_property_values())
 
 
 class Action(models.Model):
@@ -290,38 +337,8 @@ class Action(models.Model):
         return "%s: %s" % (self.scene, self.content)
 
     def check_condition(self, session_character):
-        condition_dict = json.loads(self.condition)
-        if not condition_dict:
-            return True
-
-        for condition in condition_dict:
-            property_pk, condition_type, condition_value = condition
-            try:
-                property = Property.objects.get(pk=property_pk)
-                session_value = property.get_session_value(session_character)
-            except Property.DoesNotExist:
-                return False
-
-            if condition_type == "==":
-                if session_value == condition_value:
-                    return True
-            elif condition_type == ">=":
-                if session_value >= condition_value:
-                    return True
-            elif condition_type == ">":
-                if session_value > condition_value:
-                    return True
-            elif condition_type == "<=":
-                if session_value <= condition_value:
-                    return True
-            elif condition_type == "<":
-                if session_value < condition_value:
-                    return True
-            elif condition_type == "!=":
-                if session_value != condition_value:
-                    return True
-
-        return False
+        predicate = get_predicate(self, AnyOf)
+        return predicate(session_character.get_property_values())
 
     def fire_after_effects(self, session_character):
         if self.check_condition(session_character):
@@ -390,6 +407,6 @@ class AfterEffect(models.Model):
 
         if self.set_property:
             self.set_property.set_value(
-                session_character,
-                self.set_property_value
+                self.set_property_value,
+                session_character
             )
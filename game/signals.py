@@ -0,0 +1,70 @@
+from django.db import transaction
+from django.db.models.signals import post_save, post_delete
+from django.dispatch import receiver
+
+from game.catalogue import forget_catalogue
+from game.invalidation import invalidate_on_commit
+from game.models import (
+    Game, Character, Property, Scene, Moment, Block, Action, AfterEffect
+)
+
+
+@receiver(post_save, sender=Game)
+@receiver(post_delete, sender=Game)
+def game_changed(sender, instance, **kwargs):
+    invalidate_on_commit(instance.pk, touch=False)
+
+
+@receiver(post_save, sender=Game)
+def game_listing_changed(sender, instance, **kwargs):
+    loaded = getattr(instance, '_catalogue_fields', None)
+    instance.remember_catalogue_fields()
+    if loaded == instance._catalogue_fields:
+        return
+    if instance.status == Game.STATUS_PUBLISHED or (
+            loaded is None or loaded[0] == Game.STATUS_PUBLISHED):
+        transaction.on_commit(lambda: forget_catalogue(instance.pk))
+
+
+@receiver(post_delete, sender=Game)
+def game_unlisted(sender, instance, **kwargs):
+    if instance.status == Game.STATUS_PUBLISHED:
+        transaction.on_commit(lambda: forget_catalogue(instance.pk))
+
+
+@receiver(post_save, sender=Character)
+@receiver(post_delete, sender=Character)
+@receiver(post_save, sender=Scene)
+@receiver(post_delete, sender=Scene)
+def game_counts_changed(sender, instance, created=True, **kwargs):
+    # the catalogue counts scenes and characters of published games
+    if not created:
+        return
+    status = Game.objects.filter(pk=instance.game_id).values_list('status', flat=True).first()
+    if status in (Game.STATUS_PUBLISHED, None):
+        transaction.on_commit(lambda: forget_catalogue(instance.game_id))
+
+
+@receiver(post_save, sender=Character)
+@receiver(post_delete, sender=Character)
+@receiver(post_save, sender=Property)
+@receiver(post_delete, sender=Property)
+@receiver(post_save, sender=Scene)
+@receiver(post_delete, sender=Scene)
+@receiver(post_save, sender=Moment)
+@receiver(post_delete, sender=Moment)
+@receiver(post_save, sender=Block)
+@receiver(post_delete, sender=Block)
+@receiver(post_save, sender=Action)
+@receiver(post_delete, sender=Action)
+def game_content_changed(sender, instance, **kwargs):
+    invalidate_on_commit(instance.game_id)
+
+
+@receiver(post_save, sender=AfterEffect)
+@receiver(post_delete, sender=AfterEffect)
+def after_effect_changed(sender, instance, **kwargs):
+    if AfterEffect.action.is_cached(instance):
+        invalidate_on_commit(instance.action.game_id)
+    else:
+        invalidate_on_commit(action_id=instance.action_id)
@@ -0,0 +1,26 @@
+from __future__ import absolute_import, unicode_literals
+
+import logging
+
+from huey.contrib.djhuey import db_task
+
+from game import visibility
+from game.models import Game
+
+
+logger = logging.getLogger(__name__)
+
+
+@db_task(retries=2, retry_delay=10)
+def analyze_visibility(game_pk):
+    try:
+        game = Game.objects.get(pk=game_pk)
+    except Game.DoesNotExist:
+        logger.error("Game %s does not exist" % game_pk)
+        return
+
+    report = visibility.store_report(game)
+    logger.info(
+        "Visibility of game %s v%s: %s hidden blocks, %s hidden actions" %
+        (game_pk, report.version, len(report.hidden_blocks), len(report.hidden_actions))
+    )
@@ -1,3 +1,558 @@
-from django.test import TestCase
+import json
+from unittest import mock
 
-# Create your tests here.
+from django.contrib.auth.models import User
+from django.db import transaction
+from django.core.cache import cache
+from django.test import SimpleTestCase, TestCase, TransactionTestCase
+from django.urls import reverse
+
+from game import archive, catalogue, graph, invalidation, visibility
+from game import compiled as compiled_cache
+from game.compiled import build_compiled_game, compile_game_data
+from game.conditions import (
+    ALWAYS, NEVER, AllOf, AnyOf, Clause, ConditionError, compare, compile_condition
+)
+from game.graph import StoryGraph, build_graph
+from game.models import Action, AfterEffect, Block, Character, Game, Moment, Property, Scene
+from game.utils import condition_text_checker
+
+
+def condition(*clauses):
+    return json.dumps([list(clause) for clause in clauses])
+
+
+def story(**data):
+    """Compiled game from rows in the format of `load_game_data`."""
+    rows = {
+        'characters': [], 'scenes': [], 'moments': [], 'blocks': [],
+        'actions': [], 'effects': [], 'properties': [],
+    }
+    rows.update(data)
+    return compile_game_data(1, 1, rows)
+
+
+class ConditionTest(SimpleTestCase):
+
+    def test_empty_condition_always_holds(self):
+        for text in ('', '  ', '[]', None):
+            self.assertIs(compile_condition(text, AllOf), ALWAYS)
+
+    def test_any_and_all(self):
+        text = condition((1, '==', 'a'), (2, '==', 'b'))
+        values = {1: 'a', 2: 'c'}
+        self.assertTrue(compile_condition(text, AnyOf)(values))
+        self.assertFalse(compile_condition(text, AllOf)(values))
+
+    def test_missing_property_does_not_match(self):
+        self.assertFalse(compile_condition(condition((1, '!=', 'a')))({}))
+
+    def test_values_are_compared_as_strings(self):
+        predicate = compile_condition(condition((1, '==', 1)))
+        self.assertEqual(predicate.predicates[0].value, '1')
+        self.assertTrue(predicate({1: '1'}))
+        self.assertTrue(compare('<', 'apple', 'banana'))
+        self.assertTrue(compare('!=', 'a', '1'))
+
+    def test_numbers_are_compared_as_numbers(self):
+        self.assertTrue(compile_condition(condition((1, '<', '10')))({1: '9'}))
+        self.assertTrue(compare('>=', '10', '9'))
+        self.assertTrue(compare('==', '1.0', '1'))
+        self.assertFalse(compare('>', '-2', '1'))
+        self.assertTrue(compare('!=', 'nan', '1'))
+
+    def test_broken_conditions(self):
+        for text in ('{', '{"a": 1}', '[[1, "=="]]', '[[1, "~", "a"]]', '[["x", "==", "a"]]'):
+            with self.assertRaises(ConditionError):
+                compile_condition(text)
+
+    def test_broken_condition_text_does_not_hold(self):
+        character = mock.Mock(**{'get_property_values.return_value': {1: 'a'}})
+        self.assertFalse(condition_text_checker('[[1, "~", "a"]]', character))
+        self.assertTrue(condition_text_checker(condition((1, '==', 'a')), character))
+
+
+class CompileGameDataTest(SimpleTestCase):
+
+    def test_rows_of_missing_moments_are_left_out(self):
+        compiled = story(
+            scenes=[[1, 'Hall']],
+            moments=[[10, 1, 'Door']],
+            blocks=[[100, 10, 'A door.', ''], [101, 99, 'Lost.', '']],
+            actions=[[200, 10, 'Open', ''], [201, 99, 'Lost', '']],
+            effects=[[201, 1, 10, None, None]],
+        )
+        self.assertEqual(list(compiled.blocks), [100])
+        self.assertEqual(list(compiled.actions), [200])
+        self.assertEqual(compiled.moments[10].block_pks, (100, ))
+        self.assertEqual(compiled.moments[10].action_pks, (200, ))
+
+
+class CompiledCacheTest(TransactionTestCase):
+
+    def setUp(self):
+        cache.clear()
+        compiled_cache._compiled_games.clear()
+        self.game = Game.objects.create(
+            name='Test', author=User.objects.create_user('author')
+        )
+        self.scene = Scene.objects.create(game=self.game, name='Hall')
+        self.moment = Moment.objects.create(game=self.game, scene=self.scene, name='Door')
+        patcher = mock.patch.object(
+            compiled_cache, 'build_compiled_game', wraps=build_compiled_game
+        )
+        self.build = patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def get(self):
+        return compiled_cache.get_compiled_game(Game.objects.get(pk=self.game.pk))
+
+    def test_game_is_compiled_once_per_content_version(self):
+        first = self.get()
+        self.assertIs(self.get(), first)
+        self.assertEqual(self.build.call_count, 1)
+
+    def test_other_processes_share_the_django_cache(self):
+        first = self.get()
+        compiled_cache._compiled_games.clear()
+        self.assertEqual(self.get().moments, first.moments)
+        self.assertEqual(self.build.call_count, 1)
+
+    def test_content_edit_compiles_again(self):
+        first = self.get()
+        Block.objects.create(game=self.game, scene=self.scene, moment=self.moment, content='Hi')
+
+        second = self.get()
+        self.assertNotEqual(second.version, first.version)
+        self.assertEqual(len(second.blocks), 1)
+        self.assertEqual(self.build.call_count, 2)
+        key = invalidation.cache_key('compiled', self.game.pk, first.version)
+        self.assertIsNone(compiled_cache._compiled_games.get(key))
+
+    def test_published_version_is_cached_for_good(self):
+        version = self.game.publish()
+        first = compiled_cache.get_version_compiled(version.pk)
+        Block.objects.create(game=self.game, scene=self.scene, moment=self.moment, content='Hi')
+
+        compiled_cache._compiled_games.clear()
+        with self.assertNumQueries(0):
+            self.assertEqual(compiled_cache.get_version_compiled(version.pk).blocks, first.blocks)
+        self.assertEqual(first.blocks, {})
+
+
+class GraphTest(SimpleTestCase):
+
+    def components(self, edges):
+        return sorted(
+            tuple(sorted(component))
+            for component in graph.strongly_connected_components(StoryGraph(edges, ()))
+        )
+
+    def test_components(self):
+        edges = {1: (2, ), 2: (3, ), 3: (1, 4), 4: (4, ), 5: (4, )}
+        self.assertEqual(self.components(edges), [(1, 2, 3), (4, ), (5, )])
+
+    def test_deep_graph(self):
+        size = 10000
+        edges = {pk: (pk + 1, ) for pk in range(size)}
+        edges[size] = (0, )
+        self.assertEqual(self.components(edges), [tuple(range(size + 1))])
+
+        chain = StoryGraph({pk: (pk + 1, ) for pk in range(size)}, (0, ))
+        self.assertEqual(len(graph.reachable_from(chain, chain.start_pks)), size + 1)
+
+    def test_reachable_from(self):
+        edges = StoryGraph({1: (2, ), 2: (), 3: (1, )}, (1, ))
+        self.assertEqual(graph.reachable_from(edges, edges.start_pks), {1, 2})
+        self.assertEqual(graph.reachable_from(edges, (3, )), {1, 2, 3})
+
+    def test_analyze(self):
+        compiled = story(
+            characters=[[1, 'Hero', 10]],
+            scenes=[[10, 'Hall'], [20, 'Yard'], [30, 'Attic']],
+            moments=[
+                [100, 10, 'Door'], [101, 10, 'Corridor'],
+                [200, 20, 'Gate'], [300, 30, 'Dust'],
+            ],
+            actions=[
+                [1000, 100, 'Go on', ''],
+                [1001, 101, 'Go back', ''],
+                [1002, 101, 'Go out', ''],
+            ],
+            effects=[
+                [1000, None, 101, None, ''],
+                [1001, None, 100, None, ''],
+                [1002, 20, None, None, ''],
+            ],
+        )
+        report = graph.analyze(None, compiled)
+
+        self.assertEqual(report.reachable, frozenset((100, 101, 200)))
+        self.assertEqual(report.unreachable_moments, (300, ))
+        self.assertEqual(report.unreachable_scenes, (30, ))
+        self.assertEqual(report.dead_ends, (200, 300))
+        self.assertEqual([sorted(cycle) for cycle in report.cycles], [[100, 101]])
+        self.assertFalse(report.is_ok)
+
+
+class MayHoldTest(SimpleTestCase):
+
+    def test_clause(self):
+        state = {1: frozenset(('closed', 'open'))}
+        self.assertTrue(visibility.may_hold(Clause(1, '==', 'open'), state))
+        self.assertFalse(visibility.may_hold(Clause(1, '==', 'broken'), state))
+        self.assertFalse(visibility.may_hold(Clause(2, '==', 'open'), state))
+
+    def test_numbers(self):
+        state = {1: frozenset(('2', '9'))}
+        self.assertFalse(visibility.may_hold(Clause(1, '>=', '10'), state))
+        self.assertTrue(visibility.may_hold(Clause(1, '<', '10'), state))
+
+    def test_combinators(self):
+        state = {1: frozenset(('a', )), 2: frozenset(('b', ))}
+        yes, no = Clause(1, '==', 'a'), Clause(2, '==', 'a')
+        self.assertTrue(visibility.may_hold(AnyOf([no, yes]), state))
+        self.assertFalse(visibility.may_hold(AllOf([no, yes]), state))
+        self.assertTrue(visibility.may_hold(ALWAYS, state))
+        self.assertFalse(visibility.may_hold(NEVER, state))
+
+
+class JoinTest(SimpleTestCase):
+
+    def test_join_adds_values(self):
+        target = {1: frozenset(('a', )), 2: frozenset(('x', ))}
+        changed = visibility.join(target, {1: frozenset(('b', )), 2: frozenset(('x', ))})
+
+        self.assertTrue(changed)
+        self.assertEqual(target, {1: frozenset(('a', 'b')), 2: frozenset(('x', ))})
+
+    def test_join_without_new_values(self):
+        target = {1: frozenset(('a', 'b'))}
+        self.assertFalse(visibility.join(target, {1: frozenset(('a', ))}))
+        self.assertEqual(target, {1: frozenset(('a', 'b'))})
+
+
+class PossibleStatesTest(SimpleTestCase):
+    """
+    Two characters in separate scenes. The door and the lamp are shared by
+    the session, the key belongs to the second character.
+    """
+
+    def setUp(self):
+        self.compiled = story(
+            characters=[[1, 'Guest', 10], [2, 'Keeper', 20]],
+            scenes=[[10, 'Hall'], [20, 'Yard']],
+            moments=[[100, 10, 'Door'], [200, 20, 'Gate']],
+            properties=[[1, 'closed', None], [2, 'no', 2], [3, 'off', None]],
+            blocks=[
+                [1000, 100, 'The door is open.', condition((1, '==', 'open'))],
+                [1001, 100, 'A key is here.', condition((2, '==', 'yes'))],
+                [1002, 200, 'The lamp is on.', condition((3, '==', 'on'))],
+            ],
+            actions=[
+                [2000, 200, 'Open the door', ''],
+                [2001, 100, 'Light the lamp', condition((1, '==', 'open'))],
+            ],
+            effects=[
+                [2000, None, None, 1, 'open'],
+                [2000, None, None, 2, 'yes'],
+                [2001, None, None, 3, 'on'],
+            ],
+        )
+
+    def states(self):
+        return visibility.possible_states(
+            self.compiled, build_graph(None, self.compiled)
+        )
+
+    def test_shared_values_written_elsewhere_are_possible(self):
+        states = self.states()
+
+        self.assertEqual(states[100][1], frozenset(('closed', 'open')))
+        # the lamp is lit only after the door has been opened by another
+        # character, it takes one more round of the fixpoint
+        self.assertEqual(states[200][3], frozenset(('off', 'on')))
+
+    def test_character_values_stay_on_the_character_path(self):
+        states = self.states()
+
+        self.assertEqual(states[100][2], frozenset(('no', )))
+        self.assertEqual(states[200][2], frozenset(('no', 'yes')))
+
+    def test_analyze(self):
+        report = visibility.analyze(None, self.compiled)
+
+        self.assertEqual(report.hidden_blocks, (1001, ))
+        self.assertEqual(report.hidden_actions, ())
+        self.assertEqual(report.unreachable_moments, ())
+
+
+class InvalidateOnCommitTest(TransactionTestCase):
+
+    def setUp(self):
+        self.game = Game.objects.create(
+            name='Test', author=User.objects.create_user('author')
+        )
+        self.invalidated = []
+        patcher = mock.patch.object(
+            invalidation, '_listeners', [self.invalidated.append]
+        )
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def version(self):
+        return Game.objects.get(pk=self.game.pk).updated_at
+
+    def test_game_is_invalidated_once_on_commit(self):
+        before = self.version()
+        with transaction.atomic():
+            scene = Scene.objects.create(game=self.game, name='Hall')
+            moment = Moment.objects.create(game=self.game, scene=scene, name='Door')
+            key = Property.objects.create(game=self.game, name='key', value='0')
+            action = Action.objects.create(
+                game=self.game, scene=scene, moment=moment, content='Take'
+            )
+            AfterEffect.objects.create(
+                action_id=action.pk, set_property=key, set_property_value='1'
+            )
+            self.assertEqual(self.invalidated, [])
+            self.assertEqual(self.version(), before)
+
+        self.assertEqual(self.invalidated, [self.game.pk])
+        self.assertGreater(self.version(), before)
+
+    def test_rolled_back_changes_do_not_invalidate(self):
+        with transaction.atomic():
+            Scene.objects.create(game=self.game, name='Hall')
+            transaction.set_rollback(True)
+        self.assertEqual(self.invalidated, [])
+
+        with transaction.atomic():
+            Scene.objects.create(game=self.game, name='Yard')
+        self.assertEqual(self.invalidated, [self.game.pk])
+
+    def test_change_outside_of_a_transaction(self):
+        Scene.objects.create(game=self.game, name='Hall')
+        self.assertEqual(self.invalidated, [self.game.pk])
+
+    def test_every_story_row_invalidates_its_game(self):
+        scene = Scene.objects.create(game=self.game, name='Hall')
+        moment = Moment.objects.create(game=self.game, scene=scene, name='Door')
+        rows = [
+            Character.objects.create(game=self.game, name='Hero'),
+            Property.objects.create(game=self.game, name='key', value='0'),
+            Block.objects.create(game=self.game, scene=scene, moment=moment, content='A door.'),
+            Action.objects.create(game=self.game, scene=scene, moment=moment, content='Open'),
+            moment,
+            scene,
+        ]
+        for row in rows:
+            del self.invalidated[:]
+            before = self.version()
+            row.save()
+            self.assertEqual(self.invalidated, [self.game.pk], row)
+            self.assertGreater(self.version(), before)
+
+            del self.invalidated[:]
+            row.delete()
+            self.assertEqual(self.invalidated, [self.game.pk], row)
+
+    def test_after_effect_is_traced_to_its_game_on_commit(self):
+        scene = Scene.objects.create(game=self.game, name='Hall')
+        action = Action.objects.create(game=self.game, scene=scene, content='Open')
+        del self.invalidated[:]
+
+        with transaction.atomic():
+            AfterEffect.objects.create(action_id=action.pk, go_to_scene=scene)
+            self.assertEqual(self.invalidated, [])
+        self.assertEqual(self.invalidated, [self.game.pk])
+
+    def test_game_row_change_keeps_its_own_version(self):
+        self.game.name = 'Renamed'
+        self.game.save()
+        self.assertEqual(self.invalidated, [self.game.pk])
+        self.assertEqual(self.version(), self.game.updated_at)
+
+    def test_rolled_back_savepoint_keeps_the_outer_changes(self):
+        with transaction.atomic():
+            with transaction.atomic():
+                Scene.objects.create(game=self.game, name='Hall')
+                transaction.set_rollback(True)
+            Scene.objects.create(game=self.game, name='Yard')
+        self.assertEqual(self.invalidated, [self.game.pk])
+
+    def test_failing_listener_does_not_stop_the_others(self):
+        failing = mock.Mock(side_effect=RuntimeError)
+        with mock.patch.object(
+                invalidation, '_listeners', [failing, self.invalidated.append]):
+            invalidation.invalidate(self.game.pk)
+        failing.assert_called_once_with(self.game.pk)
+        self.assertEqual(self.invalidated, [self.game.pk])
+
+    def test_cache_keys_follow_the_content_version(self):
+        before = invalidation.content_version(Game.objects.get(pk=self.game.pk))
+        invalidation.invalidate(self.game.pk)
+        after = invalidation.content_version(Game.objects.get(pk=self.game.pk))
+        self.assertNotEqual(
+            invalidation.cache_key('compiled', self.game.pk, before),
+            invalidation.cache_key('compiled', self.game.pk, after)
+        )
+
+
+class CatalogueVersionTest(TransactionTestCase):
+
+    def setUp(self):
+        cache.clear()
+        self.game = Game.objects.create(
+            name='Test', author=User.objects.create_user('author')
+        )
+        self.scene = Scene.objects.create(game=self.game, name='Hall')
+        self.game.publish()
+        self.game = Game.objects.get(pk=self.game.pk)
+
+    def test_content_edit_keeps_the_catalogue(self):
+        before = catalogue.get_catalogue()
+        moment = Moment.objects.create(game=self.game, scene=self.scene, name='Door')
+        Block.objects.create(game=self.game, scene=self.scene, moment=moment, content='Hello')
+        self.game.save()
+        self.assertEqual(catalogue.catalogue_version(), before.version)
+        self.assertIs(catalogue.get_catalogue(), before)
+
+    def test_rename_moves_the_version(self):
+        before = catalogue.catalogue_version()
+        self.game.name = 'Renamed'
+        self.game.save()
+        self.assertNotEqual(catalogue.catalogue_version(), before)
+        self.assertEqual(catalogue.get_catalogue().entries[0].name, 'Renamed')
+
+    def test_publishing_moves_the_version(self):
+        draft = Game.objects.create(name='Draft', author=self.game.author)
+        before = catalogue.catalogue_version()
+        self.assertEqual(len(catalogue.get_catalogue()), 1)
+
+        draft.publish()
+        self.assertNotEqual(catalogue.catalogue_version(), before)
+        self.assertEqual(len(catalogue.get_catalogue()), 2)
+
+    def test_new_scene_of_a_published_game_moves_the_version(self):
+        before = catalogue.catalogue_version()
+        Scene.objects.create(game=self.game, name='Yard')
+        self.assertNotEqual(catalogue.catalogue_version(), before)
+        self.assertEqual(catalogue.get_catalogue().entries[0].scene_count, 2)
+
+    def test_rolled_back_rename_keeps_the_version(self):
+        before = catalogue.catalogue_version()
+        with transaction.atomic():
+            self.game.name = 'Renamed'
+            self.game.save()
+            transaction.set_rollback(True)
+        self.assertEqual(catalogue.catalogue_version(), before)
+
+
+class RemapConditionTest(SimpleTestCase):
+
+    def test_property_pks_are_remapped(self):
+        remapped = archive.remap_condition(condition((5, '==', 'a'), (6, '<', '3')), {5: 50, 6: 60})
+        self.assertEqual(json.loads(remapped), [[50, '==', 'a'], [60, '<', '3']])
+
+    def test_missing_property(self):
+        with self.assertRaises(archive.ArchiveError):
+            archive.remap_condition(condition((5, '==', 'a'), (7, '==', 'b')), {5: 50})
+
+    def test_broken_conditions_are_kept(self):
+        for text in ('', '{', '"12"', '[["x", "==", "a"]]', '[[]]'):
+            self.assertEqual(archive.remap_condition(text, {}), text)
+
+
+class ArchiveTest(TestCase):
+
+    def setUp(self):
+        self.author = User.objects.create_user('author')
+        self.game = Game.objects.create(name='Test', author=self.author)
+        scene = Scene.objects.create(game=self.game, name='Hall')
+        moment = Moment.objects.create(game=self.game, scene=scene, name='Door')
+        hero = Character.objects.create(game=self.game, name='Hero', start_scene=scene)
+        key = Property.objects.create(game=self.game, character=hero, name='key', value='0')
+        Block.objects.create(
+            game=self.game, scene=scene, moment=moment,
+            content='You hold a key.', condition=condition((key.pk, '==', '1'))
+        )
+        take = Action.objects.create(
+            game=self.game, scene=scene, moment=moment,
+            content='Take the key', condition=condition((key.pk, '==', '0'))
+        )
+        AfterEffect.objects.create(action=take, set_property=key, set_property_value='1')
+
+    def content(self, game):
+        """Compiled rows with pks replaced by names, comparable across games."""
+        compiled = build_compiled_game(Game.objects.get(pk=game.pk))
+        names = dict(Property.objects.filter(game=game).values_list('pk', 'name'))
+
+        def clauses(predicate):
+            return [
+                (names[clause.property_pk], clause.operator, clause.value)
+                for clause in getattr(predicate, 'predicates', ())
+            ]
+
+        return {
+            'characters': sorted(c.name for c in compiled.characters.values()),
+            'moments': sorted(m.name for m in compiled.moments.values()),
+            'blocks': [(b.content, clauses(b.predicate)) for b in compiled.blocks.values()],
+            'actions': [
+                (a.content, clauses(a.predicate),
+                 [(names[e.set_property_pk], e.set_property_value) for e in a.effects])
+                for a in compiled.actions.values()
+            ],
+        }
+
+    def test_round_trip(self):
+        lines = list(archive.export_game(self.game))
+        game, counts = archive.import_game(lines, self.author)
+
+        self.assertNotEqual(game.pk, self.game.pk)
+        self.assertEqual(game.status, Game.STATUS_DRAFT)
+        self.assertEqual(counts['aftereffect'], 1)
+        self.assertEqual(self.content(game), self.content(self.game))
+
+        key = Property.objects.get(game=game)
+        self.assertEqual(key.character.game_id, game.pk)
+        self.assertEqual(
+            json.loads(Block.objects.get(game=game).condition), [[key.pk, '==', '1']]
+        )
+
+    def test_condition_on_a_missing_property(self):
+        lines = [
+            line for line in archive.export_game(self.game)
+            if json.loads(line).get('model') not in ('property', 'aftereffect')
+        ]
+        with self.assertRaises(archive.ArchiveError):
+            archive.import_game(lines, self.author)
+        self.assertEqual(Game.objects.count(), 1)
+
+
+class VisibilityReportTest(TestCase):
+
+    def setUp(self):
+        cache.clear()
+        author = User.objects.create_user('author', password='secret')
+        self.game = Game.objects.create(name='Test', author=author)
+        scene = Scene.objects.create(game=self.game, name='Hall')
+        Moment.objects.create(game=self.game, scene=scene, name='Door')
+        self.game.refresh_from_db()
+        self.client.login(username='author', password='secret')
+
+    def test_report_is_pending_when_the_task_queue_fails(self):
+        with mock.patch('game.tasks.analyze_visibility', side_effect=ConnectionError) as task:
+            response = self.client.get(reverse('game_detail', args=(self.game.pk, )))
+
+        self.assertTrue(task.called)
+        self.assertEqual(response.status_code, 200)
+        self.assertContains(response, 'conditions are being analyzed')
+
+    def test_stored_report(self):
+        visibility.store_report(self.game)
+        with mock.patch('game.tasks.analyze_visibility') as task:
+            report = visibility.get_report(self.game)
+
+        self.assertFalse(task.called)
+        self.assertEqual(report.hidden_blocks, ())
@@ -24,6 +24,14 @@ urlpatterns = [
         'g<int:game_pk>/delete/',
         game.GameDeleteView.as_view(), name="game_delete"
     ),
+    path(
+        'g<int:game_pk>/export/',
+        game.GameExportView.as_view(), name="game_export"
+    ),
+    path(
+        'g<int:game_pk>/publish/',
+        game.GamePublishView.as_view(), name="game_publish"
+    ),
 
     # Character
     path(
@@ -1,46 +1,23 @@
-import json
-from game.models import Property
+import logging
+
+from game.conditions import AllOf, ConditionError, NEVER, compile_condition
+from gamebook.lru import LRUCache
+
+
+logger = logging.getLogger(__name__)
+
+
+_compiled_texts = LRUCache(maxsize=1024)
 
 
 def condition_text_checker(condition_text, session_character):
-    condition_dict = json.loads(condition_text)
-    for condition in condition_dict:
-        property_pk, condition_type, condition_value = condition
+    predicate = _compiled_texts.get(condition_text)
+    if predicate is None:
         try:
-            property = Property.objects.get(pk=property_pk)
-            session_value = property.get_session_value(session_character)
-        except Property.DoesNotExist:
-            return False
-
-        if condition_type == "==":
-            if session_value == condition_value:
-                continue
-            else:
-                return False
-        elif condition_type == ">=":
-            if session_value >= condition_value:
-                continue
-            else:
-                return False
-        elif condition_type == ">":
-            if session_value > condition_value:
-                continue
-            else:
-                return False
-        elif condition_type == "<=":
-            if session_value <= condition_value:
-                continue
-            else:
-                return False
-        elif condition_type == "<":
-            if session_value < condition_value:
-                continue
-            else:
-                return False
-        elif condition_type == "!=":
-            if session_value != condition_value:
-                continue
-            else:
-                return False
-
-    return True
\ No newline at end of file
+            predicate = compile_condition(condition_text, AllOf)
+        except ConditionError as e:
+            logger.error("Broken condition %r: %s" % (condition_text, e))
+            predicate = NEVER
+        _compiled_texts.set(condition_text, predicate)
+
+    return predicate(session_character.get_property_values())
@@ -18,7 +18,6 @@ class ActionCreateView(LoginRequiredMixin, base.CreateWithMomentView):
         self.object = form.save(commit=False)
         self.object.game = self.game
         self.object.scene = self.scene
-        self.object.block = self.block
         self.object.moment = self.moment
         self.object.save()
         return super().form_valid(form)
@@ -12,11 +12,25 @@ class IndexView(TemplateView):
 
 
 class GameMixin(ContextMixin):
+    """
+    Views below a game in the url, e.g. /g1/s2/m3/b4/.
+
+    The whole url path is loaded with one query on dispatch: for views of
+    an object (`pk_url_kwarg` in the url) the object itself with its game,
+    scene and moment joined, otherwise the deepest level of the path with
+    its parents. Everything is scoped by the game author.
+    """
     game_pk_url_kwarg = 'game_pk'
     game = None
+    # Levels of the url path, in order, each with a `<level>_pk_url_kwarg`
+    path_levels = ('game', )
+    path_models = {'game': Game, 'scene': Scene, 'moment': Moment}
+    # prefetch_related lookups for the object of the view
+    path_prefetch = ()
+    path_object = None
 
     def dispatch(self, request, *args, **kwargs):
-        self.game = self.get_game()
+        self.resolve_path()
         return super().dispatch(request, *args, **kwargs)
 
     def get_context_data(self, **kwargs):
@@ -26,22 +40,51 @@ class GameMixin(ContextMixin):
         context.update(kwargs)
         return super().get_context_data(**context)
 
-    def get_game(self):
-        if not self.game:
-            queryset = Game.objects.filter(author=self.request.user)
-
-            pk = self.kwargs.get(self.game_pk_url_kwarg, None)
-            queryset = queryset.filter(pk=pk)
-
-            try:
-                # Get the single item from the filtered queryset
-                self.game = queryset.get()
-            except queryset.model.DoesNotExist:
-                raise Http404(
-                    _("No %(verbose_name)s found matching the query") %
-                    {'verbose_name': queryset.model._meta.verbose_name}
-                )
+    def _path_pk(self, level):
+        return self.kwargs.get(getattr(self, '%s_pk_url_kwarg' % level), None)
+
+    def _get_or_404(self, queryset):
+        try:
+            return queryset.get()
+        except queryset.model.DoesNotExist:
+            raise Http404(
+                _("No %(verbose_name)s found matching the query") %
+                {'verbose_name': queryset.model._meta.verbose_name}
+            )
+
+    def resolve_path(self):
+        pk_url_kwarg = getattr(self, 'pk_url_kwarg', None)
+        last = self.path_levels[-1]
+
+        if pk_url_kwarg in self.kwargs and pk_url_kwarg != getattr(self, '%s_pk_url_kwarg' % last):
+            queryset = self.model._default_manager.select_related(*self.path_levels) \
+                .prefetch_related(*self.path_prefetch) \
+                .filter(game__author=self.request.user, pk=self.kwargs[pk_url_kwarg])
+            parents = self.path_levels
+            self.path_object = obj = self._get_or_404(queryset.filter(**{
+                '%s_id' % level: self._path_pk(level) for level in parents
+            }))
+        else:
+            parents = self.path_levels[:-1]
+            queryset = self.path_models[last].objects.select_related(*parents).filter(**{
+                '%s_id' % level: self._path_pk(level) for level in parents
+            })
+            if last == 'game':
+                queryset = queryset.filter(author=self.request.user)
+            else:
+                queryset = queryset.filter(game__author=self.request.user)
+            obj = self._get_or_404(queryset.filter(pk=self._path_pk(last)))
+            setattr(self, last, obj)
+
+        for level in parents:
+            setattr(self, level, getattr(obj, level))
+
+    def get_object(self, queryset=None):
+        if queryset is None and self.path_object is not None:
+            return self.path_object
+        return super().get_object(queryset)
 
+    def get_game(self):
         return self.game
 
 
@@ -65,10 +108,7 @@ class UpdateWithGameView(GameMixin, UpdateView):
 class SceneMixin(GameMixin):
     scene_pk_url_kwarg = 'scene_pk'
     scene = None
-
-    def dispatch(self, request, *args, **kwargs):
-        self.scene = self.get_scene()
-        return super().dispatch(request, *args, **kwargs)
+    path_levels = ('game', 'scene')
 
     def get_context_data(self, **kwargs):
         context = {
@@ -78,19 +118,6 @@ class SceneMixin(GameMixin):
         return super().get_context_data(**context)
 
     def get_scene(self):
-        if not self.scene:
-            queryset = Scene.objects.filter(game=self.get_game())
-
-            pk = self.kwargs.get(self.scene_pk_url_kwarg, None)
-            queryset = queryset.filter(pk=pk)
-
-            try:
-                self.scene = queryset.get()
-            except queryset.model.DoesNotExist:
-                raise Http404(
-                    _("No %(verbose_name)s found matching the query") %
-                    {'verbose_name': queryset.model._meta.verbose_name}
-                )
         return self.scene
 
 
@@ -114,10 +141,7 @@ class UpdateWithSceneView(SceneMixin, UpdateView):
 class MomentMixin(SceneMixin):
     moment_pk_url_kwarg = 'moment_pk'
     moment = None
-
-    def dispatch(self, request, *args, **kwargs):
-        self.moment = self.get_moment()
-        return super().dispatch(request, *args, **kwargs)
+    path_levels = ('game', 'scene', 'moment')
 
     def get_context_data(self, **kwargs):
         context = {
@@ -127,20 +151,7 @@ class MomentMixin(SceneMixin):
         return super().get_context_data(**context)
 
     def get_moment(self):
-        if not self.moment:
-            queryset = Moment.objects.filter(game=self.get_game(), scene=self.get_scene())
-
-            pk = self.kwargs.get(self.moment_pk_url_kwarg, None)
-            queryset = queryset.filter(pk=pk)
-
-            try:
-                self.block = queryset.get()
-            except queryset.model.DoesNotExist:
-                raise Http404(
-                    _("No %(verbose_name)s found matching the query") %
-                    {'verbose_name': queryset.model._meta.verbose_name}
-                )
-        return self.block
+        return self.moment
 
 
 class DetailWithMomentView(MomentMixin, DetailView):
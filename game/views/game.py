@@ -1,8 +1,15 @@
+from django.http import StreamingHttpResponse
+from django.shortcuts import redirect
 from django.urls import reverse
 from django.contrib.auth.mixins import LoginRequiredMixin
+from django.views import View
 from django.views.generic.list import ListView
-from django.views.generic.detail import DetailView
+from django.views.generic.detail import DetailView, SingleObjectMixin
 from django.views.generic.edit import CreateView, UpdateView, DeleteView
+from game.archive import export_game
+from game.compiled import get_compiled_game
+from game.graph import get_report
+from game import visibility
 from game.models import Game
 
 
@@ -15,7 +22,44 @@ class GameListView(LoginRequiredMixin, ListView):
         return queryset.filter(author=self.request.user)
 
 
-class GameDetailView(LoginRequiredMixin, DetailView):
+class StoryAnalysisMixin(object):
+    """
+    Story graph and visibility reports of the game in the context. The
+    analysis is for the author's editor pages only, players never pay for it.
+    """
+
+    def get_queryset(self):
+        return super().get_queryset().filter(author=self.request.user)
+
+    def get_context_data(self, **kwargs):
+        compiled = get_compiled_game(self.object)
+        report = get_report(self.object)
+        context = {
+            'story_graph': report,
+            'unreachable_moments': [compiled.moments[pk] for pk in report.unreachable_moments],
+            'dead_end_moments': [compiled.moments[pk] for pk in report.dead_ends],
+            'cycle_moments': [
+                [compiled.moments[pk] for pk in cycle] for cycle in report.cycles
+            ],
+        }
+        visibility_report = visibility.get_report(self.object)
+        if visibility_report is not None:
+            context.update({
+                'visibility': visibility_report,
+                'hidden_blocks': [
+                    (compiled.blocks[pk], compiled.moments[compiled.blocks[pk].moment_pk])
+                    for pk in visibility_report.hidden_blocks
+                ],
+                'hidden_actions': [
+                    (compiled.actions[pk], compiled.moments[compiled.actions[pk].moment_pk])
+                    for pk in visibility_report.hidden_actions
+                ],
+            })
+        context.update(kwargs)
+        return super().get_context_data(**context)
+
+
+class GameDetailView(LoginRequiredMixin, StoryAnalysisMixin, DetailView):
     template_name = 'game/detail.html'
     model = Game
     pk_url_kwarg = 'game_pk'
@@ -48,3 +92,34 @@ class GameDeleteView(LoginRequiredMixin, DeleteView):
 
     def get_success_url(self):
         return reverse('game_list')
+
+
+class GameExportView(LoginRequiredMixin, DetailView):
+    """Game archive, see game.archive."""
+    model = Game
+    pk_url_kwarg = 'game_pk'
+
+    def get_queryset(self):
+        return super().get_queryset().filter(author=self.request.user)
+
+    def render_to_response(self, context, **response_kwargs):
+        response = StreamingHttpResponse(
+            export_game(self.object),
+            content_type='application/x-ndjson; charset=utf-8'
+        )
+        response['Content-Disposition'] = 'attachment; filename="game-%s.ndjson"' % self.object.pk
+        return response
+
+
+class GamePublishView(LoginRequiredMixin, SingleObjectMixin, View):
+    """Publish the draft as a new version, see Game.publish."""
+    model = Game
+    pk_url_kwarg = 'game_pk'
+
+    def get_queryset(self):
+        return super().get_queryset().filter(author=self.request.user)
+
+    def post(self, request, *args, **kwargs):
+        self.object = self.get_object()
+        self.object.publish()
+        return redirect(self.object.get_absolute_url())
@@ -7,6 +7,7 @@ class MomentDetailView(LoginRequiredMixin, base.DetailWithSceneView):
     template_name = 'game/moment/detail.html'
     model = Moment
     pk_url_kwarg = 'moment_pk'
+    path_prefetch = ('blocks', 'actions')
 
 
 class MomentCreateView(LoginRequiredMixin, base.CreateWithSceneView):
@@ -0,0 +1,207 @@
+"""
+Static visibility analysis of blocks and actions.
+
+Property values a character can have in each moment are over-approximated
+by walking the story graph: play starts with the property defaults, a
+visible action moves the character to its target moment (or leaves it in
+place) with the values its after effects set, and the value sets of every
+path into a moment are joined. The set of values is finite (defaults and
+values written by after effects), so the walk always ends.
+
+A block or action whose condition holds for no combination of the
+possible values is never visible. Properties shared by the whole session
+can be changed by any character at any time, so values written to them
+anywhere are possible everywhere (see `possible_states`).
+
+The analysis is not cheap for big games, it runs in the
+`game.tasks.analyze_visibility` task and the result is cached per game
+content version.
+"""
+import logging
+from collections import deque
+
+from django.conf import settings
+from django.core.cache import cache
+
+from game.compiled import get_compiled_game
+from game.conditions import Always, AllOf, AnyOf, Clause, compare
+from game.graph import action_target, build_graph
+from game.invalidation import cache_key, content_version
+
+
+logger = logging.getLogger(__name__)
+
+
+class VisibilityReport(object):
+    __slots__ = (
+        'version', 'unreachable_moments', 'hidden_blocks', 'hidden_actions',
+    )
+
+    def __init__(self, version, unreachable_moments, hidden_blocks, hidden_actions):
+        self.version = version
+        self.unreachable_moments = unreachable_moments
+        self.hidden_blocks = hidden_blocks
+        self.hidden_actions = hidden_actions
+
+
+def may_hold(predicate, state):
+    """True unless `predicate` is false for every combination of values in `state`."""
+    if isinstance(predicate, Clause):
+        return any(
+            compare(predicate.operator, value, predicate.value)
+            for value in state.get(predicate.property_pk, ())
+        )
+    if isinstance(predicate, AnyOf):
+        return any(may_hold(p, state) for p in predicate.predicates)
+    if isinstance(predicate, AllOf):
+        return all(may_hold(p, state) for p in predicate.predicates)
+    # Always holds, Never (a subclass of Always) does not
+    return type(predicate) is Always
+
+
+def apply_effects(state, action, shared=None):
+    """
+    State after the action's after effects. `shared` holds values other
+    characters may write to shared properties at any time, they stay
+    possible whatever this action sets.
+    """
+    result = None
+    for effect in action.effects:
+        property_pk = effect.set_property_pk
+        if property_pk and property_pk in state:
+            if result is None:
+                result = dict(state)
+            values = frozenset((effect.set_property_value, ))
+            if shared and property_pk in shared:
+                values |= shared[property_pk]
+            result[property_pk] = values
+    return state if result is None else result
+
+
+def join(target, state):
+    """Add values of `state` to `target` in place, True if anything was added."""
+    changed = False
+    for property_pk, values in state.items():
+        current = target[property_pk]
+        if not values <= current:
+            target[property_pk] = current | values
+            changed = True
+    return changed
+
+
+def walk(compiled, graph, shared):
+    """
+    States of reachable moments of one character path, with `shared`
+    values added to shared properties everywhere. Also returns the values
+    visible actions write to shared properties.
+    """
+    initial = {}
+    for pk, prop in compiled.properties.items():
+        initial[pk] = frozenset((prop.value, )) | shared.get(pk, frozenset())
+    states = {pk: dict(initial) for pk in graph.start_pks}
+    writes = {pk: set() for pk in shared}
+    work = deque(graph.start_pks)
+    queued = set(work)
+
+    while work:
+        moment_pk = work.popleft()
+        queued.discard(moment_pk)
+        state = states[moment_pk]
+
+        for action_pk in compiled.moments[moment_pk].action_pks:
+            action = compiled.actions[action_pk]
+            if not may_hold(action.predicate, state):
+                continue
+
+            for effect in action.effects:
+                if effect.set_property_pk in writes:
+                    writes[effect.set_property_pk].add(effect.set_property_value)
+
+            target_pk = action_target(compiled, action) or moment_pk
+            if target_pk not in compiled.moments:
+                continue
+            after = apply_effects(state, action, shared)
+
+            if target_pk not in states:
+                states[target_pk] = dict(after)
+                changed = True
+            else:
+                changed = join(states[target_pk], after)
+            if changed and target_pk not in queued:
+                work.append(target_pk)
+                queued.add(target_pk)
+
+    return states, writes
+
+
+def possible_states(compiled, graph):
+    """
+    {moment_pk: {property_pk: frozenset of values}} for reachable moments.
+
+    Properties without a character are shared by the session: any
+    character may change them while another one stays in a moment. Values
+    written to them by every reachable visible action are added to every
+    moment and the walk is repeated until no new value shows up.
+    """
+    shared = {
+        pk: frozenset() for pk, prop in compiled.properties.items()
+        if not prop.character_pk
+    }
+    while True:
+        states, writes = walk(compiled, graph, shared)
+        if all(values <= shared[pk] for pk, values in writes.items()):
+            return states
+        shared = {pk: shared[pk] | writes[pk] for pk in shared}
+
+
+def analyze(game, compiled=None):
+    if compiled is None:
+        compiled = get_compiled_game(game)
+    states = possible_states(compiled, build_graph(game, compiled))
+
+    def hidden(records):
+        return tuple(
+            record.pk for record in records.values()
+            if record.moment_pk not in states or
+            not may_hold(record.predicate, states[record.moment_pk])
+        )
+
+    return VisibilityReport(
+        version=compiled.version,
+        unreachable_moments=tuple(pk for pk in compiled.moments if pk not in states),
+        hidden_blocks=hidden(compiled.blocks),
+        hidden_actions=hidden(compiled.actions),
+    )
+
+
+def report_key(game):
+    return cache_key('visibility', game.pk, content_version(game))
+
+
+def store_report(game):
+    report = analyze(game)
+    cache.set(
+        cache_key('visibility', game.pk, report.version), report,
+        getattr(settings, 'GAME_VISIBILITY_CACHE_TIMEOUT', 60 * 60 * 24 * 7)
+    )
+    return report
+
+
+def get_report(game):
+    """
+    Cached report of the current game version. If there is none yet the
+    analysis task is queued and None is returned. A task queue that is
+    down or not configured leaves the report pending, it is queued again
+    after the marker expires.
+    """
+    key = report_key(game)
+    report = cache.get(key)
+    if report is None and cache.add(key + '-queued', 1, 60 * 10):
+        from game.tasks import analyze_visibility
+
+        logger.debug("Queue visibility analysis of game %s" % game)
+        try:
+            analyze_visibility(game.pk)
+        except Exception:
+            logger.exception("Visibility analysis of game %s not queued" % game.pk)
+    return report
@@ -0,0 +1,230 @@
+"""
+Request metrics.
+
+`measure(name)` records database queries, database time, cache hits and
+misses and wall time of a block of code. `MetricsMiddleware` measures
+every request, logs one line per request, warns about requests above
+METRICS_SLOW_QUERIES queries or METRICS_SLOW_MS milliseconds and keeps
+per-view totals of this process, exposed by `metrics_view` in the
+Prometheus text format to staff and to METRICS_ALLOWED_IPS.
+
+Caches report their hits and misses with `cache_hit(name)` and
+`cache_miss(name)`. Apps add their own metrics to `metrics_view` with
+the `collector` decorator.
+"""
+import logging
+import threading
+import time
+from collections import Counter, defaultdict
+from contextlib import contextmanager
+
+from django.conf import settings
+from django.db import connection
+from django.http import Http404, HttpResponse
+
+
+logger = logging.getLogger(__name__)
+
+
+_local = threading.local()
+
+
+class Measurement(object):
+    __slots__ = ('name', 'queries', 'db_time', 'cache_hits', 'cache_misses', 'wall_time')
+
+    def __init__(self, name):
+        self.name = name
+        self.queries = 0
+        self.db_time = 0.0
+        self.cache_hits = 0
+        self.cache_misses = 0
+        self.wall_time = 0.0
+
+    def __str__(self):
+        return (
+            "name=%s queries=%d db_ms=%.1f cache_hits=%d cache_misses=%d wall_ms=%.1f" % (
+                self.name, self.queries, self.db_time * 1000,
+                self.cache_hits, self.cache_misses, self.wall_time * 1000
+            )
+        )
+
+    def as_dict(self):
+        return {key: getattr(self, key) for key in self.__slots__}
+
+
+def _active():
+    stack = getattr(_local, 'stack', None)
+    if stack is None:
+        stack = _local.stack = []
+    return stack
+
+
+def _execute_wrapper(execute, sql, params, many, context):
+    started = time.perf_counter()
+    try:
+        return execute(sql, params, many, context)
+    finally:
+        elapsed = time.perf_counter() - started
+        for measurement in _active():
+            measurement.queries += 1
+            measurement.db_time += elapsed
+
+
+def cache_hit(name=None):
+    for measurement in _active():
+        measurement.cache_hits += 1
+
+
+def cache_miss(name=None):
+    for measurement in _active():
+        measurement.cache_misses += 1
+
+
+@contextmanager
+def measure(name):
+    """
+    with measure('something') as m:
+        ...
+    print(m.queries, m.db_time, m.wall_time)
+    """
+    measurement = Measurement(name)
+    stack = _active()
+    stack.append(measurement)
+    started = time.perf_counter()
+    try:
+        if len(stack) == 1:
+            with connection.execute_wrapper(_execute_wrapper):
+                yield measurement
+        else:
+            yield measurement
+    finally:
+        measurement.wall_time = time.perf_counter() - started
+        stack.remove(measurement)
+
+
+_totals = defaultdict(Counter)
+_totals_lock = threading.Lock()
+
+
+def record(measurement, status=None):
+    with _totals_lock:
+        totals = _totals[measurement.name]
+        totals['requests'] += 1
+        totals['queries'] += measurement.queries
+        totals['db_seconds'] += measurement.db_time
+        totals['cache_hits'] += measurement.cache_hits
+        totals['cache_misses'] += measurement.cache_misses
+        totals['seconds'] += measurement.wall_time
+        if status is not None and status >= 500:
+            totals['errors'] += 1
+        if is_slow(measurement):
+            totals['slow'] += 1
+
+
+def get_totals():
+    with _totals_lock:
+        return {name: dict(totals) for name, totals in _totals.items()}
+
+
+def is_slow(measurement):
+    return (
+        measurement.queries > getattr(settings, 'METRICS_SLOW_QUERIES', 50) or
+        measurement.wall_time * 1000 > getattr(settings, 'METRICS_SLOW_MS', 500)
+    )
+
+
+class MetricsMiddleware(object):
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+
+    def __call__(self, request):
+        with measure(None) as measurement:
+            response = self.get_response(request)
+
+        match = getattr(request, 'resolver_match', None)
+        measurement.name = match.view_name if match else 'unresolved'
+        record(measurement, response.status_code)
+
+        if is_slow(measurement):
+            logger.warning("slow request path=%s status=%s %s" % (
+                request.path, response.status_code, measurement
+            ))
+        else:
+            logger.info("request path=%s status=%s %s" % (
+                request.path, response.status_code, measurement
+            ))
+        return response
+
+
+METRICS = (
+    ('requests', 'gamebook_requests_total', "Handled requests"),
+    ('errors', 'gamebook_request_errors_total', "Requests answered with 5xx"),
+    ('slow', 'gamebook_slow_requests_total', "Requests above the slow thresholds"),
+    ('queries', 'gamebook_db_queries_total', "Database queries"),
+    ('db_seconds', 'gamebook_db_seconds_total', "Time spent in the database"),
+    ('cache_hits', 'gamebook_cache_hits_total', "Cache hits"),
+    ('cache_misses', 'gamebook_cache_misses_total', "Cache misses"),
+    ('seconds', 'gamebook_request_seconds_total', "Wall time of requests"),
+)
+
+
+_collectors = []
+
+
+def collector(func):
+    """
+    Register `func() -> [(metric, type, help text, [({label: value}, number)])]`,
+    called by `metrics_view` on every scrape. Can be used as a decorator.
+    """
+    _collectors.append(func)
+    return func
+
+
+def _labels(labels):
+    return ",".join(
+        '%s="%s"' % (name, labels[name]) for name in sorted(labels)
+    )
+
+
+def client_ip(request):
+    """
+    Address of the client. Behind caddy REMOTE_ADDR is the proxy, the
+    client address comes in METRICS_CLIENT_IP_HEADER, which caddy always
+    overwrites. Requests that bypass the proxy fall back to REMOTE_ADDR.
+    """
+    header = getattr(settings, 'METRICS_CLIENT_IP_HEADER', 'HTTP_X_REAL_IP')
+    ip = request.META.get(header) if header else None
+    if ip:
+        return ip.split(',')[0].strip()
+    return request.META.get('REMOTE_ADDR')
+
+
+def metrics_view(request):
+    """Totals of this process in the Prometheus text format."""
+    if not (request.user.is_staff or
+            client_ip(request) in getattr(settings, 'METRICS_ALLOWED_IPS', ['127.0.0.1'])):
+        raise Http404
+
+    totals = get_totals()
+    lines = []
+    for key, metric, help_text in METRICS:
+        lines.append("# HELP %s %s" % (metric, help_text))
+        lines.append("# TYPE %s counter" % metric)
+        for view_name in sorted(totals):
+            lines.append('%s{view="%s"} %s' % (
+                metric, view_name, totals[view_name].get(key, 0)
+            ))
+
+    for func in _collectors:
+        try:
+            collected = func()
+        except Exception:
+            logger.exception("Metrics collector %s failed" % func)
+            continue
+        for metric, metric_type, help_text, samples in collected:
+            lines.append("# HELP %s %s" % (metric, help_text))
+            lines.append("# TYPE %s %s" % (metric, metric_type))
+            for labels, value in samples:
+                lines.append('%s{%s} %s' % (metric, _labels(labels), value))
+    return HttpResponse("\n".join(lines) + "\n", content_type='text/plain; version=0.0.4')
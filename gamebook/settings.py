@@ -62,6 +62,7 @@ INSTALLED_APPS = [
 SITE_ID = 1
 
 MIDDLEWARE = [
+    'gamebook.metrics.MetricsMiddleware',
     'debug_toolbar.middleware.DebugToolbarMiddleware',
     'django.middleware.security.SecurityMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
@@ -232,6 +233,12 @@ LOGGING = {
             'handlers': ['console'],
             'propagate': False,
         },
+        # one line per request, see gamebook.metrics
+        'gamebook.metrics': {
+            'level': 'INFO',
+            'handlers': ['console', 'sentry'],
+            'propagate': False,
+        },
     },
 }
 
@@ -0,0 +1,112 @@
+from collections import Counter, defaultdict
+from unittest import mock
+
+from django.contrib.auth.models import User
+from django.core.cache import cache
+from django.test import RequestFactory, TestCase, override_settings
+from django.urls import reverse
+
+from gamebook import metrics
+
+
+class MeasureTest(TestCase):
+
+    def test_queries_and_cache_are_counted(self):
+        with metrics.measure('outer') as outer:
+            User.objects.count()
+            with metrics.measure('inner') as inner:
+                User.objects.count()
+                metrics.cache_hit('test')
+            metrics.cache_miss('test')
+
+        self.assertEqual((outer.queries, outer.cache_hits, outer.cache_misses), (2, 1, 1))
+        self.assertEqual((inner.queries, inner.cache_hits, inner.cache_misses), (1, 1, 0))
+        self.assertGreater(outer.wall_time, 0)
+
+    def test_nothing_is_counted_outside_of_a_measurement(self):
+        with metrics.measure('done') as measurement:
+            pass
+        User.objects.count()
+        metrics.cache_hit('test')
+        self.assertEqual((measurement.queries, measurement.cache_hits), (0, 0))
+
+
+class MetricsMiddlewareTest(TestCase):
+
+    def setUp(self):
+        cache.clear()
+        patcher = mock.patch.object(metrics, '_totals', defaultdict(Counter))
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_requests_are_counted_per_view(self):
+        with self.assertLogs('gamebook.metrics', 'INFO') as logs:
+            self.client.get(reverse('game_catalogue'))
+            self.client.get(reverse('game_catalogue'))
+
+        totals = metrics.get_totals()['game_catalogue']
+        self.assertEqual(totals['requests'], 2)
+        self.assertGreater(totals['queries'], 0)
+        self.assertNotIn('slow', totals)
+        self.assertIn('name=game_catalogue queries=', logs.output[0])
+
+    @override_settings(METRICS_SLOW_QUERIES=0)
+    def test_slow_requests_are_flagged(self):
+        with self.assertLogs('gamebook.metrics', 'WARNING') as logs:
+            self.client.get(reverse('game_catalogue'))
+
+        self.assertEqual(metrics.get_totals()['game_catalogue']['slow'], 1)
+        self.assertIn('slow request path=/', logs.output[0])
+
+    def test_unresolved_requests(self):
+        with self.assertLogs('gamebook.metrics', 'INFO'):
+            self.client.get('/no-such-page/')
+        self.assertEqual(metrics.get_totals()['unresolved']['requests'], 1)
+
+
+class MetricsViewTest(TestCase):
+
+    def setUp(self):
+        patcher = mock.patch.object(metrics, '_totals', defaultdict(Counter))
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.totals = Counter(requests=3, queries=7)
+        metrics._totals['game_catalogue'] = self.totals
+
+    def test_totals_in_the_prometheus_format(self):
+        with self.assertLogs('gamebook.metrics', 'INFO'):
+            response = self.client.get(reverse('metrics'))
+
+        self.assertEqual(response.status_code, 200)
+        self.assertContains(response, '# TYPE gamebook_requests_total counter')
+        self.assertContains(response, 'gamebook_requests_total{view="game_catalogue"} 3')
+        self.assertContains(response, 'gamebook_db_queries_total{view="game_catalogue"} 7')
+
+    def test_failing_collector_is_skipped(self):
+        collectors = [
+            mock.Mock(side_effect=RuntimeError),
+            lambda: [('test_total', 'counter', "Test", [({'a': 'b'}, 1)])],
+        ]
+        with mock.patch.object(metrics, '_collectors', collectors), \
+                self.assertLogs('gamebook.metrics', 'INFO'):
+            response = self.client.get(reverse('metrics'))
+        self.assertContains(response, 'test_total{a="b"} 1')
+
+    @override_settings(METRICS_ALLOWED_IPS=['10.0.0.1'])
+    def test_access(self):
+        with self.assertLogs('gamebook.metrics', 'INFO'):
+            self.assertEqual(self.client.get(reverse('metrics')).status_code, 404)
+            response = self.client.get(reverse('metrics'), HTTP_X_REAL_IP='10.0.0.1')
+            self.assertEqual(response.status_code, 200)
+
+            User.objects.create_user('staff', password='secret', is_staff=True)
+            self.client.login(username='staff', password='secret')
+            self.assertEqual(self.client.get(reverse('metrics')).status_code, 200)
+
+    def test_client_ip(self):
+        factory = RequestFactory()
+        self.assertEqual(metrics.client_ip(factory.get('/')), '127.0.0.1')
+        self.assertEqual(
+            metrics.client_ip(factory.get('/', HTTP_X_REAL_IP='10.0.0.1, 10.0.0.2')),
+            '10.0.0.1'
+        )
@@ -17,6 +17,7 @@ from django.contrib import admin
 from django.urls import path, include
 from django.conf import settings
 from game.views.base import IndexView
+from gamebook.metrics import metrics_view
 
 urlpatterns = [
 #    path('telegrambot/', include('telegrambot.urls')),
@@ -27,6 +28,7 @@ urlpatterns = [
     path('play/', include('play.urls')),
 
     path('admin/', admin.site.urls),
+    path('metrics/', metrics_view, name='metrics'),
 
     path('', IndexView.as_view()),
 ]
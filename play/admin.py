@@ -1,5 +1,5 @@
 from django.contrib import admin
-from play.models import Gamelog, SessionCharacter, Session
+from play.models import Gamelog, GamelogSegment, SessionCharacter, Session
 
 
 @admin.register(Gamelog)
@@ -7,11 +7,26 @@ class GamelogAdmin(admin.ModelAdmin):
     list_display = ('source', 'created_at', 'text', )
 
 
+@admin.register(GamelogSegment)
+class GamelogSegmentAdmin(admin.ModelAdmin):
+    list_display = ('session', 'count', 'first_created_at', 'last_created_at')
+    exclude = ('data', )
+
+
 @admin.register(Session)
 class SessionAdmin(admin.ModelAdmin):
-    list_display = ('game', 'status', 'user', 'active_character')
+    list_display = ('game', 'game_version', 'status', 'user', 'active_character')
 
 
 @admin.register(SessionCharacter)
 class SessionCharacterAdmin(admin.ModelAdmin):
-    list_display = ('session', 'character', 'current_scene', 'created_at')
+    list_display = ('session', 'character_name', 'scene_pk', 'moment_pk', 'created_at')
+
+    def character_name(self, obj):
+        return obj.name
+
+    def scene_pk(self, obj):
+        return obj.current_scene_id
+
+    def moment_pk(self, obj):
+        return obj.current_moment_id
@@ -0,0 +1,36 @@
+from datetime import timedelta
+
+from django.core.management.base import BaseCommand
+from django.utils import timezone
+
+from play.models import Session
+
+
+class Command(BaseCommand):
+    help = "Roll game logs of finished sessions into compressed segments"
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--days', type=int, default=7,
+            help="Archive sessions finished at least this many days ago"
+        )
+        parser.add_argument(
+            '--segment-size', type=int, default=1000,
+            help="Game log entries per segment"
+        )
+
+    def handle(self, *args, **options):
+        finished_before = timezone.now() - timedelta(days=options['days'])
+        sessions = Session.objects.filter(
+            status=Session.STATUS_FINISHED,
+            updated_at__lt=finished_before,
+            gamelogs__isnull=False
+        ).distinct()
+
+        total = 0
+        for session in sessions.iterator():
+            archived = session.archive_gamelogs(options['segment_size'])
+            total += archived
+            self.stdout.write("%s: %s entries archived" % (session, archived))
+
+        self.stdout.write(self.style.SUCCESS("%s entries archived" % total))
@@ -0,0 +1,324 @@
+import json
+import random
+import subprocess
+import time
+import tracemalloc
+
+from django.apps import apps
+from django.conf import settings
+from django.contrib.auth.models import User
+from django.core.management.base import BaseCommand, CommandError
+from django.test import RequestFactory
+from django.utils import timezone
+
+from game.invalidation import invalidate
+from game.models import Game, Character, Property, Scene, Moment, Block, Action, AfterEffect
+from gamebook.metrics import measure
+from play.models import Session
+
+
+OPERATORS = ('==', '!=', '>=', '<')
+
+
+def percentile(values, rank):
+    values = sorted(values)
+    if not values:
+        return None
+    index = min(len(values) - 1, max(0, int(round(rank / 100.0 * len(values))) - 1))
+    return values[index]
+
+
+class Command(BaseCommand):
+    help = "Generate a synthetic game and measure the play hot paths"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--scenes', type=int, default=10)
+        parser.add_argument('--moments', type=int, default=5, help="Moments per scene")
+        parser.add_argument('--blocks', type=int, default=5, help="Blocks per moment")
+        parser.add_argument('--actions', type=int, default=3, help="Actions per moment")
+        parser.add_argument('--properties', type=int, default=10)
+        parser.add_argument('--clauses', type=int, default=2, help="Clauses per condition")
+        parser.add_argument('--iterations', type=int, default=200)
+        parser.add_argument('--seed', type=int, default=1)
+        parser.add_argument('--output', help="Write results as JSON to this file")
+        parser.add_argument('--keep', action='store_true', help="Keep the generated game")
+        parser.add_argument(
+            '--force', action='store_true',
+            help="Run with DEBUG off. The benchmark writes to the database "
+                 "and flushes the game caches, never run it against production"
+        )
+
+    def handle(self, *args, **options):
+        if not (settings.DEBUG or options['force']):
+            raise CommandError(
+                "The benchmark writes to the database and DEBUG is off. "
+                "Use --force if this is not a production database."
+            )
+        if options['scenes'] < 1 or options['moments'] < 1:
+            raise CommandError("The game needs at least one scene and one moment")
+
+        self.random = random.Random(options['seed'])
+        self.user, created = User.objects.get_or_create(username='benchmark')
+
+        started = time.perf_counter()
+        game = self.generate(options)
+        generated_in = time.perf_counter() - started
+        self.stdout.write("Game %s generated in %.1f s" % (game.pk, generated_in))
+
+        results = {}
+        try:
+            iterations = options['iterations']
+            results['Game.get_user_game'] = self.bench_get_user_game(game, iterations)
+            results['Session.get_game_data'] = self.bench_get_game_data(game, iterations)
+            results['SessionCharacter.do_action'] = self.bench_do_action(game, iterations)
+            results['HookView.post'] = self.bench_hook(iterations)
+        finally:
+            if not options['keep']:
+                game.delete()
+
+        report = {
+            'created_at': timezone.now().isoformat(),
+            'commit': self.get_commit(),
+            'params': {
+                key: options[key] for key in (
+                    'scenes', 'moments', 'blocks', 'actions', 'properties',
+                    'clauses', 'iterations', 'seed'
+                )
+            },
+            'generated_in': generated_in,
+            'results': results,
+        }
+
+        for name, result in results.items():
+            if 'skipped' in result:
+                self.stdout.write("%-28s skipped: %s" % (name, result['skipped']))
+            else:
+                self.stdout.write(
+                    "%-28s p50 %.2f ms  p99 %.2f ms  queries %.1f  peak %.0f KiB" % (
+                        name, result['latency_ms']['p50'], result['latency_ms']['p99'],
+                        result['queries']['mean'], result['memory_peak_kib']
+                    )
+                )
+
+        if options['output']:
+            with open(options['output'], 'w') as f:
+                json.dump(report, f, indent=2, sort_keys=True)
+            self.stdout.write(self.style.SUCCESS("Results written to %s" % options['output']))
+        else:
+            self.stdout.write(json.dumps(report, indent=2, sort_keys=True))
+
+    def get_commit(self):
+        try:
+            return subprocess.check_output(
+                ['git', 'rev-parse', 'HEAD'], stderr=subprocess.DEVNULL
+            ).decode('utf-8').strip()
+        except (OSError, subprocess.CalledProcessError):
+            return None
+
+    def condition(self, property_pks, clauses):
+        if not clauses or self.random.random() < 0.3:
+            return ''
+        return json.dumps([
+            [
+                self.random.choice(property_pks),
+                self.random.choice(OPERATORS),
+                str(self.random.randint(0, 3))
+            ]
+            for i in range(clauses)
+        ])
+
+    def generate(self, options):
+        """Game with the requested shape, rows are written with bulk_create."""
+        game = Game.objects.create(
+            name="Benchmark %s" % timezone.now().isoformat(),
+            author=self.user,
+            status=Game.STATUS_PUBLISHED
+        )
+
+        Scene.objects.bulk_create(
+            Scene(game=game, name="Scene %s" % i, order=i)
+            for i in range(options['scenes'])
+        )
+        scenes = list(Scene.objects.filter(game=game).order_by('pk'))
+
+        Moment.objects.bulk_create(
+            Moment(game=game, scene=scene, name="Moment %s" % i, order=i)
+            for scene in scenes for i in range(options['moments'])
+        )
+        moments = list(Moment.objects.filter(game=game).order_by('pk'))
+        moments_by_scene = {}
+        for moment in moments:
+            moments_by_scene.setdefault(moment.scene_id, []).append(moment)
+
+        character = Character.objects.create(game=game, name="Hero", start_scene=scenes[0])
+
+        Property.objects.bulk_create(
+            Property(game=game, character=character if i % 2 else None,
+                     name="p%s" % i, value='0')
+            for i in range(options['properties'])
+        )
+        property_pks = list(
+            Property.objects.filter(game=game).order_by('pk').values_list('pk', flat=True)
+        ) or [0]
+
+        Block.objects.bulk_create(
+            Block(
+                game=game, scene_id=moment.scene_id, moment=moment, order=i,
+                content="Block %s of %s. " % (i, moment.name) * 10,
+                condition=self.condition(property_pks, options['clauses'])
+            )
+            for moment in moments for i in range(options['blocks'])
+        )
+
+        Action.objects.bulk_create(
+            Action(
+                game=game, scene_id=moment.scene_id, moment=moment, order=i,
+                content="Action %s of %s" % (i, moment.name),
+                # the first action is always visible, so nobody gets stuck
+                condition='' if i == 0 else self.condition(property_pks, options['clauses'])
+            )
+            for moment in moments for i in range(options['actions'])
+        )
+
+        effects = []
+        for action in Action.objects.filter(game=game).order_by('pk'):
+            if self.random.random() < 0.2:
+                effects.append(AfterEffect(action=action, go_to_scene=self.random.choice(scenes)))
+            else:
+                effects.append(AfterEffect(
+                    action=action,
+                    go_to_moment=self.random.choice(moments_by_scene[action.scene_id])
+                ))
+            if options['properties']:
+                effects.append(AfterEffect(
+                    action=action,
+                    set_property_id=self.random.choice(property_pks),
+                    set_property_value=str(self.random.randint(0, 3))
+                ))
+        AfterEffect.objects.bulk_create(effects)
+
+        # bulk_create sends no signals
+        invalidate(game.pk)
+        game.refresh_from_db()
+        return game
+
+    def run(self, iterations, setup, target):
+        """
+        Call `target(setup())` and collect latency and queries. Memory is
+        traced in a separate shorter pass, tracing slows every allocation.
+        """
+        latencies, queries, db_times = [], [], []
+        for i in range(iterations):
+            arg = setup()
+            with measure('benchmark') as m:
+                target(arg)
+            latencies.append(m.wall_time * 1000)
+            queries.append(m.queries)
+            db_times.append(m.db_time * 1000)
+
+        tracemalloc.start()
+        try:
+            for i in range(min(iterations, 20)):
+                arg = setup()
+                target(arg)
+            peak = tracemalloc.get_traced_memory()[1]
+        finally:
+            tracemalloc.stop()
+
+        return {
+            'iterations': iterations,
+            'latency_ms': {
+                'mean': sum(latencies) / len(latencies),
+                'p50': percentile(latencies, 50),
+                'p90': percentile(latencies, 90),
+                'p99': percentile(latencies, 99),
+                'max': max(latencies),
+            },
+            'queries': {
+                'mean': sum(queries) / len(queries),
+                'max': max(queries),
+            },
+            'db_ms_mean': sum(db_times) / len(db_times),
+            'memory_peak_kib': peak / 1024.0,
+        }
+
+    def finish_sessions(self, game):
+        Session.objects.filter(game=game, user=self.user).update(status=Session.STATUS_FINISHED)
+        return game
+
+    def bench_get_user_game(self, game, iterations):
+        return self.run(
+            iterations,
+            lambda: self.finish_sessions(game),
+            lambda game: game.get_user_game(self.user)
+        )
+
+    def fresh_session(self, session_pk):
+        return Session.objects.select_related('game', 'active_character').get(pk=session_pk)
+
+    def bench_get_game_data(self, game, iterations):
+        session_pk = game.get_user_game(self.user).pk
+        return self.run(
+            iterations,
+            lambda: self.fresh_session(session_pk),
+            lambda session: session.get_game_data()
+        )
+
+    def bench_do_action(self, game, iterations):
+        if not Action.objects.filter(game=game).exists():
+            return {'skipped': "the game has no actions"}
+
+        state = {'session_pk': game.get_user_game(self.user).pk}
+
+        def setup():
+            session = self.fresh_session(state['session_pk'])
+            actions = session.get_game_data().actions
+            if not actions:
+                # a dead end, play again from the start
+                self.finish_sessions(game)
+                session = game.get_user_game(self.user)
+                state['session_pk'] = session.pk
+                actions = session.get_game_data().actions
+                if not actions:
+                    raise CommandError("No action is visible at the start of the game")
+            return session.active_character, self.random.choice(actions)['id']
+
+        return self.run(
+            iterations,
+            setup,
+            lambda arg: arg[0].do_action(arg[1])
+        )
+
+    def bench_hook(self, iterations):
+        if not apps.is_installed('telegrambot'):
+            return {'skipped': "telegrambot is not installed"}
+
+        from telegrambot.models import Bot
+        from telegrambot.views import HookView
+
+        bot = Bot.objects.create(token='0:benchmark-%s' % int(time.time() * 1000))
+        factory = RequestFactory()
+        view = HookView.as_view()
+        counter = iter(range(1, iterations + 21))
+
+        def setup():
+            update_id = next(counter)
+            return factory.post(
+                '/telegrambot/%s/' % bot.id,
+                data=json.dumps({
+                    'update_id': update_id,
+                    'message': {
+                        'message_id': update_id,
+                        'date': int(time.time()),
+                        'text': '/games',
+                        'from': {'id': 1, 'is_bot': False, 'first_name': 'Benchmark'},
+                        'chat': {'id': 1, 'type': 'private', 'first_name': 'Benchmark'},
+                    },
+                }),
+                content_type='application/json'
+            )
+
+        try:
+            return self.run(iterations, setup, lambda request: view(request, bot_id=bot.id))
+        finally:
+            bot.delete()
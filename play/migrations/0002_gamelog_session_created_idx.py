@@ -0,0 +1,17 @@
+# Generated by Django 2.0.4 on 2026-10-18 12:00
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('play', '0001_initial'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='gamelog',
+            index=models.Index(fields=['session', 'created_at', 'id'], name='gamelog_session_created_idx'),
+        ),
+    ]
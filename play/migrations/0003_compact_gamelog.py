@@ -0,0 +1,49 @@
+# Generated by Django 2.0.4 on 2026-10-18 12:30
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('play', '0002_gamelog_session_created_idx'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='gamelog',
+            name='text',
+            field=models.TextField(blank=True, verbose_name='text'),
+        ),
+        migrations.AddField(
+            model_name='gamelog',
+            name='block_ids',
+            field=models.TextField(blank=True, verbose_name='block ids'),
+        ),
+        migrations.AddField(
+            model_name='gamelog',
+            name='action_id',
+            field=models.IntegerField(blank=True, null=True, verbose_name='action id'),
+        ),
+        migrations.AddField(
+            model_name='gamelog',
+            name='game_version',
+            field=models.BigIntegerField(blank=True, null=True, verbose_name='game version'),
+        ),
+        migrations.CreateModel(
+            name='GamelogSegment',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('created_at', models.DateTimeField(auto_now_add=True, verbose_name='Date created')),
+                ('first_created_at', models.DateTimeField(verbose_name='First entry date')),
+                ('last_created_at', models.DateTimeField(verbose_name='Last entry date')),
+                ('count', models.PositiveIntegerField(verbose_name='count')),
+                ('data', models.BinaryField(verbose_name='data')),
+                ('session', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='gamelog_segments', to='play.Session', verbose_name='session')),
+            ],
+            options={
+                'ordering': ['session', 'first_created_at'],
+            },
+        ),
+    ]
@@ -0,0 +1,40 @@
+# Generated by Django 2.0.4 on 2026-10-18 13:00
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('game', '0002_gameversion'),
+        ('play', '0003_compact_gamelog'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='session',
+            name='game_version',
+            field=models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='sessions', to='game.GameVersion', verbose_name='game version'),
+        ),
+        migrations.AlterField(
+            model_name='sessioncharacter',
+            name='character',
+            field=models.ForeignKey(db_constraint=False, on_delete=django.db.models.deletion.DO_NOTHING, related_name='in_games', to='game.Character', verbose_name='character'),
+        ),
+        migrations.AlterField(
+            model_name='sessioncharacter',
+            name='current_scene',
+            field=models.ForeignKey(db_constraint=False, on_delete=django.db.models.deletion.DO_NOTHING, related_name='scene_characters', to='game.Scene', verbose_name='current scene'),
+        ),
+        migrations.AlterField(
+            model_name='sessioncharacter',
+            name='current_moment',
+            field=models.ForeignKey(db_constraint=False, on_delete=django.db.models.deletion.DO_NOTHING, related_name='moment_characters', to='game.Moment', verbose_name='current moment'),
+        ),
+        migrations.AlterField(
+            model_name='sessionproperty',
+            name='property',
+            field=models.ForeignKey(db_constraint=False, on_delete=django.db.models.deletion.DO_NOTHING, related_name='in_games', to='game.Property', verbose_name='property'),
+        ),
+    ]
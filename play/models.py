@@ -1,14 +1,26 @@
+import json
 import logging
+import zlib
+from collections import namedtuple
 
-from django.db import models
+from django.apps import apps
+from django.conf import settings
+from django.db import models, transaction
 from django.db.models import Q
 from django.utils.translation import ugettext_lazy as _
+from django.utils import timezone
+from django.utils.dateparse import parse_datetime
 from django.contrib.auth.models import User
+from game.compiled import get_compiled_game, get_version_compiled
+from play.state import SessionState
 
 
 logger = logging.getLogger(__name__)
 
 
+GameData = namedtuple('GameData', 'vision actions block_pks')
+
+
 class Session(models.Model):
     """
     Игровая сессия конкретного юзера внутри квеста.
@@ -44,39 +56,146 @@ class Session(models.Model):
         null=True,
         on_delete=models.SET_NULL
     )
+    game_version = models.ForeignKey(
+        to='game.GameVersion',
+        verbose_name=_('game version'),
+        related_name='sessions',
+        null=True,
+        blank=True,
+        on_delete=models.SET_NULL
+    )
 
     def __str__(self):
         return "%s in %s" % (self.user, self.game)
 
+    @property
+    def compiled_game(self):
+        """
+        The published version the session was started with,
+        the current draft for sessions without one.
+        """
+        if getattr(self, '_compiled_game', None) is None:
+            if self.game_version_id:
+                self._compiled_game = get_version_compiled(self.game_version_id)
+            else:
+                self._compiled_game = get_compiled_game(self.game)
+        return self._compiled_game
+
     def get_game_data(self):
         logger.debug(
             "Get game data for session %s with active active_character %s" %
             (self, self.active_character)
         )
-        return {
-            'vision': self.active_character.get_scene_vision(),
-            'actions': self.active_character.get_scene_actions(),
-        }
+        return self.active_character.get_game_data()
 
     def fire_action(self, action_pk):
         logger.debug(
             "Fire some action for session %s with active active_character %s" %
             (self, self.active_character)
         )
-
-        try:
-            action = self.active_character.current_scene.actions.get(
-                pk=action_pk
+        return self.active_character.do_action(action_pk)
+
+    def get_gamelog_window(self, limit=None, before=None):
+        """
+        Last `limit` game log entries older than the `before` entry,
+        in chronological order. Keyset pagination over (created_at, id).
+        """
+        if limit is None:
+            limit = getattr(settings, 'PLAY_GAMELOG_WINDOW', 20)
+
+        queryset = self.gamelogs.order_by('-created_at', '-id')
+        if before is not None:
+            queryset = queryset.filter(
+                Q(created_at__lt=before.created_at) |
+                Q(created_at=before.created_at, id__lt=before.id)
             )
-            action.fire_after_effects(self.active_character)
-            return True
-        except models.Model.DoesNotExist:
-            logger.debug(
-                "Not found action with pk %s in scene %S" %
-                (action_pk, self.active_character.current_scene)
+        return self.expand_gamelogs(list(reversed(queryset[:limit])))
+
+    def iter_gamelogs(self, before=None, chunk_size=500):
+        """
+        All game log entries older than the `before` entry in chronological
+        order, fetched in keyset chunks of `chunk_size` rows.
+        """
+        queryset = self.gamelogs.order_by('created_at', 'id')
+        if before is not None:
+            queryset = queryset.filter(
+                Q(created_at__lt=before.created_at) |
+                Q(created_at=before.created_at, id__lt=before.id)
             )
 
-        return False
+        last = None
+        while True:
+            chunk = queryset
+            if last is not None:
+                chunk = chunk.filter(
+                    Q(created_at__gt=last.created_at) |
+                    Q(created_at=last.created_at, id__gt=last.id)
+                )
+            chunk = self.expand_gamelogs(list(chunk[:chunk_size]))
+            for gamelog in chunk:
+                yield gamelog
+            if len(chunk) < chunk_size:
+                return
+            last = chunk[-1]
+
+    def expand_gamelogs(self, gamelogs):
+        """
+        Fill in the text of compact game log entries from the published
+        version each entry was written with.
+        """
+        versions = {
+            gamelog.game_version for gamelog in gamelogs if gamelog.is_compact
+        }
+        if not versions:
+            return gamelogs
+
+        GameVersion = apps.get_model('game', 'GameVersion')
+        compiled_games = {
+            content_version: get_version_compiled(pk)
+            for content_version, pk in GameVersion.objects.filter(
+                game_id=self.game_id, content_version__in=versions
+            ).values_list('content_version', 'pk')
+        }
+        for gamelog in gamelogs:
+            if gamelog.is_compact:
+                compiled_game = compiled_games.get(gamelog.game_version)
+                if compiled_game is None:
+                    logger.error(
+                        "Game log %s of session %s: version %s is gone" %
+                        (gamelog.pk, self.pk, gamelog.game_version)
+                    )
+                    continue
+                gamelog.text = gamelog.render(compiled_game)
+        return gamelogs
+
+    def archive_gamelogs(self, segment_size=1000):
+        """
+        Roll the game log of the session into compressed segments
+        and delete the rows. Returns the number of archived entries.
+        """
+        archived = 0
+        with transaction.atomic():
+            segments = []
+            chunk = []
+            for gamelog in self.gamelogs.order_by('created_at', 'id').iterator():
+                chunk.append(gamelog)
+                if len(chunk) == segment_size:
+                    segments.append(GamelogSegment.from_gamelogs(self, chunk))
+                    archived += len(chunk)
+                    chunk = []
+            if chunk:
+                segments.append(GamelogSegment.from_gamelogs(self, chunk))
+                archived += len(chunk)
+
+            if segments:
+                GamelogSegment.objects.bulk_create(segments)
+                self.gamelogs.all().delete()
+        return archived
+
+    def iter_archived_gamelogs(self):
+        for segment in self.gamelog_segments.order_by('first_created_at'):
+            for gamelog in self.expand_gamelogs(list(segment.entries())):
+                yield gamelog
 
     def finish_game(self):
         self.status = self.STATUS_FINISHED
@@ -86,23 +205,28 @@ class Session(models.Model):
 class SessionCharacter(models.Model):
     created_at = models.DateTimeField(_("Date created"), auto_now_add=True)
     updated_at = models.DateTimeField(_("Date updated"), auto_now=True)
+    # story rows are referenced without constraints: a session pinned to a
+    # published version keeps its position when the draft rows are deleted
     character = models.ForeignKey(
         to='game.Character',
         verbose_name=_('character'),
         related_name='in_games',
-        on_delete=models.CASCADE
+        on_delete=models.DO_NOTHING,
+        db_constraint=False
     )
     current_scene = models.ForeignKey(
         to='game.Scene',
         verbose_name=_('current scene'),
         related_name='scene_characters',
-        on_delete=models.CASCADE
+        on_delete=models.DO_NOTHING,
+        db_constraint=False
     )
     current_moment = models.ForeignKey(
         to='game.Moment',
         verbose_name=_('current moment'),
         related_name='moment_characters',
-        on_delete=models.CASCADE
+        on_delete=models.DO_NOTHING,
+        db_constraint=False
     )
     session = models.ForeignKey(
         to='Session',
@@ -117,53 +241,232 @@ class SessionCharacter(models.Model):
         )
 
     def __str__(self):
-        return "%s: %s" % (self.session, self.character)
+        return "%s: %s" % (self.session_id, self.character_id)
+
+    @classmethod
+    def start(cls, session, character_pk):
+        """New character of the session in its start moment."""
+        scene_pk, moment_pk = session.compiled_game.get_start_pks(character_pk)
+        return cls.objects.create(
+            character_id=character_pk,
+            session=session,
+            current_scene_id=scene_pk,
+            current_moment_id=moment_pk
+        )
+
+    @property
+    def state(self):
+        # not `_state`, django keeps its ModelState there
+        if getattr(self, '_session_state', None) is None:
+            self._session_state = SessionState(self)
+        return self._session_state
+
+    def get_property_values(self):
+        return self.state.values
+
+    @property
+    def compiled_game(self):
+        if getattr(self, '_compiled_game', None) is None:
+            self._compiled_game = self.session.compiled_game
+        return self._compiled_game
+
+    @property
+    def name(self):
+        character = self.compiled_game.characters.get(self.character_id)
+        return character.name if character else ''
+
+    def check_position(self):
+        """
+        Sessions without a version play the draft, and the author may delete
+        the moment a character is in. Such a character is moved to the default
+        moment of its scene, or to its start position if the scene is gone
+        too, and the new position is saved. Returns True if it moved.
+        """
+        compiled = self.compiled_game
+        if self.current_moment_id in compiled.moments:
+            return False
+
+        scene_pk = self.current_scene_id
+        moment_pk = compiled.get_default_moment_pk(scene_pk)
+        if moment_pk is None:
+            scene_pk, moment_pk = compiled.get_start_pks(self.character_id)
+        if moment_pk is None:
+            # the game has no moments left, nothing to move to
+            return False
 
-    def get_scene_vision(self):
+        logger.info(
+            "Moment %s of character %s is gone, move it to moment %s" %
+            (self.current_moment_id, self, moment_pk)
+        )
+        self.current_scene_id = scene_pk
+        self.current_moment_id = moment_pk
+        self._game_data = None
+        SessionCharacter.objects.filter(pk=self.pk).update(
+            current_scene_id=scene_pk,
+            current_moment_id=moment_pk,
+            updated_at=timezone.now()
+        )
+        return True
+
+    def get_scene_blocks(self):
+        values = self.state.values
         result = []
-        blocks = self.current_moment.get_blocks_for_character(self)
-        for block in blocks:
-            result.append(block.content)
+        for block in self.compiled_game.get_blocks(self.current_moment_id):
+            if block.predicate(values):
+                result.append(block)
 
-        return "\n\n".join(result)
+        return result
+
+    def get_scene_vision(self, blocks=None):
+        if blocks is None:
+            blocks = self.get_scene_blocks()
+        return "\n\n".join(block.content for block in blocks)
 
     def get_scene_actions(self):
+        values = self.state.values
         result = []
-        actions = self.current_moment.get_actions_for_character(self)
-        for action in actions:
-            result.append({'id': action.pk, 'content': action.content})
+        for action in self.compiled_game.get_actions(self.current_moment_id):
+            if action.predicate(values):
+                result.append({'id': action.pk, 'content': action.content})
 
         return result
 
+    def get_game_data(self):
+        """
+        What the character sees right now. Computed once and reused until
+        the character moves or acts.
+        """
+        if getattr(self, '_game_data', None) is None:
+            self.check_position()
+            blocks = self.get_scene_blocks()
+            self._game_data = GameData(
+                vision=self.get_scene_vision(blocks),
+                actions=self.get_scene_actions(),
+                block_pks=tuple(block.pk for block in blocks),
+            )
+        return self._game_data
+
     def do_action(self, action_id):
+        """
+        Fire an action of the current moment.
+
+        All changes (position, properties, game log) are collected in memory
+        and written at the end in one transaction. The session row is locked
+        first, so concurrent requests for the same session run one by one
+        and each sees the position left by the previous one.
+        """
         try:
-            action = self.current_moment.actions.get(id=action_id)
-            gl_vision = Gamelog(
-                session=self.session,
-                source=Gamelog.SOURCE_GAME,
-                text=self.get_scene_vision()
+            action_id = int(action_id)
+        except (TypeError, ValueError):
+            return False
+
+        with transaction.atomic():
+            Session.objects.select_for_update().filter(
+                pk=self.session_id
+            ).values_list('pk').get()
+            self.refresh_from_db(fields=['current_scene', 'current_moment'])
+            self.state.reset()
+            self._game_data = None
+            self.check_position()
+
+            action = self.compiled_game.get_action(
+                self.current_moment_id, action_id
+            )
+            if action is None:
+                return False
+
+            gamelogs = self.make_gamelogs(action)
+            self.fire_action(action)
+            # property changes alone change what the character sees too
+            self._game_data = None
+
+            Gamelog.objects.bulk_create(gamelogs)
+            self.state.flush()
+            SessionCharacter.objects.filter(pk=self.pk).update(
+                current_scene_id=self.current_scene_id,
+                current_moment_id=self.current_moment_id,
+                updated_at=timezone.now()
             )
-            gl_action = Gamelog(
-                session=self.session,
+        return True
+
+    def make_gamelogs(self, action):
+        """
+        Log entries for the current vision and the chosen action. With
+        PLAY_GAMELOG_COMPACT sessions of a published version store only
+        block and action ids, the text is rebuilt from the version on read.
+        Draft rows change, so draft sessions always store the text.
+        """
+        game_data = self.get_game_data()
+        if (getattr(settings, 'PLAY_GAMELOG_COMPACT', False) and
+                self.session.game_version_id):
+            version = self.compiled_game.version
+            return [
+                Gamelog(
+                    session_id=self.session_id,
+                    source=Gamelog.SOURCE_GAME,
+                    block_ids=",".join(str(pk) for pk in game_data.block_pks),
+                    game_version=version
+                ),
+                Gamelog(
+                    session_id=self.session_id,
+                    source=Gamelog.SOURCE_USER,
+                    action_id=action.pk,
+                    game_version=version
+                ),
+            ]
+
+        return [
+            Gamelog(
+                session_id=self.session_id,
+                source=Gamelog.SOURCE_GAME,
+                text=game_data.vision
+            ),
+            Gamelog(
+                session_id=self.session_id,
                 source=Gamelog.SOURCE_USER,
                 text=action.content
+            ),
+        ]
+
+    def fire_action(self, action):
+        """Apply action after effects in memory, nothing is saved here."""
+        if not action.predicate(self.state.values):
+            logger.debug(
+                "Try to fire not visible action %s for character %s" %
+                (action.pk, self)
             )
-            action.fire_after_effects(self)
-            gl_vision.save()
-            gl_action.save()
-            return True
-        except self.current_moment.actions.DoesNotExist:
-            return False
+            return
+
+        logger.debug("Fire action %s for character %s" % (action.pk, self))
+        for effect in action.effects:
+            if effect.go_to_scene_pk:
+                self.move_to_scene(effect.go_to_scene_pk)
+            if effect.go_to_moment_pk:
+                self.move_to_moment(effect.go_to_moment_pk)
+            if effect.set_property_pk:
+                self.state.set(
+                    effect.set_property_pk,
+                    effect.set_property_value
+                )
+
+    def move_to_scene(self, scene_pk):
+        self.current_scene_id = scene_pk
+        self.current_moment_id = self.compiled_game.get_default_moment_pk(
+            scene_pk
+        )
+        self._game_data = None
+
+    def move_to_moment(self, moment_pk):
+        self.current_moment_id = moment_pk
+        self.current_scene_id = self.compiled_game.moments[moment_pk].scene_pk
+        self._game_data = None
 
     def go_to_scene(self, scene):
-        self.current_scene = scene
-        self.current_moment = scene.get_default_moment()
+        self.move_to_scene(scene.pk)
         self.save()
 
     def go_to_moment(self, moment):
-        self.current_moment = moment
-        if moment.scene != self.current_scene:
-            self.current_scene = moment.scene
+        self.move_to_moment(moment.pk)
         self.save()
 
 
@@ -188,7 +491,8 @@ class SessionProperty(models.Model):
         to='game.Property',
         verbose_name=_('property'),
         related_name='in_games',
-        on_delete=models.CASCADE
+        on_delete=models.DO_NOTHING,
+        db_constraint=False
     )
     current_value = models.CharField(
         verbose_name=_('current value'),
@@ -202,10 +506,18 @@ class SessionProperty(models.Model):
         )
 
     def __str__(self):
-        return "%s: %s" % (self.character, self.property)
+        return "%s: %s" % (self.character_id, self.property_id)
 
 
 class Gamelog(models.Model):
+    """
+    One entry of the game log. Entries keep their text unless
+    PLAY_GAMELOG_COMPACT is on (it is off by default): then entries of
+    sessions pinned to a published version keep only block and action ids
+    and the content version, see `SessionCharacter.make_gamelogs`. Logs of
+    finished sessions are rolled into GamelogSegment rows by the
+    `archive_gamelogs` command, active sessions keep their rows.
+    """
     SOURCE_USER, SOURCE_GAME = 'u', 'g'
     SOURCE_CHOICES = (
         (SOURCE_USER, _('user')),
@@ -225,7 +537,98 @@ class Gamelog(models.Model):
         choices=SOURCE_CHOICES,
         default=SOURCE_GAME
     )
-    text = models.TextField(verbose_name=_('text'))
+    text = models.TextField(verbose_name=_('text'), blank=True)
+    block_ids = models.TextField(verbose_name=_('block ids'), blank=True)
+    action_id = models.IntegerField(verbose_name=_('action id'), blank=True,
+                                    null=True)
+    game_version = models.BigIntegerField(verbose_name=_('game version'),
+                                          blank=True, null=True)
 
     class Meta:
         ordering = ['created_at', ]
+        indexes = [
+            models.Index(
+                fields=['session', 'created_at', 'id'],
+                name='gamelog_session_created_idx'
+            ),
+        ]
+
+    def __str__(self):
+        return "%s: %s" % (self.session_id, self.get_source_display())
+
+    @property
+    def is_compact(self):
+        return not self.text and (bool(self.block_ids) or bool(self.action_id))
+
+    def render(self, compiled_game):
+        """Text of the entry, rebuilt from `compiled_game` if compact."""
+        if not self.is_compact:
+            return self.text
+
+        if self.action_id:
+            action = compiled_game.actions.get(self.action_id)
+            return action.content if action else ''
+
+        result = []
+        for pk in self.block_ids.split(','):
+            block = compiled_game.blocks.get(int(pk))
+            if block:
+                result.append(block.content)
+        return "\n\n".join(result)
+
+    def to_row(self):
+        return [
+            self.created_at.isoformat(), self.source, self.text,
+            self.block_ids, self.action_id, self.game_version,
+        ]
+
+
+class GamelogSegment(models.Model):
+    """
+    Game log of a finished session rolled into one compressed blob.
+    `data` is zlib compressed json: a list of `Gamelog.to_row` lists.
+    """
+
+    created_at = models.DateTimeField(_("Date created"), auto_now_add=True)
+    session = models.ForeignKey(
+        to='Session',
+        verbose_name=_('session'),
+        related_name='gamelog_segments',
+        on_delete=models.CASCADE
+    )
+    first_created_at = models.DateTimeField(_("First entry date"))
+    last_created_at = models.DateTimeField(_("Last entry date"))
+    count = models.PositiveIntegerField(verbose_name=_('count'))
+    data = models.BinaryField(verbose_name=_('data'))
+
+    class Meta:
+        ordering = ['session', 'first_created_at', ]
+
+    def __str__(self):
+        return "%s: %s entries" % (self.session_id, self.count)
+
+    @classmethod
+    def from_gamelogs(cls, session, gamelogs):
+        return cls(
+            session=session,
+            first_created_at=gamelogs[0].created_at,
+            last_created_at=gamelogs[-1].created_at,
+            count=len(gamelogs),
+            data=zlib.compress(
+                json.dumps([gl.to_row() for gl in gamelogs]).encode('utf-8')
+            )
+        )
+
+    def entries(self):
+        """Unsaved Gamelog instances stored in the segment."""
+        rows = json.loads(zlib.decompress(bytes(self.data)).decode('utf-8'))
+        for created_at, source, text, block_ids, action_id, version in rows:
+            yield Gamelog(
+                session_id=self.session_id,
+                created_at=parse_datetime(created_at),
+                source=source,
+                text=text,
+                block_ids=block_ids,
+                action_id=action_id,
+                game_version=version
+            )
@@ -0,0 +1,139 @@
+import logging
+
+from django.apps import apps
+from django.db import IntegrityError, transaction
+from django.utils import timezone
+
+
+logger = logging.getLogger(__name__)
+
+
+class SessionState(object):
+    """
+    Property values of a session as seen by one session character.
+
+    Game defaults come from the compiled game and session overrides are
+    loaded with one query on first access. Values are kept for the life of
+    the object (the request), so condition checks and after effects never
+    query properties one by one.
+    """
+
+    def __init__(self, session_character):
+        self.session_character = session_character
+        self._character_bound = None
+        self._rows = None
+        self._values = None
+        self._dirty = {}
+
+    def _load(self):
+        SessionProperty = apps.get_model('play', 'SessionProperty')
+        values = {}
+        self._character_bound = set()
+        for record in self.session_character.compiled_game.properties.values():
+            values[record.pk] = record.value
+            if record.character_pk:
+                self._character_bound.add(record.pk)
+
+        # a property has one row per session, whoever wrote it; values of
+        # rows bound to another character are not seen, but the row is
+        # still the one to update
+        self._rows = {}
+        for pk, property_id, character_id, value in SessionProperty.objects.filter(
+            session_id=self.session_character.session_id
+        ).values_list('pk', 'property_id', 'character_id', 'current_value'):
+            self._rows[property_id] = pk
+            if character_id is None or character_id == self.session_character.pk:
+                values[property_id] = value
+
+        self._values = values
+
+    @property
+    def values(self):
+        """{property_pk: current value} mapping used by conditions."""
+        if self._values is None:
+            self._load()
+        return self._values
+
+    def get(self, property_pk, default=None):
+        return self.values.get(property_pk, default)
+
+    def set(self, property_pk, value):
+        """
+        Change a property value in the snapshot.
+        The change is written to the database by `flush`.
+        """
+        value = str(value)
+        self.values[property_pk] = value
+        self._dirty[property_pk] = value
+
+    def flush(self):
+        """
+        Write changed values: one UPDATE per distinct value for existing
+        rows and one bulk INSERT for new ones.
+        """
+        if not self._dirty:
+            return
+
+        SessionProperty = apps.get_model('play', 'SessionProperty')
+        session_id = self.session_character.session_id
+
+        updates = {}
+        new_rows = []
+        for property_pk, value in self._dirty.items():
+            row_pk = self._rows.get(property_pk)
+            if row_pk:
+                updates.setdefault(value, []).append(row_pk)
+            else:
+                new_rows.append(SessionProperty(
+                    session_id=session_id,
+                    property_id=property_pk,
+                    current_value=value,
+                    character=(
+                        self.session_character
+                        if property_pk in self._character_bound else None
+                    ),
+                ))
+
+        now = timezone.now()
+        for value, row_pks in updates.items():
+            SessionProperty.objects.filter(pk__in=row_pks).update(
+                current_value=value,
+                updated_at=now
+            )
+
+        self._dirty = {}
+
+        if new_rows:
+            try:
+                with transaction.atomic():
+                    SessionProperty.objects.bulk_create(new_rows)
+            except IntegrityError:
+                # rows written by a concurrent request since the load
+                for row in new_rows:
+                    stored, created = SessionProperty.objects.get_or_create(
+                        session_id=session_id,
+                        property_id=row.property_id,
+                        defaults={
+                            'current_value': row.current_value,
+                            'character': row.character,
+                        }
+                    )
+                    if not created:
+                        SessionProperty.objects.filter(pk=stored.pk).update(
+                            current_value=row.current_value,
+                            updated_at=now
+                        )
+                self.reset()
+            else:
+                if all(row.pk for row in new_rows):
+                    for row in new_rows:
+                        self._rows[row.property_id] = row.pk
+                else:
+                    # backend does not return pks from bulk_create, reload rows
+                    self.reset()
+
+    def reset(self):
+        self._character_bound = None
+        self._rows = None
+        self._values = None
+        self._dirty = {}
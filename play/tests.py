@@ -1,3 +1,282 @@
-from django.test import TestCase
+import json
+from unittest import mock
 
-# Create your tests here.
+from django.contrib.auth.models import User
+from django.test import TestCase, TransactionTestCase, override_settings
+from django.urls import reverse
+
+from game.models import Game, Scene, Moment, Character, Property, Block, Action, AfterEffect
+from play.models import Gamelog, Session, SessionCharacter, SessionProperty
+from play.state import SessionState
+
+
+def make_game(author):
+    """
+    One scene, one moment: a key can be taken once, and a block shows up
+    after it is taken.
+    """
+    game = Game.objects.create(name='Test', author=author)
+    scene = Scene.objects.create(game=game, name='Hall')
+    moment = Moment.objects.create(game=game, scene=scene, name='Door')
+    Character.objects.create(game=game, name='Hero', start_scene=scene)
+    key = Property.objects.create(game=game, name='key', value='0')
+
+    Block.objects.create(
+        game=game, scene=scene, moment=moment, order=1,
+        content='A locked door.', condition=''
+    )
+    Block.objects.create(
+        game=game, scene=scene, moment=moment, order=2,
+        content='You hold a key.', condition=json.dumps([[key.pk, '==', '1']])
+    )
+    take = Action.objects.create(
+        game=game, scene=scene, moment=moment,
+        content='Take the key', condition=json.dumps([[key.pk, '==', '0']])
+    )
+    AfterEffect.objects.create(action=take, set_property=key, set_property_value='1')
+
+    game.refresh_from_db()
+    return game
+
+
+class DoActionTest(TestCase):
+
+    def setUp(self):
+        self.game = make_game(User.objects.create_user('author'))
+        self.take = Action.objects.get(game=self.game)
+        self.session = self.game.get_user_game(User.objects.create_user('player'))
+
+    def test_property_change_refreshes_game_data(self):
+        character = self.session.active_character
+        self.assertEqual(character.get_game_data().vision, 'A locked door.')
+
+        self.assertTrue(character.do_action(self.take.pk))
+
+        game_data = character.get_game_data()
+        self.assertEqual(game_data.vision, 'A locked door.\n\nYou hold a key.')
+        self.assertEqual(game_data.actions, [])
+
+    def test_unknown_action(self):
+        character = self.session.active_character
+        self.assertFalse(character.do_action(self.take.pk + 1000))
+        self.assertFalse(character.do_action('abc'))
+
+    def test_action_writes_log_and_properties_together(self):
+        character = self.session.active_character
+        self.assertTrue(character.do_action(self.take.pk))
+
+        self.assertEqual(Gamelog.objects.filter(session=self.session).count(), 2)
+        self.assertEqual(
+            SessionProperty.objects.get(session=self.session).current_value, '1'
+        )
+
+    def test_failed_action_is_rolled_back(self):
+        character = self.session.active_character
+        with mock.patch.object(
+                SessionCharacter.objects, 'filter', side_effect=RuntimeError):
+            with self.assertRaises(RuntimeError):
+                character.do_action(self.take.pk)
+
+        self.assertFalse(Gamelog.objects.filter(session=self.session).exists())
+        self.assertFalse(SessionProperty.objects.filter(session=self.session).exists())
+
+        # the in-memory state is reloaded, the action can be taken again
+        character = SessionCharacter.objects.get(pk=character.pk)
+        self.assertTrue(character.do_action(self.take.pk))
+
+
+class SessionStateTest(TestCase):
+
+    def setUp(self):
+        self.game = make_game(User.objects.create_user('author'))
+        sidekick = Character.objects.create(
+            game=self.game, name='Sidekick', start_scene=self.game.scenes.get()
+        )
+        self.mood = Property.objects.create(
+            game=self.game, character=sidekick, name='mood', value='calm'
+        )
+        self.session = self.game.get_user_game(User.objects.create_user('player'))
+        self.hero = self.session.characters.get(character__name='Hero')
+        self.sidekick = self.session.characters.get(character=sidekick)
+
+    def test_row_of_another_character_is_updated(self):
+        SessionProperty.objects.create(
+            session=self.session, property=self.mood,
+            character=self.sidekick, current_value='angry'
+        )
+        state = SessionState(self.hero)
+        self.assertEqual(state.get(self.mood.pk), 'calm')
+
+        state.set(self.mood.pk, 'happy')
+        state.flush()
+
+        row = SessionProperty.objects.get(session=self.session, property=self.mood)
+        self.assertEqual(row.current_value, 'happy')
+        self.assertEqual(row.character, self.sidekick)
+        self.assertEqual(SessionState(self.sidekick).get(self.mood.pk), 'happy')
+
+    def test_row_written_since_the_load_is_updated(self):
+        state = SessionState(self.hero)
+        self.assertEqual(state.get(self.mood.pk), 'calm')
+        SessionProperty.objects.create(
+            session=self.session, property=self.mood,
+            character=self.sidekick, current_value='angry'
+        )
+
+        state.set(self.mood.pk, 'happy')
+        state.flush()
+
+        row = SessionProperty.objects.get(session=self.session, property=self.mood)
+        self.assertEqual(row.current_value, 'happy')
+
+
+class GamelogViewTest(TestCase):
+
+    def setUp(self):
+        self.game = make_game(User.objects.create_user('author'))
+        player = User.objects.create_user('player', password='secret')
+        self.session = self.game.get_user_game(player)
+        self.client.login(username='player', password='secret')
+        self.url = reverse('game_play_log', args=(self.game.pk, ))
+
+    def test_log(self):
+        take = Action.objects.get(game=self.game)
+        self.session.active_character.do_action(take.pk)
+
+        response = self.client.get(self.url)
+        self.assertEqual(response.status_code, 200)
+        self.assertIn('A locked door.', b''.join(response.streaming_content).decode('utf-8'))
+
+    def test_bad_before(self):
+        self.assertEqual(self.client.get(self.url, {'before': 'abc'}).status_code, 400)
+        self.assertEqual(self.client.get(self.url, {'before': '999999'}).status_code, 404)
+
+
+class DeletedMomentTest(TransactionTestCase):
+
+    def setUp(self):
+        self.game = make_game(User.objects.create_user('author'))
+        self.moment = Moment.objects.get(game=self.game)
+        self.other = Moment.objects.create(
+            game=self.game, scene=self.moment.scene, name='Corridor', order=200
+        )
+        Block.objects.create(
+            game=self.game, scene=self.moment.scene, moment=self.other,
+            content='A long corridor.', condition=''
+        )
+        self.game.refresh_from_db()
+        self.session = self.game.get_user_game(User.objects.create_user('player'))
+
+    def test_character_moves_to_the_default_moment_of_its_scene(self):
+        self.moment.delete()
+        session = Session.objects.get(pk=self.session.pk)
+        character = session.active_character
+
+        self.assertEqual(str(character), "%s: %s" % (session.pk, character.character_id))
+        self.assertEqual(session.get_game_data().vision, 'A long corridor.')
+        self.assertEqual(
+            SessionCharacter.objects.get(pk=character.pk).current_moment_id,
+            self.other.pk
+        )
+
+    def test_deleted_character_has_no_name(self):
+        character = self.session.active_character
+        self.assertEqual(character.name, 'Hero')
+
+        Character.objects.filter(game=self.game).delete()
+        character = SessionCharacter.objects.get(pk=character.pk)
+        self.assertEqual(character.name, '')
+
+
+class PublishTest(TransactionTestCase):
+
+    def setUp(self):
+        self.game = make_game(User.objects.create_user('author'))
+        self.block = Block.objects.get(game=self.game, order=1)
+
+    def play(self, username):
+        game = Game.objects.get(pk=self.game.pk)
+        session = game.get_user_game(User.objects.create_user(username))
+        return Session.objects.get(pk=session.pk)
+
+    def test_publish_keeps_the_content_version(self):
+        updated_at = self.game.updated_at
+        version = self.game.publish()
+
+        game = Game.objects.get(pk=self.game.pk)
+        self.assertEqual(game.updated_at, updated_at)
+        self.assertEqual(game.status, Game.STATUS_PUBLISHED)
+        self.assertEqual(game.published_version_id, version.pk)
+        self.assertEqual(version.number, 1)
+        self.assertEqual(version.content_version, version.compiled_game.version)
+        self.assertEqual(self.game.publish().number, 2)
+
+    def test_sessions_play_the_version_they_started_with(self):
+        version = self.game.publish()
+        first = self.play('first')
+        self.assertEqual(first.game_version_id, version.pk)
+
+        self.block.content = 'An open door.'
+        self.block.save()
+        self.assertEqual(self.play('second').get_game_data().vision, 'A locked door.')
+
+        Game.objects.get(pk=self.game.pk).publish()
+        self.assertEqual(self.play('third').get_game_data().vision, 'An open door.')
+        first = Session.objects.get(pk=first.pk)
+        self.assertEqual(first.get_game_data().vision, 'A locked door.')
+
+    def test_deleting_draft_rows_keeps_pinned_sessions(self):
+        self.game.publish()
+        session = self.play('player')
+        Moment.objects.filter(game=self.game).delete()
+
+        session = Session.objects.get(pk=session.pk)
+        self.assertEqual(session.get_game_data().vision, 'A locked door.')
+        self.assertEqual(session.active_character.name, 'Hero')
+
+
+@override_settings(PLAY_GAMELOG_COMPACT=True)
+class CompactGamelogTest(TransactionTestCase):
+
+    def setUp(self):
+        self.game = make_game(User.objects.create_user('author'))
+        self.take = Action.objects.get(game=self.game)
+
+    def play(self):
+        game = Game.objects.get(pk=self.game.pk)
+        session = game.get_user_game(User.objects.create_user('player'))
+        session.active_character.do_action(self.take.pk)
+        return Session.objects.get(pk=session.pk)
+
+    def texts(self, session):
+        return [gamelog.text for gamelog in session.get_gamelog_window()]
+
+    def test_entries_are_rendered_from_their_version(self):
+        self.game.publish()
+        session = self.play()
+        self.assertTrue(all(gamelog.is_compact for gamelog in session.gamelogs.all()))
+
+        block = Block.objects.get(game=self.game, order=1)
+        block.content = 'An open door.'
+        block.save()
+        self.take.content = 'Grab the key'
+        self.take.save()
+        Game.objects.get(pk=self.game.pk).publish()
+
+        session = Session.objects.get(pk=session.pk)
+        self.assertEqual(self.texts(session), ['A locked door.', 'Take the key'])
+
+        session.finish_game()
+        session.archive_gamelogs()
+        self.assertEqual(
+            [gamelog.text for gamelog in session.iter_archived_gamelogs()],
+            ['A locked door.', 'Take the key']
+        )
+
+    def test_draft_sessions_store_the_text(self):
+        session = self.play()
+        Block.objects.filter(game=self.game, order=1).delete()
+
+        session = Session.objects.get(pk=session.pk)
+        self.assertFalse(any(gamelog.is_compact for gamelog in session.gamelogs.all()))
+        self.assertEqual(self.texts(session), ['A locked door.', 'Take the key'])
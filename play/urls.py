@@ -1,9 +1,17 @@
 from django.urls import path
-from play.views import PlayView
+from play.views import CatalogueView, PlayView, GamelogView
 
 urlpatterns = [
+    path(
+        '',
+        CatalogueView.as_view(), name="game_catalogue"
+    ),
     path(
         'g<int:game_pk>/',
         PlayView.as_view(), name="game_play"
     ),
+    path(
+        'g<int:game_pk>/log/',
+        GamelogView.as_view(), name="game_play_log"
+    ),
 ]
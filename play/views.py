@@ -1,10 +1,34 @@
-from django.shortcuts import redirect
+from django.contrib.auth.mixins import LoginRequiredMixin
+from django.http import HttpResponseBadRequest, StreamingHttpResponse
+from django.shortcuts import redirect, get_object_or_404
 from django.urls import reverse
-from game.views.game import GameDetailView
+from django.utils.dateformat import format as date_format
+from django.views import View
+from django.views.generic import TemplateView
+from django.views.generic.detail import DetailView
+from game.catalogue import get_catalogue
+from game.models import Game
+from play.models import Session
 
 
-class PlayView(GameDetailView):
+class CatalogueView(TemplateView):
+    """Published games, see game.catalogue."""
+    template_name = 'play/list.html'
+
+    def get_context_data(self, **kwargs):
+        page = get_catalogue().get_page(self.request.GET.get('page'))
+        context = {
+            'page_obj': page,
+            'object_list': page.object_list,
+        }
+        context.update(kwargs)
+        return super().get_context_data(**context)
+
+
+class PlayView(LoginRequiredMixin, DetailView):
     template_name = 'play/detail.html'
+    model = Game
+    pk_url_kwarg = 'game_pk'
     game_session = None
 
     def get_session(self):
@@ -14,8 +38,11 @@ class PlayView(GameDetailView):
         return self.game_session
 
     def get_context_data(self, **kwargs):
+        session = self.get_session()
         context = {
-            'session': self.get_session()
+            'session': session,
+            'game_data': session.get_game_data(),
+            'gamelogs': session.get_gamelog_window(),
         }
         context.update(kwargs)
         return super().get_context_data(**context)
@@ -36,3 +63,37 @@ class PlayView(GameDetailView):
 
         context = self.get_context_data(object=self.object)
         return self.render_to_response(context)
+
+
+class GamelogView(LoginRequiredMixin, View):
+    """Whole game log of the active session as plain text, streamed."""
+
+    def get(self, request, game_pk):
+        session = get_object_or_404(
+            Session,
+            game_id=game_pk,
+            user=request.user,
+            status=Session.STATUS_ACTIVE
+        )
+
+        before = None
+        before_pk = request.GET.get('before')
+        if before_pk:
+            try:
+                before_pk = int(before_pk)
+            except ValueError:
+                return HttpResponseBadRequest()
+            before = get_object_or_404(session.gamelogs, pk=before_pk)
+
+        return StreamingHttpResponse(
+            self.render_lines(session.iter_gamelogs(before=before)),
+            content_type='text/plain; charset=utf-8'
+        )
+
+    def render_lines(self, gamelogs):
+        for gamelog in gamelogs:
+            yield "%s, %s\n%s\n\n" % (
+                date_format(gamelog.created_at, "d.m.Y H:i:s"),
+                gamelog.get_source_display(),
+                gamelog.text
+            )
@@ -0,0 +1 @@
+default_app_config = 'telegrambot.apps.TelegrambotConfig'
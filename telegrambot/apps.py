@@ -3,3 +3,7 @@ from django.apps import AppConfig
 
 class TelegrambotConfig(AppConfig):
     name = 'telegrambot'
+
+    def ready(self):
+        import telegrambot.signals  # noqa
+        import telegrambot.router  # noqa
@@ -1,40 +1,176 @@
+"""
+Two-tier model cache: a small per-process LRU in front of the django cache.
+
+Keys carry a schema version computed from the model fields, so a deploy
+that changes a model never unpickles old instances. Missing rows are cached
+too (negative caching) and raise `DoesNotExist` without a query.
+
+Saving or deleting a Bot drops its entry (see telegrambot.signals); other
+processes may serve their local copy for TELEGRAMBOT_LOCAL_CACHE_TIMEOUT
+seconds more. Hit and miss counters are published by the metrics view.
+"""
+import hashlib
+import threading
+import time
+from collections import Counter, defaultdict
+
+from django.conf import settings
 from django.core.cache import cache
 
+from gamebook import metrics
+from gamebook.lru import LRUCache
+
+
+# Bump to drop every cached object regardless of model changes
+SCHEMA_VERSION = 1
+
+DOES_NOT_EXIST = '__telegrambot.caching.does_not_exist__'
+_MISSING = object()
+
+_local = LRUCache(
+    maxsize=getattr(settings, 'TELEGRAMBOT_LOCAL_CACHE_SIZE', 1024)
+)
+
+_stats = defaultdict(Counter)
+_stats_lock = threading.Lock()
+
+_versions = {}
+
+
+def model_version(model):
+    version = _versions.get(model)
+    if version is None:
+        fields = ",".join(
+            "%s:%s" % (f.attname, f.get_internal_type())
+            for f in model._meta.concrete_fields
+        )
+        version = hashlib.md5(
+            ("%s|%s" % (SCHEMA_VERSION, fields)).encode('utf-8')
+        ).hexdigest()[:8]
+        _versions[model] = version
+    return version
+
 
 def generate_key(model, pk, related=None):
     if related:
-        return '{}.{}.{}-{}'.format(model._meta.app_label, model._meta.model_name, related, pk)
-    return '{}.{}-{}'.format(model._meta.app_label, model._meta.model_name, pk)
+        key = '{}.{}.{}-{}'.format(model._meta.app_label, model._meta.model_name, related, pk)
+    else:
+        key = '{}.{}-{}'.format(model._meta.app_label, model._meta.model_name, pk)
+    return '{}:{}'.format(key, model_version(model))
+
+
+def get_timeout(model):
+    timeouts = getattr(settings, 'TELEGRAMBOT_CACHE_TIMEOUTS', {})
+    return timeouts.get(
+        model._meta.label_lower,
+        getattr(settings, 'TELEGRAMBOT_CACHE_TIMEOUT', 60 * 60)
+    )
+
+
+def _count(model, event):
+    with _stats_lock:
+        _stats[model._meta.label_lower][event] += 1
+    if event == 'misses':
+        metrics.cache_miss(model._meta.label_lower)
+    else:
+        metrics.cache_hit(model._meta.label_lower)
+
+
+def get_stats():
+    """{model label: {'local_hits': n, 'hits': n, 'misses': n}}"""
+    with _stats_lock:
+        return {label: dict(counter) for label, counter in _stats.items()}
+
+
+@metrics.collector
+def collect_stats():
+    return [(
+        'gamebook_telegrambot_cache_total', 'counter',
+        "Lookups of the telegram model cache by result",
+        [
+            ({'model': label, 'result': result}, count)
+            for label, counter in sorted(get_stats().items())
+            for result, count in sorted(counter.items())
+        ]
+    )]
+
+
+def _load(model, key):
+    entry = _local.get(key)
+    if entry is not None:
+        value, expires_at = entry
+        if expires_at > time.time():
+            _count(model, 'local_hits')
+            return value
+        _local.delete(key)
+
+    value = cache.get(key, _MISSING)
+    if value is not _MISSING:
+        _count(model, 'hits')
+        _store_local(key, value)
+        return value
+
+    _count(model, 'misses')
+    return _MISSING
+
+
+def _store_local(key, value):
+    _local.set(key, (
+        value,
+        time.time() + getattr(settings, 'TELEGRAMBOT_LOCAL_CACHE_TIMEOUT', 60)
+    ))
+
+
+def _store(model, key, value, timeout=None):
+    if timeout is None:
+        timeout = get_timeout(model)
+    cache.set(key, value, timeout)
+    _store_local(key, value)
 
 
 def get_or_set(model, pk):
     key = generate_key(model, pk)
-    obj = cache.get(key)
-    if not obj:
-        obj = model.objects.get(pk=pk)
-        cache.set(key, obj)
+    obj = _load(model, key)
+    if obj is _MISSING:
+        try:
+            obj = model.objects.get(pk=pk)
+        except model.DoesNotExist:
+            _store(
+                model, key, DOES_NOT_EXIST,
+                getattr(settings, 'TELEGRAMBOT_NEGATIVE_CACHE_TIMEOUT', 60)
+            )
+            raise
+        _store(model, key, obj)
+    if obj == DOES_NOT_EXIST:
+        raise model.DoesNotExist(
+            "%s matching pk %s does not exist" % (model._meta.object_name, pk)
+        )
     return obj
 
 
 def get(model, pk):
-    key = generate_key(model, pk)
-    return cache.get(key)
+    obj = _load(model, generate_key(model, pk))
+    if obj is _MISSING or obj == DOES_NOT_EXIST:
+        return None
+    return obj
 
 
 def delete(model, instance, related=None):
     key = generate_key(model, instance.pk, related)
+    _local.delete(key)
     cache.delete(key)
 
 
 def set(obj):
-    key = generate_key(obj._meta.model, obj.pk)
-    cache.set(key, obj)
+    model = obj._meta.model
+    _store(model, generate_key(model, obj.pk), obj)
 
 
 def get_or_set_related(instance, related, *args):
-    key = generate_key(instance._meta.model, instance.pk, related)
-    objs = cache.get(key)
-    if objs is None:
-        objs = getattr(instance, related).select_related(*args).all()
-        cache.set(key, objs)
-    return objs
\ No newline at end of file
+    model = instance._meta.model
+    key = generate_key(model, instance.pk, related)
+    objs = _load(model, key)
+    if objs is _MISSING:
+        objs = list(getattr(instance, related).select_related(*args).all())
+        _store(model, key, objs)
+    return objs
@@ -0,0 +1,170 @@
+"""
+Per-chat ordered queue of incoming updates.
+
+Updates are kept in a redis sorted set per (bot, chat) scored by telegram
+`update_id`. One worker at a time drains a chat (see `tasks.drain_chat`),
+so updates of a chat are handled one by one in order while different
+chats are handled in parallel.
+
+An item whose handler fails stays in the queue with its attempt counted,
+draining stops there and `RetryLater` tells when to try again
+(TELEGRAMBOT_UPDATE_RETRY_DELAY seconds, doubled on every attempt). After
+TELEGRAMBOT_UPDATE_MAX_ATTEMPTS attempts the item is dropped.
+"""
+import json
+import logging
+
+from django.conf import settings
+from django_redis import get_redis_connection
+
+
+logger = logging.getLogger(__name__)
+
+
+BATCH_SIZE = 50
+
+
+class RetryLater(Exception):
+    """A queued item failed, the chat should be drained again after `delay` seconds."""
+
+    def __init__(self, delay):
+        super().__init__(delay)
+        self.delay = delay
+
+
+def queue_key(bot_id, chat_id):
+    return 'telegrambot.chatqueue-{}-{}'.format(bot_id, chat_id)
+
+
+def chat_id_from_data(update_data):
+    if 'message' in update_data:
+        return update_data['message']['chat']['id']
+    if 'callback_query' in update_data:
+        callback_query = update_data['callback_query']
+        if 'message' in callback_query:
+            return callback_query['message']['chat']['id']
+        return callback_query['from']['id']
+    return None
+
+
+def chat_id_from_update(update):
+    if update.message_id:
+        return update.message.chat_id
+    if update.callback_query_id and update.callback_query.message_id:
+        return update.callback_query.message.chat_id
+    if update.callback_query_id:
+        return update.callback_query.from_user_id
+    return None
+
+
+def push(bot_id, chat_id, update_id, item):
+    """
+    Put an item to the chat queue. `item` is a dict, either
+    {'data': raw update json} or {'pk': saved Update pk}.
+    """
+    item = dict(item, update_id=update_id)
+    get_redis_connection().zadd(
+        queue_key(bot_id, chat_id),
+        update_id,
+        json.dumps(item, sort_keys=True)
+    )
+
+
+def _callback_signature(item):
+    """(message id, data) of a callback press, None for anything else."""
+    data = item.get('data')
+    if not data or 'callback_query' not in data:
+        return None
+    callback_query = data['callback_query']
+    message = callback_query.get('message')
+    if not message:
+        return None
+    return message['message_id'], callback_query.get('data')
+
+
+def coalesce(items):
+    """
+    Drop repeated presses of the same button: of several consecutive
+    identical callback queries only the first one is handled.
+    """
+    result = []
+    previous = None
+    for item in items:
+        signature = _callback_signature(item)
+        if signature is not None and signature == previous:
+            logger.debug("Coalesced update %s" % item['update_id'])
+            continue
+        previous = signature
+        result.append(item)
+    return result
+
+
+def requeue(conn, key, member, item):
+    """
+    Put a failed item back with one more attempt counted. Returns seconds
+    to wait before the next attempt, None if the item was dropped.
+    """
+    attempts = item.get('attempts', 0) + 1
+    retry = attempts < getattr(settings, 'TELEGRAMBOT_UPDATE_MAX_ATTEMPTS', 5)
+
+    pipe = conn.pipeline()
+    pipe.zrem(key, member)
+    if retry:
+        pipe.zadd(
+            key,
+            item['update_id'],
+            json.dumps(dict(item, attempts=attempts), sort_keys=True)
+        )
+    pipe.execute()
+
+    if not retry:
+        return None
+    delay = getattr(settings, 'TELEGRAMBOT_UPDATE_RETRY_DELAY', 1) * 2 ** (attempts - 1)
+    return min(delay, getattr(settings, 'TELEGRAMBOT_UPDATE_MAX_RETRY_DELAY', 300))
+
+
+def drain(bot_id, chat_id, handler):
+    """
+    Handle queued items of a chat in update_id order until the queue is
+    empty. Must be called under a per-chat lock. Raises RetryLater when
+    an item failed and was put back.
+    """
+    conn = get_redis_connection()
+    key = queue_key(bot_id, chat_id)
+    handled = 0
+
+    while True:
+        members = conn.zrange(key, 0, BATCH_SIZE - 1)
+        if not members:
+            return handled
+
+        items = [json.loads(member.decode('utf-8')) for member in members]
+        kept = {id(item) for item in coalesce(items)}
+        done = []
+        try:
+            for member, item in zip(members, items):
+                if id(item) in kept:
+                    try:
+                        handler(item)
+                    except Exception:
+                        logger.exception(
+                            "Error handling update %s of chat %s for bot %s" %
+                            (item['update_id'], chat_id, bot_id)
+                        )
+                        delay = requeue(conn, key, member, item)
+                        if delay is not None:
+                            raise RetryLater(delay)
+                        logger.error(
+                            "Update %s of chat %s for bot %s dropped after %s attempts" %
+                            (item['update_id'], chat_id, bot_id, item.get('attempts', 0) + 1)
+                        )
+                        continue
+                    handled += 1
+                done.append(member)
+        finally:
+            if done:
+                conn.zrem(key, *done)
+
+
+def is_empty(bot_id, chat_id):
+    return not get_redis_connection().zcard(queue_key(bot_id, chat_id))
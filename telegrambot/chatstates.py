@@ -0,0 +1,111 @@
+"""
+Chat state store.
+
+There is one ChatState per (chat, user). The state is loaded once per
+handled update and saved only when it changed.
+
+With TELEGRAMBOT_CHAT_STATE_REDIS states of active chats live in redis
+and are written back to the database by the periodic
+`tasks.flush_chat_states` task (write-behind).
+"""
+import json
+import logging
+
+from django.conf import settings
+from django.utils import timezone
+from django_redis import get_redis_connection
+
+from .models import ChatState
+
+
+logger = logging.getLogger(__name__)
+
+
+DIRTY_KEY = 'telegrambot.chatstate-dirty'
+
+
+def use_redis():
+    return getattr(settings, 'TELEGRAMBOT_CHAT_STATE_REDIS', False)
+
+
+def state_key(chat_id, user_id):
+    return 'telegrambot.chatstate-{}-{}'.format(chat_id, user_id)
+
+
+def _from_redis(chat, user):
+    raw = get_redis_connection().get(state_key(chat.id, user.id))
+    if raw is None:
+        return None
+    data = json.loads(raw.decode('utf-8'))
+    chat_state = ChatState(
+        pk=data['pk'], chat=chat, user=user,
+        state=data['state'], context=data['context']
+    )
+    chat_state._state.adding = False
+    return chat_state
+
+
+def _to_redis(chat_state):
+    conn = get_redis_connection()
+    pipe = conn.pipeline()
+    pipe.setex(
+        state_key(chat_state.chat_id, chat_state.user_id),
+        getattr(settings, 'TELEGRAMBOT_CHAT_STATE_REDIS_TIMEOUT', 60 * 60 * 24),
+        json.dumps({
+            'pk': chat_state.pk,
+            'state': chat_state.state,
+            'context': chat_state.context,
+        })
+    )
+    pipe.sadd(DIRTY_KEY, state_key(chat_state.chat_id, chat_state.user_id))
+    pipe.execute()
+
+
+def get_chat_state(chat, user):
+    """ChatState of the user in the chat, created in the menu state if missing."""
+    chat_state = _from_redis(chat, user) if use_redis() else None
+    if chat_state is None:
+        chat_state, created = ChatState.objects.get_or_create(
+            chat_id=chat.id,
+            user_id=user.id,
+            defaults={'state': ChatState.STATE_MENU}
+        )
+        chat_state.chat = chat
+        chat_state.user = user
+    chat_state.mark_clean()
+    return chat_state
+
+
+def save_chat_state(chat_state):
+    if not chat_state.is_dirty:
+        return
+    chat_state.ctx = chat_state.ctx
+    if use_redis():
+        _to_redis(chat_state)
+    else:
+        chat_state.save(update_fields=['state', 'context', 'updated_at'])
+    chat_state.mark_clean()
+
+
+def flush_chat_states(batch_size=500):
+    """Write chat states changed in redis back to the database."""
+    conn = get_redis_connection()
+    total = 0
+    while True:
+        pipe = conn.pipeline()
+        for i in range(batch_size):
+            pipe.spop(DIRTY_KEY)
+        keys = [key for key in pipe.execute() if key is not None]
+        if not keys:
+            return total
+        now = timezone.now()
+        for raw in conn.mget(keys):
+            if raw is None:
+                continue
+            data = json.loads(raw.decode('utf-8'))
+            ChatState.objects.filter(pk=data['pk']).update(
+                state=data['state'],
+                context=data['context'],
+                updated_at=now
+            )
+            total += 1
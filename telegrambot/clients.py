@@ -0,0 +1,35 @@
+"""
+Process-wide registry of telegram API clients.
+
+One `telegram.Bot` per token, created on first use and shared by all
+threads. Each client has its own pooled HTTP connection, so outgoing calls
+reuse keep-alive connections.
+"""
+import threading
+
+import telegram
+from django.conf import settings
+from telegram.utils.request import Request
+
+
+_clients = {}
+_lock = threading.Lock()
+
+
+def get_client(token):
+    client = _clients.get(token)
+    if client is None:
+        with _lock:
+            client = _clients.get(token)
+            if client is None:
+                client = telegram.Bot(
+                    token,
+                    request=Request(
+                        con_pool_size=getattr(
+                            settings, 'TELEGRAMBOT_CONNECTION_POOL_SIZE', 8
+                        )
+                    )
+                )
+                _clients[token] = client
+    return client
+
@@ -0,0 +1,180 @@
+"""
+Bot commands, see telegrambot.router.
+
+Menu:
+    /games - список квестов на боте
+    /my - список активных квестов чувака
+In game:
+    /exit - back to the menu, the session stays active
+    /finish - finish the session
+"""
+from game.models import Game
+from play.models import Session
+
+from .keyboards import PREFIX_ACTION, PREFIX_GAME, PREFIX_GAMES_PAGE, PREFIX_SESSION, games_keyboard
+from .models import ChatState
+from .router import encode_callback, router
+
+
+def _site_user(bot, update):
+    chat, user = bot._get_chat_and_user(update)
+    if user.site_user_id is None:
+        bot.send_message(
+            chat.id,
+            "Привяжите telegram к аккаунту на сайте, чтобы играть",
+            None,
+            update
+        )
+    return user.site_user_id
+
+
+def _show_game(bot, update, chat_state, session):
+    chat, user = bot._get_chat_and_user(update)
+    chat_state.state = ChatState.STATE_GAME
+    chat_state.ctx.session_id = session.pk
+
+    game_data = session.get_game_data()
+    response_message = ""
+    response_keyboard_row = []
+    for idx, action in enumerate(game_data.actions, 1):
+        response_message += "{}. {}\n\n".format(idx, action["content"])
+        response_keyboard_row.append((str(idx), encode_callback(PREFIX_ACTION, action["id"])))
+
+    bot.send_message(
+        chat.id,
+        "<b>{}</b>:\n\n{}<!--next-->{}".format(
+            session.game.name, game_data.vision, response_message or "..."
+        ),
+        bot.build_keyboard([response_keyboard_row]) if response_keyboard_row else None,
+        update
+    )
+
+
+def _to_menu(chat_state):
+    chat_state.state = ChatState.STATE_MENU
+    chat_state.ctx.session_id = None
+
+
+@router.command(None, '/start', '/games')
+def show_games(bot, update, chat_state):
+    chat, user = bot._get_chat_and_user(update)
+    _to_menu(chat_state)
+    chat_state.ctx.section = "games"
+    chat_state.ctx.page = 1
+    response_message, keyboard = games_keyboard(bot)
+    bot.send_message(chat.id, response_message, keyboard)
+
+
+@router.callback(None, PREFIX_GAMES_PAGE)
+def show_games_page(bot, update, chat_state, page=None):
+    chat, user = bot._get_chat_and_user(update)
+    try:
+        page = int(page)
+    except (TypeError, ValueError):
+        page = 1
+    _to_menu(chat_state)
+    chat_state.ctx.section = "games"
+    chat_state.ctx.page = page
+    response_message, keyboard = games_keyboard(bot, page)
+    bot.send_message(chat.id, response_message, keyboard, update)
+
+
+@router.command(None, '/my')
+def show_sessions(bot, update, chat_state):
+    chat, user = bot._get_chat_and_user(update)
+    site_user_id = _site_user(bot, update)
+    if site_user_id is None:
+        return
+
+    _to_menu(chat_state)
+    chat_state.ctx.section = "my"
+    response_message = "Ваши активные квесты:\n"
+    response_keyboard_row = []
+    sessions = Session.objects.filter(
+        user_id=site_user_id, status=Session.STATUS_ACTIVE
+    ).select_related('game')
+    for idx, session in enumerate(sessions, 1):
+        response_message += "{}. <b>{}</b>\n".format(idx, session.game.name)
+        response_keyboard_row.append((str(idx), encode_callback(PREFIX_SESSION, session.pk)))
+    bot.send_message(
+        chat.id,
+        response_message,
+        bot.build_keyboard([response_keyboard_row]) if response_keyboard_row else None
+    )
+
+
+@router.callback(None, PREFIX_GAME)
+def start_game(bot, update, chat_state, game_id=None):
+    chat, user = bot._get_chat_and_user(update)
+    site_user_id = _site_user(bot, update)
+    if site_user_id is None:
+        return
+
+    try:
+        game = Game.objects.get(pk=game_id, status=Game.STATUS_PUBLISHED)
+    except (Game.DoesNotExist, ValueError):
+        bot.send_message(chat.id, "Квест не найден :(", None, update)
+        return
+
+    _show_game(bot, update, chat_state, game.get_user_game(user.site_user))
+
+
+@router.callback(None, PREFIX_SESSION)
+def resume_session(bot, update, chat_state, session_id=None):
+    chat, user = bot._get_chat_and_user(update)
+    site_user_id = _site_user(bot, update)
+    if site_user_id is None:
+        return
+
+    try:
+        session = Session.objects.select_related('game', 'active_character').get(
+            pk=session_id, user_id=site_user_id, status=Session.STATUS_ACTIVE
+        )
+    except (Session.DoesNotExist, ValueError):
+        bot.send_message(chat.id, "Сессия не найдена :(", None, update)
+        return
+
+    _show_game(bot, update, chat_state, session)
+
+
+def _current_session(bot, update, chat_state):
+    chat, user = bot._get_chat_and_user(update)
+    try:
+        return Session.objects.select_related('game', 'active_character').get(
+            pk=chat_state.ctx.session_id,
+            user_id=user.site_user_id,
+            status=Session.STATUS_ACTIVE
+        )
+    except Session.DoesNotExist:
+        _to_menu(chat_state)
+        bot.send_message(chat.id, "Сессия не найдена :(", None, update)
+        return None
+
+
+@router.callback(ChatState.STATE_GAME, PREFIX_ACTION)
+def do_action(bot, update, chat_state, action_id=None):
+    session = _current_session(bot, update, chat_state)
+    if session is None:
+        return
+
+    session.active_character.do_action(action_id)
+    _show_game(bot, update, chat_state, session)
+
+
+@router.command(ChatState.STATE_GAME, '/exit')
+def exit_game(bot, update, chat_state):
+    chat, user = bot._get_chat_and_user(update)
+    _to_menu(chat_state)
+    bot.send_message(chat.id, "Вы вышли в меню: /games, /my")
+
+
+@router.command(ChatState.STATE_GAME, '/finish')
+def finish_game(bot, update, chat_state):
+    chat, user = bot._get_chat_and_user(update)
+    session = _current_session(bot, update, chat_state)
+    if session is None:
+        return
+
+    session.finish_game()
+    _to_menu(chat_state)
+    bot.send_message(chat.id, "Квест завершён: /games, /my")
@@ -0,0 +1,294 @@
+import logging
+from datetime import datetime
+
+from django.conf import settings
+from django.core.cache import cache
+from django.db import connection, transaction
+from django.utils import timezone
+
+import telegrambot.caching as caching
+from .models import User, Chat, Message, Update, CallbackQuery
+
+
+logger = logging.getLogger(__name__)
+
+
+USER_FIELDS = ('id', 'first_name', 'last_name', 'username', 'is_bot', 'language_code')
+CHAT_FIELDS = ('id', 'type', 'title', 'username', 'first_name', 'last_name')
+
+
+class OnlyTextMessages(Exception):
+    pass
+
+
+def _pick(data, fields):
+    """Known fields of a telegram object, telegram adds new ones over time."""
+    return {field: data.get(field) for field in fields if field in data}
+
+
+def _timestamp(value):
+    return datetime.fromtimestamp(value, tz=timezone.utc)
+
+
+def parse_update(update_data, bot):
+    """
+    Build unsaved User/Chat/Message/CallbackQuery/Update instances
+    from update json.
+    """
+    users = {}
+
+    def user(data):
+        instance = users.get(data['id'])
+        if instance is None:
+            instance = users[data['id']] = User(**_pick(data, USER_FIELDS))
+        return instance
+
+    def message(data):
+        return Message(
+            message_id=data['message_id'],
+            from_user=user(data['from']),
+            date=_timestamp(data['date']),
+            chat=Chat(**_pick(data['chat'], CHAT_FIELDS)),
+            text=data.get('text'),
+            bot=bot
+        )
+
+    update = Update(bot=bot, update_id=update_data['update_id'])
+
+    if 'message' in update_data:
+        if 'text' not in update_data['message']:
+            raise OnlyTextMessages
+        update.message = message(update_data['message'])
+    elif 'callback_query' in update_data:
+        callback_data = update_data['callback_query']
+        update.callback_query = CallbackQuery(
+            callback_id=callback_data['id'],
+            from_user=user(callback_data['from']),
+            # Message may be not present if it is very old
+            message=(
+                message(callback_data['message'])
+                if 'message' in callback_data else None
+            ),
+            data=callback_data.get('data')
+        )
+    else:
+        logger.error("Not valid message %s" % update_data)
+        raise OnlyTextMessages
+
+    return update, list(users.values())
+
+
+def _values(rows):
+    return ", ".join(
+        "(%s)" % ", ".join(["%s"] * len(row)) for row in rows
+    )
+
+
+def _upsert_postgresql(update, users):
+    """
+    Write users, chat, message, callback query and update with one
+    statement of data-modifying CTEs. Telegram objects are upserted,
+    so changed names and usernames are saved.
+    """
+    now = timezone.now()
+    message = update.message or (
+        update.callback_query.message if update.callback_query else None
+    )
+    ctes = []
+    params = []
+
+    rows = [[getattr(u, f) for f in USER_FIELDS] for u in users]
+    ctes.append(
+        "u AS (INSERT INTO {table} ({columns}) VALUES {values} "
+        "ON CONFLICT (id) DO UPDATE SET {updates} RETURNING id)".format(
+            table=User._meta.db_table,
+            columns=", ".join(USER_FIELDS),
+            values=_values(rows),
+            updates=", ".join(
+                "%s = EXCLUDED.%s" % (f, f) for f in USER_FIELDS[1:]
+            )
+        )
+    )
+    for row in rows:
+        params.extend(row)
+
+    if message:
+        chat = message.chat
+        ctes.append(
+            "c AS (INSERT INTO {table} ({columns}) VALUES {values} "
+            "ON CONFLICT (id) DO UPDATE SET {updates} RETURNING id)".format(
+                table=Chat._meta.db_table,
+                columns=", ".join(CHAT_FIELDS),
+                values=_values([CHAT_FIELDS]),
+                updates=", ".join(
+                    "%s = EXCLUDED.%s" % (f, f) for f in CHAT_FIELDS[1:]
+                )
+            )
+        )
+        params.extend(getattr(chat, f) for f in CHAT_FIELDS)
+
+        ctes.append(
+            "m AS (INSERT INTO {table} (created_at, updated_at, message_id, "
+            "from_user_id, date, chat_id, bot_id, text) "
+            "VALUES (%s, %s, %s, %s, %s, %s, %s, %s) "
+            "ON CONFLICT (chat_id, bot_id, message_id) DO UPDATE SET "
+            "text = EXCLUDED.text, updated_at = EXCLUDED.updated_at "
+            "RETURNING id)".format(table=Message._meta.db_table)
+        )
+        params.extend([
+            now, now, message.message_id, message.from_user.id,
+            message.date, chat.id, update.bot.pk, message.text
+        ])
+
+    if update.callback_query:
+        callback_query = update.callback_query
+        ctes.append(
+            "q AS (INSERT INTO {table} (created_at, updated_at, callback_id, "
+            "from_user_id, message_id, data) "
+            "SELECT %s, %s, %s, %s, {message_id}, %s {source} "
+            "ON CONFLICT (callback_id) DO UPDATE SET "
+            "data = EXCLUDED.data, updated_at = EXCLUDED.updated_at "
+            "RETURNING id)".format(
+                table=CallbackQuery._meta.db_table,
+                message_id="m.id" if message else "NULL",
+                source="FROM m" if message else ""
+            )
+        )
+        params.extend([
+            now, now, callback_query.callback_id,
+            callback_query.from_user.id, callback_query.data
+        ])
+        update_message, update_callback, source = "NULL", "q.id", "FROM q"
+    else:
+        update_message, update_callback, source = "m.id", "NULL", "FROM m"
+
+    ctes.append(
+        "up AS (INSERT INTO {table} (created_at, updated_at, bot_id, "
+        "update_id, message_id, callback_query_id) "
+        "SELECT %s, %s, %s, %s, {message_id}, {callback_query_id} {source} "
+        "ON CONFLICT (update_id, bot_id) DO UPDATE SET "
+        "updated_at = EXCLUDED.updated_at RETURNING id)".format(
+            table=Update._meta.db_table,
+            message_id=update_message,
+            callback_query_id=update_callback,
+            source=source
+        )
+    )
+    params.extend([now, now, update.bot.pk, update.update_id])
+
+    sql = "WITH {ctes} SELECT up.id, {message_id}, {callback_query_id} FROM up".format(
+        ctes=", ".join(ctes),
+        message_id="(SELECT id FROM m)" if message else "NULL",
+        callback_query_id="(SELECT id FROM q)" if update.callback_query else "NULL"
+    )
+
+    with connection.cursor() as cursor:
+        cursor.execute(sql, params)
+        update.pk, message_pk, callback_query_pk = cursor.fetchone()
+
+    if message:
+        message.pk = message_pk
+    if update.callback_query:
+        update.callback_query.pk = callback_query_pk
+
+    for instance in [update, message, update.callback_query] + users:
+        if instance is not None:
+            instance._state.adding = False
+            if hasattr(instance, 'created_at'):
+                instance.created_at = instance.updated_at = now
+
+
+def _upsert_orm(update, users):
+    for user in users:
+        User.objects.update_or_create(
+            id=user.id,
+            defaults=_pick(user.__dict__, USER_FIELDS[1:])
+        )
+
+    message = update.message or (
+        update.callback_query.message if update.callback_query else None
+    )
+    if message:
+        Chat.objects.update_or_create(
+            id=message.chat.id,
+            defaults=_pick(message.chat.__dict__, CHAT_FIELDS[1:])
+        )
+        message.pk = Message.objects.update_or_create(
+            chat_id=message.chat.id,
+            bot_id=update.bot.pk,
+            message_id=message.message_id,
+            defaults={
+                'from_user_id': message.from_user.id,
+                'date': message.date,
+                'text': message.text,
+            }
+        )[0].pk
+
+    if update.callback_query:
+        callback_query = update.callback_query
+        callback_query.pk = CallbackQuery.objects.update_or_create(
+            callback_id=callback_query.callback_id,
+            defaults={
+                'from_user_id': callback_query.from_user.id,
+                'message_id': message.pk if message else None,
+                'data': callback_query.data,
+            }
+        )[0].pk
+
+    update.pk = Update.objects.get_or_create(
+        bot=update.bot,
+        update_id=update.update_id,
+        defaults={
+            'message_id': update.message.pk if update.message else None,
+            'callback_query_id': (
+                update.callback_query.pk if update.callback_query else None
+            ),
+        }
+    )[0].pk
+
+
+def create_update(update_data, bot):
+    """
+    Save update json as telegrambot models in one transaction and return
+    the Update with its related objects already attached.
+    On PostgreSQL all rows are written in a single round trip.
+    """
+    update, users = parse_update(update_data, bot)
+
+    with transaction.atomic():
+        if connection.vendor == 'postgresql':
+            _upsert_postgresql(update, users)
+        else:
+            _upsert_orm(update, users)
+
+    # Foreign key ids were copied when the instances had no pk yet
+    update.message = update.message
+    if update.callback_query:
+        update.callback_query.message = update.callback_query.message
+    update.callback_query = update.callback_query
+
+    for user in users:
+        caching.set(user)
+    caching.set(update)
+    return update
+
+
+def dedup_key(bot_id, update_id):
+    return 'telegrambot.update-seen-{}-{}'.format(bot_id, update_id)
+
+
+def claim_update(bot_id, update_id):
+    """
+    True the first time an update is seen. Telegram retries webhooks,
+    the same update may come several times.
+    """
+    return cache.add(
+        dedup_key(bot_id, update_id),
+        1,
+        getattr(settings, 'TELEGRAMBOT_UPDATE_DEDUP_TIMEOUT', 60 * 60 * 24)
+    )
+
+
+def release_update(bot_id, update_id):
+    """Forget a claimed update, so a webhook retry is handled again."""
+    cache.delete(dedup_key(bot_id, update_id))
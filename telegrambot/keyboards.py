@@ -0,0 +1,54 @@
+"""
+Keyboards shared by all chats.
+
+The published games list looks the same for everybody, so its pages are
+built once and reused until the catalogue changes (see game.catalogue).
+"""
+from django.utils.text import Truncator
+
+from game.catalogue import get_catalogue
+from gamebook.lru import LRUCache
+
+from .router import encode_callback
+
+
+PREFIX_GAME, PREFIX_GAMES_PAGE, PREFIX_SESSION, PREFIX_ACTION = 'g', 'p', 's', 'a'
+
+
+_keyboards = LRUCache(maxsize=64)
+
+
+def games_keyboard(bot, page=1):
+    """(text, keyboard) for a page of published games."""
+    catalogue = get_catalogue()
+    key = ('games', catalogue.version, page)
+    cached = _keyboards.get(key)
+    if cached is None:
+        games = catalogue.get_page(page)
+        response_message = "Доступные квесты:\n"
+        response_keyboard_row = []
+        for idx, game in enumerate(games, games.start_index()):
+            response_message += "{}. <b>{}</b>\n{}\n".format(
+                idx, game.name, Truncator(game.description).chars(200)
+            )
+            response_keyboard_row.append((str(idx), encode_callback(PREFIX_GAME, game.pk)))
+        if not response_keyboard_row:
+            response_message += "ни одного квеста не нашли :("
+
+        keyboard = [response_keyboard_row] if response_keyboard_row else []
+        if games.paginator.num_pages > 1:
+            response_message += "\nСтраница {} из {}".format(games.number, games.paginator.num_pages)
+            navigation_row = []
+            if games.has_previous():
+                navigation_row.append(
+                    ("<", encode_callback(PREFIX_GAMES_PAGE, games.previous_page_number()))
+                )
+            if games.has_next():
+                navigation_row.append(
+                    (">", encode_callback(PREFIX_GAMES_PAGE, games.next_page_number()))
+                )
+            keyboard.append(navigation_row)
+
+        cached = (response_message, bot.build_keyboard(keyboard) if keyboard else None)
+        _keyboards.set(key, cached)
+    return cached
@@ -0,0 +1,81 @@
+# Generated by Django 2.0.4 on 2026-10-18 10:05
+
+from django.db import migrations, models
+from django.db.models import Count, Min, OuterRef, Subquery
+import django.db.models.deletion
+
+
+def set_message_bots(apps, schema_editor):
+    Message = apps.get_model('telegrambot', 'Message')
+    Update = apps.get_model('telegrambot', 'Update')
+
+    Message.objects.filter(bot__isnull=True).update(bot_id=Subquery(
+        Update.objects.filter(message=OuterRef('pk')).values('bot_id')[:1]
+    ))
+    Message.objects.filter(bot__isnull=True).update(bot_id=Subquery(
+        Update.objects.filter(callback_query__message=OuterRef('pk')).values('bot_id')[:1]
+    ))
+
+
+def remove_duplicates(apps, schema_editor):
+    """Keep the oldest row of each duplicate, updates and callbacks are moved to it."""
+    Message = apps.get_model('telegrambot', 'Message')
+    CallbackQuery = apps.get_model('telegrambot', 'CallbackQuery')
+    Update = apps.get_model('telegrambot', 'Update')
+
+    duplicates = list(
+        Message.objects.filter(bot__isnull=False)
+        .values('chat', 'bot', 'message_id')
+        .annotate(keep=Min('pk'), count=Count('pk'))
+        .filter(count__gt=1)
+    )
+    for row in duplicates:
+        others = Message.objects.filter(
+            chat_id=row['chat'], bot_id=row['bot'], message_id=row['message_id']
+        ).exclude(pk=row['keep'])
+        Update.objects.filter(message__in=others).update(message_id=row['keep'])
+        CallbackQuery.objects.filter(message__in=others).update(message_id=row['keep'])
+        others.delete()
+
+    duplicates = list(
+        CallbackQuery.objects.values('callback_id')
+        .annotate(keep=Min('pk'), count=Count('pk'))
+        .filter(count__gt=1)
+    )
+    for row in duplicates:
+        others = CallbackQuery.objects.filter(
+            callback_id=row['callback_id']
+        ).exclude(pk=row['keep'])
+        Update.objects.filter(callback_query__in=others).update(callback_query_id=row['keep'])
+        others.delete()
+
+    if schema_editor.connection.vendor == 'postgresql':
+        # deferred foreign key checks of the changed rows would block
+        # the ALTER TABLE statements below
+        schema_editor.execute('SET CONSTRAINTS ALL IMMEDIATE')
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('telegrambot', '0001_initial'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='message',
+            name='bot',
+            field=models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.CASCADE, related_name='messages', to='telegrambot.Bot', verbose_name='Bot'),
+        ),
+        migrations.RunPython(set_message_bots, migrations.RunPython.noop),
+        migrations.RunPython(remove_duplicates, migrations.RunPython.noop),
+        migrations.AlterField(
+            model_name='callbackquery',
+            name='callback_id',
+            field=models.CharField(max_length=255, unique=True, verbose_name='Id'),
+        ),
+        migrations.AlterUniqueTogether(
+            name='message',
+            unique_together={('chat', 'bot', 'message_id')},
+        ),
+    ]
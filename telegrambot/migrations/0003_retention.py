@@ -0,0 +1,36 @@
+# Generated by Django 2.0.4 on 2026-10-18 11:20
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('telegrambot', '0002_upsert_constraints'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='update',
+            name='callback_query',
+            field=models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='updates', to='telegrambot.CallbackQuery', verbose_name='Callback Query'),
+        ),
+        migrations.AlterField(
+            model_name='update',
+            name='message',
+            field=models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='updates', to='telegrambot.Message', verbose_name='Message'),
+        ),
+        migrations.AddIndex(
+            model_name='message',
+            index=models.Index(fields=['updated_at'], name='tg_message_updated_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='callbackquery',
+            index=models.Index(fields=['updated_at'], name='tg_callback_updated_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='update',
+            index=models.Index(fields=['updated_at'], name='tg_update_updated_idx'),
+        ),
+    ]
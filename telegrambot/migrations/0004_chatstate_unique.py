@@ -0,0 +1,31 @@
+# Generated by Django 2.0.4 on 2026-10-18 12:40
+
+from django.db import migrations
+from django.db.models import Count, Max
+
+
+def remove_duplicate_chat_states(apps, schema_editor):
+    ChatState = apps.get_model('telegrambot', 'ChatState')
+    duplicates = (
+        ChatState.objects.values('chat', 'user')
+        .annotate(count=Count('pk'), last_pk=Max('pk'))
+        .filter(count__gt=1)
+    )
+    for row in duplicates:
+        ChatState.objects.filter(chat=row['chat'], user=row['user']) \
+            .exclude(pk=row['last_pk']).delete()
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('telegrambot', '0003_retention'),
+    ]
+
+    operations = [
+        migrations.RunPython(remove_duplicate_chat_states, migrations.RunPython.noop),
+        migrations.AlterUniqueTogether(
+            name='chatstate',
+            unique_together={('chat', 'user')},
+        ),
+    ]
@@ -2,13 +2,18 @@ import uuid
 import telegram
 import json
 import ast
+import logging
 
 from django.db import models
 from django.conf import settings
 from django.urls import reverse
 from django.utils.translation import ugettext_lazy as _
 from telegrambot.utils import validate_token
-from game.models import Session, Game
+from telegrambot.clients import get_client
+from telegrambot import outbox
+
+
+logger = logging.getLogger(__name__)
 
 
 class User(models.Model):
@@ -54,6 +59,27 @@ class Chat(models.Model):
         return "%s" % (self.id)
 
 
+class ChatContext(object):
+    """Decoded ChatState context."""
+    __slots__ = ('section', 'session_id', 'page')
+
+    def __init__(self, section=None, session_id=None, page=None):
+        self.section = section
+        self.session_id = session_id
+        self.page = page
+
+    @classmethod
+    def from_json(cls, value):
+        data = json.loads(value) if value else {}
+        return cls(**{key: data[key] for key in cls.__slots__ if key in data})
+
+    def to_json(self):
+        return json.dumps(
+            {key: getattr(self, key) for key in self.__slots__},
+            sort_keys=True
+        )
+
+
 class ChatState(models.Model):
     STATE_MENU, STATE_GAME = 'menu', 'game'
     STATE_CHOICES = (
@@ -76,19 +102,32 @@ class ChatState(models.Model):
     class Meta:
         verbose_name = _('Telegram Chat State')
         verbose_name_plural = _('Telegram Chats States')
+        unique_together = ('chat', 'user')
 
     def _get_context(self):
-        if self.context:
-            return json.loads(self.context)
-        return {}
+        """Decoded once and kept on the instance, see ChatContext."""
+        ctx = self.__dict__.get('_ctx')
+        if ctx is None:
+            ctx = self._ctx = ChatContext.from_json(self.context)
+        return ctx
 
     def _set_context(self, value):
-        self.context = json.dumps(value)
+        if isinstance(value, dict):
+            value = ChatContext(**value)
+        self._ctx = value
+        self.context = value.to_json()
 
     ctx = property(_get_context, _set_context)
 
+    def mark_clean(self):
+        self._clean = (self.state, self.ctx.to_json())
+
+    @property
+    def is_dirty(self):
+        return self.__dict__.get('_clean') != (self.state, self.ctx.to_json())
+
     def __str__(self):
-        return "(%s:%s)" % (str(self.chat.id), self.state)
+        return "(%s:%s)" % (str(self.chat_id), self.state)
 
 
 class Bot(models.Model):
@@ -111,36 +150,35 @@ class Bot(models.Model):
         verbose_name = _('Telegram Bot')
         verbose_name_plural = _('Telegram Bots')
 
-    def __init__(self, *args, **kwargs):
-        super(Bot, self).__init__(*args, **kwargs)
-        self._bot = None
-        if self.token:
-            try:
-                self.init_bot()
-            except telegram.bot.InvalidToken:
-                raise Exception("Incorrect token %s" % self.token)
-
     def __str__(self):
         return "%s" % (self.user_api.first_name or self.token if self.user_api else self.token)
 
-    def init_bot(self):
-        self._bot = telegram.Bot(self.token)
+    @property
+    def api(self):
+        """Shared telegram API client, created on first use."""
+        try:
+            return get_client(self.token)
+        except telegram.error.InvalidToken:
+            raise Exception("Incorrect token %s" % self.token)
 
     @property
     def hook_url(self):
         return reverse('telegrambot_hook', args=(self.id, ))
 
     def set_webhook(self, url):
-        self._bot.set_webhook(url=url)
+        self.api.set_webhook(url=url)
 
     def _get_chat_and_user(self, update):
+        """
+        (None, None) if the update has no chat: its content was purged
+        (see telegrambot.retention) or a callback query came without the
+        message it belongs to.
+        """
         if update.message:
-            chat = update.message.chat
-            user = update.message.from_user
-        elif update.callback_query:
-            chat = update.callback_query.message.chat
-            user = update.callback_query.from_user
-        return chat, user
+            return update.message.chat, update.message.from_user
+        if update.callback_query and update.callback_query.message:
+            return update.callback_query.message.chat, update.callback_query.from_user
+        return None, None
 
     def message_text(self, message):
         if message.message:
@@ -149,14 +187,12 @@ class Bot(models.Model):
             return message.callback_query.data
 
     def get_chat_state(self, message):
+        from telegrambot.chatstates import get_chat_state
+
         chat, user = self._get_chat_and_user(message)
-        try:
-            return ChatState.objects.select_related('chat', 'user').get(
-                chat=chat,
-                user=user,
-            )
-        except ChatState.DoesNotExist:
+        if chat is None:
             return None
+        return get_chat_state(chat, user)
 
     def _create_keyboard_button(self, element):
         if isinstance(element, tuple):
@@ -176,148 +212,62 @@ class Bot(models.Model):
             keyboard_data_redy_to_built.append(row_data_redy_to_built)
         return telegram.InlineKeyboardMarkup(keyboard_data_redy_to_built)
 
-    def create_chat_state(self, message, target_state, context):
-        chat, user = self._get_chat_and_user(message)
-        return ChatState.objects.create(
-            chat=chat,
-            user=user,
-            state=target_state,
-            ctx=context
-        )
-
     def get_chat_id(self, message):
         chat, user = self._get_chat_and_user(message)
-        return chat.id
+        return chat.id if chat else None
 
     def send_message(self, chat_id, text, keyboard=None, update_message=None):
-        parse_mode = telegram.ParseMode.HTML
-        disable_web_page_preview = True
+        """
+        Queue a message for the chat, see telegrambot.outbox.
+        `<!--next-->` splits the text into several messages, the keyboard
+        goes with the last one. When answering a callback query the first
+        message replaces the pressed one.
+        """
         update_message_id = None
         if update_message:
             if update_message.callback_query:
                 update_message_id = update_message.callback_query.message.message_id
         texts = text.strip().split('<!--next-->')
-        msgs = []
-        for txt in texts:
-            msgs.append((txt, None))
-        if keyboard:
-            msgs[-1] = (msgs[-1][0], keyboard)
-
-        can_update = True
-        for msg in msgs:
-            if update_message_id and can_update:
-                self._bot.edit_message_text(
-                    chat_id=chat_id,
-                    message_id=update_message_id,
-                    text=msg[0],
-                    parse_mode=parse_mode,
-                    disable_web_page_preview=disable_web_page_preview,
-                    reply_markup=msg[1]
-                )
-                can_update = False
+
+        items = []
+        for idx, txt in enumerate(texts):
+            if idx == 0 and update_message_id:
+                items.append(outbox.make_item(
+                    outbox.METHOD_EDIT, txt, message_id=update_message_id
+                ))
             else:
-                self._bot.send_message(
-                    chat_id=chat_id,
-                    text=msg[0],
-                    parse_mode=parse_mode,
-                    disable_web_page_preview=disable_web_page_preview,
-                    reply_markup=msg[1]
-                )
+                items.append(outbox.make_item(outbox.METHOD_SEND, txt))
+        if keyboard:
+            items[-1]['reply_markup'] = keyboard.to_dict()
+
+        self.queue_messages(chat_id, items)
+
+    def remove_keyboard(self, chat_id, message_id):
+        self.queue_messages(chat_id, [
+            outbox.make_item(outbox.METHOD_EDIT_MARKUP, message_id=message_id)
+        ])
+
+    def queue_messages(self, chat_id, items):
+        from telegrambot.tasks import deliver_chat
+
+        outbox.push(self.id, chat_id, items)
+        deliver_chat(str(self.id), chat_id)
 
     def handle_message(self, message):
         """
         Process incoming message generating a response to the sender.
+        Commands are declared in telegrambot.handlers.
         :param message: Generic message received from provider
         """
+        from telegrambot.chatstates import save_chat_state
+        from telegrambot.handlers import router
+
         chat_state = self.get_chat_state(message)
-        chat, user = self._get_chat_and_user(message)
-        if not chat_state:
-            chat_state = self.create_chat_state(message, ChatState.STATE_MENU, {})
-
-        chat_context = chat_state.ctx
-        text = self.message_text(message)
-
-        if chat_state.state == ChatState.STATE_MENU:
-            """
-            /games - список квестов на боте
-            /my - список активных квестов чувака
-            """
-            if text == "/my":
-                response_message = "Ваши активные квесты:\n"
-                response_keyboard_row = []
-                for idx, session in enumerate(Session.objects.filter(user=user)):
-                    response_message += "{}. <b>{}</b>\n".format(idx, sessions.game.name)
-                    response_keyboard_row.append((idx, session.id))
-                chat_context["section"] = "my"
-                self.send_message(
-                    chat.id,
-                    response_message,
-                    self.build_keyboard([response_keyboard_row, ])
-                )
-
-            if text == "/games":
-                response_message = "Доступные квесты:\n"
-                response_keyboard_row = []
-                for idx, game in enumerate(Game.objects.filter(status=Game.STATUS_PUBLISHED)):
-                    response_message += "{}. <b>{}</b>\n{}\n".format(idx, game.name, game.description)
-                    response_keyboard_row.append((idx, game.id))
-                else:
-                    response_message += "ни одного квеста не нашли :("
-                chat_context["section"] = "games"
-                self.send_message(
-                    chat.id,
-                    response_message,
-                    self.build_keyboard([response_keyboard_row, ])
-                )
-            
-            if chat_context["section"] == "my":
-                try:
-                    session = Session.objects.get(user=user, pk=text)
-                    if message.callback_query:
-                        self.bot.edit_message_reply_markup(
-                            chat_id=chat.id,
-                            message_id=message.callback_query.message.message_id,
-                            reply_markup=None
-
-                        )
-                except Session.DoesNotExist:
-                    self.send_message(
-                        chat.id,
-                        "Сессия не найдена :(",
-                        None,
-                        message.callback_query.message.message_id if message.callback_query else None
-                    )
-                
-                chat_context.state = ChatState.STATE_GAME
-
-                game_data = session.get_game_data()
-                self.send_message(
-                    chat.id,
-                    "{}:\n\n{}".format(session.game.name, game_data["vision"])
-                )
-                
-                response_message = ""
-                response_keyboard_row = []
-                for idx, action in enumerate(game_data["actions"]):
-                    response_message += "{}. {}\n\n".format(idx, action["content"])
-                    response_keyboard_row.append((idx, action["id"]))
-                
-                self.send_message(
-                    chat.id,
-                    response_message,
-                    self.build_keyboard([response_keyboard_row, ])
-                )
-
-
-        if chat_state.state == ChatState.STATE_GAME:
-            """
-            /exit
-            /finish
-            """
-            pass
-
-        chat_state.ctx = chat_context
-        chat_state.save()
+        if chat_state is None:
+            logger.warning("Update %s has no chat to answer to, skip it" % message.pk)
+            return
+        router.dispatch(self, message, chat_state)
+        save_chat_state(chat_state)
 
 
 class Message(models.Model):
@@ -330,6 +280,8 @@ class Message(models.Model):
     forward_from = models.ForeignKey(User, null=True, blank=True, related_name='forwarded_from',
                                      verbose_name=_("Forward from"), on_delete=models.CASCADE)
     text = models.TextField(null=True, blank=True, verbose_name=_("Text"))
+    bot = models.ForeignKey(Bot, null=True, blank=True, related_name='messages', verbose_name=_("Bot"),
+                            on_delete=models.CASCADE)
 
     #  TODO: complete fields with all message fields
 
@@ -337,6 +289,10 @@ class Message(models.Model):
         verbose_name = 'Message'
         verbose_name_plural = 'Messages'
         ordering = ['-date', ]
+        unique_together = ('chat', 'bot', 'message_id')
+        indexes = [
+            models.Index(fields=['updated_at'], name='tg_message_updated_idx'),
+        ]
 
     def __str__(self):
         return "(%s,%s,%s)" % (self.message_id, self.chat, self.text or '(no text)')
@@ -345,7 +301,7 @@ class Message(models.Model):
 class CallbackQuery(models.Model):
     created_at = models.DateTimeField(_("Date created"), auto_now_add=True)
     updated_at = models.DateTimeField(_("Date updated"), auto_now=True)
-    callback_id = models.CharField(_('Id'), db_index=True, max_length=255)  # It might not be unique.
+    callback_id = models.CharField(_('Id'), unique=True, max_length=255)
     from_user = models.ForeignKey(User, related_name='callback_queries', verbose_name=_("User"), on_delete=models.CASCADE)
     message = models.ForeignKey(Message, null=True, blank=True, related_name='callback_queries',
                                 verbose_name=_("Message"), on_delete=models.CASCADE)
@@ -354,6 +310,9 @@ class CallbackQuery(models.Model):
     class Meta:
         verbose_name = 'CallbackQuery'
         verbose_name_plural = 'CallbackQueries'
+        indexes = [
+            models.Index(fields=['updated_at'], name='tg_callback_updated_idx'),
+        ]
 
     def __str__(self):
         return "(%s,%s)" % (self.callback_id, self.data)
@@ -365,14 +324,17 @@ class Update(models.Model):
     bot = models.ForeignKey(Bot, verbose_name=_("Bot"), related_name="updates", on_delete=models.CASCADE)
     update_id = models.BigIntegerField(_('Update Id'), db_index=True)
     message = models.ForeignKey(Message, null=True, blank=True, verbose_name=_('Message'),
-                                related_name="updates", on_delete=models.CASCADE)
+                                related_name="updates", on_delete=models.SET_NULL)
     callback_query = models.ForeignKey(CallbackQuery, null=True, blank=True, verbose_name=_("Callback Query"),
-                                       related_name="updates", on_delete=models.CASCADE)
+                                       related_name="updates", on_delete=models.SET_NULL)
 
     class Meta:
         verbose_name = 'Update'
         verbose_name_plural = 'Updates'
         unique_together = ('update_id', 'bot')
+        indexes = [
+            models.Index(fields=['updated_at'], name='tg_update_updated_idx'),
+        ]
 
     def __str__(self):
         return "(%s, %s)" % (self.bot.id, self.update_id)
@@ -0,0 +1,202 @@
+"""
+Outbound message queue.
+
+Messages are queued in a redis list per (bot, chat) and delivered by the
+`tasks.deliver_chat` task. Delivery respects telegram rate limits with
+token buckets kept in redis: one per bot (TELEGRAMBOT_GLOBAL_RATE messages
+per second) and one per chat (TELEGRAMBOT_CHAT_RATE messages per second).
+Both buckets are checked in one script and tokens are taken only when
+neither holds the message back, so no token is spent on a message that
+waits. When telegram answers 429, the chat is paused
+in redis for `retry_after` and no delivery sends to it before that.
+"""
+import json
+import logging
+import time
+
+import telegram
+from django.conf import settings
+from django_redis import get_redis_connection
+
+
+logger = logging.getLogger(__name__)
+
+
+METHOD_SEND, METHOD_EDIT, METHOD_EDIT_MARKUP = 'send', 'edit', 'edit_markup'
+
+
+# GCRA token buckets, KEYS are the buckets and ARGV the current time then
+# (interval, tolerance) of each bucket. Returns 0 if a message may be sent
+# now and takes a token of every bucket, otherwise the number of
+# milliseconds to wait and takes nothing.
+TOKEN_BUCKET_SCRIPT = """
+local now = tonumber(ARGV[1])
+local tats = {}
+local wait = 0
+for i, key in ipairs(KEYS) do
+    local tolerance = tonumber(ARGV[i * 2 + 1])
+    local tat = tonumber(redis.call('GET', key) or now)
+    if tat < now then
+        tat = now
+    end
+    tats[i] = tat
+    wait = math.max(wait, tat - now - tolerance)
+end
+if wait > 0 then
+    return wait
+end
+for i, key in ipairs(KEYS) do
+    local interval = tonumber(ARGV[i * 2])
+    local tolerance = tonumber(ARGV[i * 2 + 1])
+    redis.call('SET', key, tats[i] + interval, 'PX', tolerance + interval * 2)
+end
+return 0
+"""
+
+
+def queue_key(bot_id, chat_id):
+    return 'telegrambot.outbox-{}-{}'.format(bot_id, chat_id)
+
+
+def bucket_key(bot_id, chat_id=None):
+    if chat_id is None:
+        return 'telegrambot.outbox-bucket-{}'.format(bot_id)
+    return 'telegrambot.outbox-bucket-{}-{}'.format(bot_id, chat_id)
+
+
+def pause_key(bot_id, chat_id):
+    return 'telegrambot.outbox-pause-{}-{}'.format(bot_id, chat_id)
+
+
+def pause(bot_id, chat_id, seconds):
+    """Hold delivery to the chat, telegram asked to retry after `seconds`."""
+    get_redis_connection().set(pause_key(bot_id, chat_id), 1, px=int(seconds * 1000))
+
+
+def paused_for(bot_id, chat_id):
+    """Seconds left of the chat pause, 0 if it is not paused."""
+    ttl = get_redis_connection().pttl(pause_key(bot_id, chat_id))
+    return ttl / 1000.0 if ttl and ttl > 0 else 0
+
+
+def push(bot_id, chat_id, items):
+    """Queue messages for a chat. Items are dicts made by `make_item`."""
+    if items:
+        get_redis_connection().rpush(
+            queue_key(bot_id, chat_id),
+            *[json.dumps(item) for item in items]
+        )
+
+
+def make_item(method, text=None, keyboard=None, message_id=None):
+    return {
+        'method': method,
+        'text': text,
+        'reply_markup': keyboard.to_dict() if keyboard is not None else None,
+        'message_id': message_id,
+    }
+
+
+def take_tokens(buckets):
+    """
+    Milliseconds to wait before the next message, 0 if it may go now.
+    `buckets` are (key, rate, burst), a token is taken from all or none.
+    """
+    keys, args = [], [int(time.time() * 1000)]
+    for key, rate, burst in buckets:
+        interval = int(1000 / rate)
+        keys.append(key)
+        args.extend([interval, interval * (burst - 1)])
+    conn = get_redis_connection()
+    return int(conn.eval(TOKEN_BUCKET_SCRIPT, len(keys), *(keys + args)))
+
+
+def send_item(bot, chat_id, item):
+    reply_markup = None
+    if item['reply_markup']:
+        reply_markup = telegram.InlineKeyboardMarkup.de_json(
+            item['reply_markup'], bot.api
+        )
+
+    if item['method'] == METHOD_EDIT_MARKUP:
+        bot.api.edit_message_reply_markup(
+            chat_id=chat_id,
+            message_id=item['message_id'],
+            reply_markup=reply_markup
+        )
+    elif item['method'] == METHOD_EDIT:
+        bot.api.edit_message_text(
+            chat_id=chat_id,
+            message_id=item['message_id'],
+            text=item['text'],
+            parse_mode=telegram.ParseMode.HTML,
+            disable_web_page_preview=True,
+            reply_markup=reply_markup
+        )
+    else:
+        bot.api.send_message(
+            chat_id=chat_id,
+            text=item['text'],
+            parse_mode=telegram.ParseMode.HTML,
+            disable_web_page_preview=True,
+            reply_markup=reply_markup
+        )
+
+
+def deliver(bot, chat_id, max_sleep=1.0):
+    """
+    Send queued messages of a chat in order. Must be called under a per-chat
+    lock. Returns None when the queue is empty, otherwise the number of
+    seconds after which delivery should be resumed.
+    """
+    conn = get_redis_connection()
+    key = queue_key(bot.id, chat_id)
+    global_rate = getattr(settings, 'TELEGRAMBOT_GLOBAL_RATE', 30)
+    chat_rate = getattr(settings, 'TELEGRAMBOT_CHAT_RATE', 1)
+
+    while True:
+        raw = conn.lindex(key, 0)
+        if raw is None:
+            return None
+
+        paused = paused_for(bot.id, chat_id)
+        if paused:
+            return paused
+
+        buckets = (
+            (bucket_key(bot.id), global_rate, global_rate),
+            (bucket_key(bot.id, chat_id), chat_rate, 1),
+        )
+        wait = take_tokens(buckets) / 1000.0
+        while wait:
+            if wait > max_sleep:
+                return wait
+            time.sleep(wait)
+            wait = take_tokens(buckets) / 1000.0
+
+        item = json.loads(raw.decode('utf-8'))
+        try:
+            send_item(bot, chat_id, item)
+        except telegram.error.RetryAfter as e:
+            logger.warning(
+                "Flood limit for chat %s of bot %s, retry after %s" %
+                (chat_id, bot.id, e.retry_after)
+            )
+            pause(bot.id, chat_id, e.retry_after)
+            return e.retry_after
+        except telegram.error.TelegramError as e:
+            # BadRequest is a NetworkError too, but retrying will not help
+            if (isinstance(e, telegram.error.NetworkError) and
+                    not isinstance(e, telegram.error.BadRequest)):
+                logger.warning(
+                    "Network error for chat %s of bot %s: %s" %
+                    (chat_id, bot.id, e)
+                )
+                return getattr(settings, 'TELEGRAMBOT_NETWORK_RETRY_DELAY', 5)
+
+            logger.error(
+                "Message %s to chat %s of bot %s dropped: %s" %
+                (item, chat_id, bot.id, e)
+            )
+
+        conn.lpop(key)
@@ -0,0 +1,106 @@
+"""
+Retention of stored telegram objects.
+
+Messages, callback queries and updates are only read while an update is
+handled. Old rows are purged in small batches by the periodic
+`tasks.purge_history` task:
+
+* TELEGRAMBOT_RETENTION_DAYS - messages and callback queries not touched
+  for this many days are deleted (default 7), unless a stored update or
+  callback query still refers to them.
+* TELEGRAMBOT_UPDATE_RETENTION_DAYS - updates are kept this long for
+  deduplication of webhook retries (default 2, telegram gives up
+  redelivering an update after 24 hours).
+* TELEGRAMBOT_KEEP_UPDATE_IDS_ONLY - when True, message and callback query
+  of an update are deleted as soon as it is handled and only the update id
+  is kept.
+"""
+import logging
+from datetime import timedelta
+
+from django.conf import settings
+from django.db import transaction
+from django.utils import timezone
+
+from .models import Message, Update, CallbackQuery
+
+
+logger = logging.getLogger(__name__)
+
+
+def keep_update_ids_only():
+    return getattr(settings, 'TELEGRAMBOT_KEEP_UPDATE_IDS_ONLY', False)
+
+
+# reverse relations that keep a row alive while they are not empty
+REFERENCES = {
+    CallbackQuery: ('updates', ),
+    Message: ('updates', 'callback_queries'),
+}
+
+
+def _unreferenced(model):
+    return {'%s__isnull' % name: True for name in REFERENCES.get(model, ())}
+
+
+def strip_update(update):
+    """
+    Drop stored content of a handled update, keep the update id. Content
+    other updates or callback queries still refer to is left for `purge`.
+    """
+    with transaction.atomic():
+        Update.objects.filter(pk=update.pk).update(message=None, callback_query=None)
+        if update.callback_query_id:
+            CallbackQuery.objects.filter(
+                pk=update.callback_query_id, **_unreferenced(CallbackQuery)
+            ).delete()
+        if update.message_id:
+            Message.objects.filter(
+                pk=update.message_id, **_unreferenced(Message)
+            ).delete()
+
+
+def purge(model, before, batch_size=1000):
+    """
+    Delete rows of `model` last updated before `before` that no row refers
+    to any more. Rows are deleted in batches, each in its own transaction,
+    to keep locks short.
+    """
+    unreferenced = _unreferenced(model)
+    total = 0
+    while True:
+        pks = list(
+            model.objects.filter(updated_at__lt=before, **unreferenced)
+            .order_by('updated_at').values_list('pk', flat=True)[:batch_size]
+        )
+        if not pks:
+            return total
+        with transaction.atomic():
+            # rows may have got a reference since they were selected
+            total += model.objects.filter(pk__in=pks, **unreferenced).delete()[1].get(
+                model._meta.label, 0
+            )
+
+
+def purge_history(batch_size=None):
+    """Purge expired telegram objects. Returns {model name: rows deleted}."""
+    if batch_size is None:
+        batch_size = getattr(settings, 'TELEGRAMBOT_RETENTION_BATCH_SIZE', 1000)
+    now = timezone.now()
+    content_before = now - timedelta(
+        days=getattr(settings, 'TELEGRAMBOT_RETENTION_DAYS', 7)
+    )
+    updates_before = now - timedelta(
+        days=getattr(settings, 'TELEGRAMBOT_UPDATE_RETENTION_DAYS', 2)
+    )
+
+    deleted = {}
+    for model, before in (
+        (Update, updates_before),
+        (CallbackQuery, content_before),
+        (Message, content_before),
+    ):
+        deleted[model._meta.model_name] = purge(model, before, batch_size)
+
+    logger.info("Telegram history purged: %s" % deleted)
+    return deleted
@@ -0,0 +1,142 @@
+"""
+Command router.
+
+Handlers are registered per (chat state, command) for text messages and
+per (chat state, prefix) for callback queries and are resolved with one
+dict lookup. A handler registered with state None works in every state.
+
+Callback data is encoded compactly as `prefix:arg:arg`, telegram allows
+at most 64 bytes.
+
+Handlers run in task workers, so calls and time per handler are counted
+in redis and published by the metrics view of the web processes.
+"""
+import logging
+import time
+from collections import defaultdict
+
+from django_redis import get_redis_connection
+
+from gamebook import metrics
+
+
+logger = logging.getLogger(__name__)
+
+
+CALLBACK_SEPARATOR = ':'
+CALLBACK_MAX_LENGTH = 64
+
+STATS_KEY = 'telegrambot.router-stats'
+
+
+def encode_callback(prefix, *args):
+    data = CALLBACK_SEPARATOR.join([prefix] + [str(arg) for arg in args])
+    if len(data.encode('utf-8')) > CALLBACK_MAX_LENGTH:
+        raise ValueError("Callback data is too long: %s" % data)
+    return data
+
+
+def decode_callback(data):
+    parts = (data or '').split(CALLBACK_SEPARATOR)
+    return parts[0], parts[1:]
+
+
+class Router(object):
+
+    def __init__(self):
+        self._commands = {}
+        self._callbacks = {}
+        self._fallbacks = {}
+
+    def command(self, state, *commands):
+        """Register a handler of text commands, e.g. `/games`."""
+        def decorator(handler):
+            for command in commands:
+                self._commands[(state, command)] = handler
+            return handler
+        return decorator
+
+    def callback(self, state, prefix):
+        """Register a handler of callback data made by `encode_callback(prefix, ...)`."""
+        def decorator(handler):
+            self._callbacks[(state, prefix)] = handler
+            return handler
+        return decorator
+
+    def fallback(self, state):
+        """Register a handler of anything else received in the state."""
+        def decorator(handler):
+            self._fallbacks[state] = handler
+            return handler
+        return decorator
+
+    def resolve(self, state, update):
+        """(handler, args) for the update, handler is None if nothing matches."""
+        if update.callback_query:
+            prefix, args = decode_callback(update.callback_query.data)
+            handler = (
+                self._callbacks.get((state, prefix)) or
+                self._callbacks.get((None, prefix))
+            )
+            if handler:
+                return handler, args
+        elif update.message:
+            command = (update.message.text or '').strip().split(' ', 1)[0]
+            handler = (
+                self._commands.get((state, command)) or
+                self._commands.get((None, command))
+            )
+            if handler:
+                return handler, []
+        return self._fallbacks.get(state) or self._fallbacks.get(None), []
+
+    def dispatch(self, bot, update, chat_state):
+        handler, args = self.resolve(chat_state.state, update)
+        if handler is None:
+            logger.debug("No handler for %s in state %s" % (update, chat_state.state))
+            return False
+
+        started = time.time()
+        try:
+            handler(bot, update, chat_state, *args)
+        finally:
+            self._record(handler, time.time() - started)
+        return True
+
+    def _record(self, handler, elapsed):
+        name = '%s.%s' % (handler.__module__, handler.__name__)
+        logger.debug("Handler %s took %.1f ms" % (name, elapsed * 1000))
+        try:
+            pipe = get_redis_connection().pipeline()
+            pipe.hincrby(STATS_KEY, '%s:calls' % name, 1)
+            pipe.hincrbyfloat(STATS_KEY, '%s:seconds' % name, elapsed)
+            pipe.execute()
+        except Exception as e:
+            # statistics never break handling
+            logger.warning("Handler stats not recorded: %s" % e)
+
+    def get_stats(self):
+        """{handler: {'calls': n, 'seconds': total}} of all workers."""
+        stats = defaultdict(dict)
+        for field, value in get_redis_connection().hgetall(STATS_KEY).items():
+            name, stat = field.decode('utf-8').rsplit(':', 1)
+            stats[name][stat] = int(value) if stat == 'calls' else float(value)
+        return dict(stats)
+
+
+router = Router()
+
+
+@metrics.collector
+def collect_stats():
+    stats = router.get_stats()
+    return [
+        (
+            metric, 'counter', help_text,
+            [({'handler': name}, stats[name].get(stat, 0)) for name in sorted(stats)]
+        )
+        for stat, metric, help_text in (
+            ('calls', 'gamebook_telegrambot_handler_calls_total', "Calls of telegram handlers"),
+            ('seconds', 'gamebook_telegrambot_handler_seconds_total', "Time spent in telegram handlers"),
+        )
+    ]
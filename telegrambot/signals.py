@@ -0,0 +1,12 @@
+from django.db.models.signals import post_save, post_delete
+from django.dispatch import receiver
+
+import telegrambot.caching as caching
+from telegrambot.models import Bot
+
+
+@receiver(post_save, sender=Bot)
+@receiver(post_delete, sender=Bot)
+def bot_changed(sender, instance, **kwargs):
+    """A disabled bot or a rotated token must not be served from the cache."""
+    caching.delete(Bot, instance)
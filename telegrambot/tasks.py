@@ -3,18 +3,20 @@ from __future__ import absolute_import, unicode_literals
 import telegrambot.caching as caching
 import logging
 
+from huey import crontab
 from huey.contrib.djhuey import HUEY as djhuey
-from huey.contrib.djhuey import db_task
+from huey.contrib.djhuey import db_task, db_periodic_task
 from django.conf import settings
 
 from .models import Update, Bot
+from .ingest import create_update, OnlyTextMessages
+from . import chatqueue, chatstates, outbox, retention
 
 
 logger = logging.getLogger(__name__)
 
 
-@db_task(retries=5, retry_delay=1)
-def handle_update(update_id, bot_id):
+def process_update(update_id, bot_id):
     lock_id = 'handle_update_{}_{}'.format(update_id, bot_id)
 
     with djhuey.lock_task(lock_id):
@@ -34,3 +36,95 @@ def handle_update(update_id, bot_id):
                 logger.error("Error processing %s for bot %s" % (update, telegram_bot))
             else:
                 caching.delete(Update, update)
+                if retention.keep_update_ids_only():
+                    retention.strip_update(update)
+
+
+def ingest(bot_id, update_data):
+    """
+    Normalize raw update json queued by the webhook fast path
+    into telegrambot models and handle it.
+    """
+    try:
+        telegram_bot = caching.get_or_set(Bot, bot_id)
+    except Bot.DoesNotExist:
+        logger.error("Update %s for unknown bot %s" % (update_data.get('update_id'), bot_id))
+        return
+
+    if not telegram_bot.enabled:
+        logger.error("Update %s ignored by disabled bot %s" % (update_data.get('update_id'), bot_id))
+        return
+
+    try:
+        update = create_update(update_data, telegram_bot)
+    except OnlyTextMessages:
+        logger.warning("Not text message %s for bot %s" % (update_data, bot_id))
+        return
+
+    process_update(update.id, telegram_bot.id)
+
+
+def enqueue_update(bot_id, chat_id, update_id, item):
+    """Queue an update for its chat and make sure a worker drains it."""
+    chatqueue.push(bot_id, chat_id, update_id, item)
+    drain_chat(str(bot_id), chat_id)
+
+
+@db_task(retries=10, retry_delay=1)
+def drain_chat(bot_id, chat_id):
+    """
+    Handle queued updates of one chat in order. If another worker already
+    drains the chat, the lock fails and the task is retried, so nothing
+    queued meanwhile is left behind. A failed update holds the chat back
+    until it is retried, see chatqueue.drain.
+    """
+    def handler(item):
+        if item.get('pk'):
+            process_update(item['pk'], bot_id)
+        else:
+            ingest(bot_id, item['data'])
+
+    try:
+        with djhuey.lock_task('drain_chat_{}_{}'.format(bot_id, chat_id)):
+            chatqueue.drain(bot_id, chat_id, handler)
+    except chatqueue.RetryLater as e:
+        logger.warning(
+            "Drain of chat %s for bot %s is retried in %s s" % (chat_id, bot_id, e.delay)
+        )
+        drain_chat.schedule((bot_id, chat_id), delay=e.delay)
+        return
+
+    if not chatqueue.is_empty(bot_id, chat_id):
+        drain_chat(bot_id, chat_id)
+
+
+@db_task(retries=10, retry_delay=1)
+def deliver_chat(bot_id, chat_id):
+    """
+    Send queued messages of a chat. Waits longer than a second are not
+    slept through: the task is scheduled again instead.
+    """
+    try:
+        telegram_bot = caching.get_or_set(Bot, bot_id)
+    except Bot.DoesNotExist:
+        logger.error("Bot  %s does not exists or disabled" % bot_id)
+        return
+
+    with djhuey.lock_task('deliver_chat_{}_{}'.format(bot_id, chat_id)):
+        delay = outbox.deliver(telegram_bot, chat_id)
+
+    if delay is not None:
+        deliver_chat.schedule(args=(bot_id, chat_id), delay=delay)
+
+
+@db_periodic_task(crontab(minute='*/15'))
+def purge_history():
+    with djhuey.lock_task('telegrambot_purge_history'):
+        retention.purge_history()
+
+
+@db_periodic_task(crontab(minute='*'))
+def flush_chat_states():
+    if chatstates.use_redis():
+        with djhuey.lock_task('telegrambot_flush_chat_states'):
+            chatstates.flush_chat_states()
@@ -1,3 +1,565 @@
-from django.test import TestCase
+import json
+import threading
+import time
+import uuid
+from datetime import timedelta
+from types import SimpleNamespace
+from unittest import mock, skipUnless
 
-# Create your tests here.
+import telegram
+
+from django.core.cache import cache
+from django.db import connection
+from django.test import TestCase, override_settings
+from django.urls import reverse
+from django.utils import timezone
+
+from telegrambot import (
+    caching, chatqueue, chatstates, clients, ingest, outbox, retention, router, tasks, views
+)
+from telegrambot.models import Bot, CallbackQuery, Chat, ChatState, Message, Update, User
+
+
+def _key(key):
+    return key.decode('utf-8') if isinstance(key, bytes) else key
+
+
+class FakeRedis(object):
+    """The few redis commands the telegrambot stores use, in memory."""
+
+    def __init__(self):
+        self.values = {}
+        self.expires = {}
+        self.sets = {}
+        self.lists = {}
+        self.zsets = {}
+        self.hashes = {}
+
+    def get(self, key):
+        return self.values.get(_key(key))
+
+    def set(self, key, value, px=None):
+        self.setex(key, None, str(value))
+        if px:
+            self.expires[_key(key)] = time.time() + px / 1000.0
+
+    def pttl(self, key):
+        key = _key(key)
+        if key not in self.values:
+            return -2
+        if key not in self.expires:
+            return -1
+        return max(0, int((self.expires[key] - time.time()) * 1000))
+
+    def rpush(self, key, *values):
+        self.lists.setdefault(_key(key), []).extend(
+            v.encode('utf-8') if isinstance(v, str) else v for v in values
+        )
+
+    def lindex(self, key, index):
+        values = self.lists.get(_key(key), [])
+        return values[index] if -len(values) <= index < len(values) else None
+
+    def lpop(self, key):
+        values = self.lists.get(_key(key))
+        return values.pop(0) if values else None
+
+    def mget(self, keys):
+        return [self.get(key) for key in keys]
+
+    def setex(self, key, time, value):
+        if isinstance(value, str):
+            value = value.encode('utf-8')
+        self.values[_key(key)] = value
+
+    def sadd(self, key, *members):
+        self.sets.setdefault(_key(key), set()).update(_key(m) for m in members)
+
+    def spop(self, key):
+        members = self.sets.get(_key(key))
+        if not members:
+            return None
+        return members.pop().encode('utf-8')
+
+    def hincrby(self, key, field, amount=1):
+        values = self.hashes.setdefault(_key(key), {})
+        field = field.encode('utf-8')
+        values[field] = int(values.get(field, 0)) + amount
+
+    def hincrbyfloat(self, key, field, amount=1.0):
+        values = self.hashes.setdefault(_key(key), {})
+        field = field.encode('utf-8')
+        values[field] = float(values.get(field, 0)) + amount
+
+    def hgetall(self, key):
+        return {
+            field: str(value).encode('utf-8')
+            for field, value in self.hashes.get(_key(key), {}).items()
+        }
+
+    def zadd(self, key, score, member):
+        if isinstance(member, str):
+            member = member.encode('utf-8')
+        self.zsets.setdefault(_key(key), {})[member] = score
+
+    def zrange(self, key, start, end):
+        zset = self.zsets.get(_key(key), {})
+        members = sorted(zset, key=lambda member: (zset[member], member))
+        if end < 0:
+            end += len(members)
+        return members[start:end + 1]
+
+    def zrem(self, key, *members):
+        zset = self.zsets.get(_key(key), {})
+        for member in members:
+            zset.pop(member, None)
+
+    def zcard(self, key):
+        return len(self.zsets.get(_key(key), {}))
+
+    def pipeline(self):
+        return FakePipeline(self)
+
+
+class FakePipeline(object):
+
+    def __init__(self, redis):
+        self.redis = redis
+        self.calls = []
+
+    def __getattr__(self, name):
+        def call(*args):
+            self.calls.append((name, args))
+        return call
+
+    def execute(self):
+        calls, self.calls = self.calls, []
+        return [getattr(self.redis, name)(*args) for name, args in calls]
+
+
+@override_settings(TELEGRAMBOT_CHAT_STATE_REDIS=True)
+class ChatStateFlushTest(TestCase):
+
+    def setUp(self):
+        self.redis = FakeRedis()
+        patcher = mock.patch.object(chatstates, 'get_redis_connection', return_value=self.redis)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+        self.chat = Chat.objects.create(id=1, type=Chat.PRIVATE)
+        self.user = User.objects.create(id=1, first_name='Player')
+
+    def flush(self):
+        with mock.patch.object(tasks.djhuey, 'lock_task'):
+            tasks.flush_chat_states.call_local()
+
+    def test_changed_state_is_written_by_the_flush_task(self):
+        chat_state = chatstates.get_chat_state(self.chat, self.user)
+        chat_state.state = ChatState.STATE_GAME
+        chat_state.ctx = {'session_id': 5}
+        chatstates.save_chat_state(chat_state)
+
+        stored = ChatState.objects.get(pk=chat_state.pk)
+        self.assertEqual(stored.state, ChatState.STATE_MENU)
+
+        self.flush()
+
+        stored = ChatState.objects.get(pk=chat_state.pk)
+        self.assertEqual(stored.state, ChatState.STATE_GAME)
+        self.assertEqual(stored.ctx.session_id, 5)
+        self.assertFalse(self.redis.sets.get(chatstates.DIRTY_KEY))
+
+    def test_state_is_read_back_from_redis(self):
+        chat_state = chatstates.get_chat_state(self.chat, self.user)
+        chat_state.ctx = {'page': 3}
+        chatstates.save_chat_state(chat_state)
+
+        chat_state = chatstates.get_chat_state(self.chat, self.user)
+        self.assertEqual(chat_state.ctx.page, 3)
+        self.assertFalse(chat_state.is_dirty)
+
+    def test_flush_without_changes(self):
+        self.flush()
+        self.assertEqual(ChatState.objects.count(), 0)
+
+
+class OutboxTest(TestCase):
+
+    def setUp(self):
+        self.redis = FakeRedis()
+        patcher = mock.patch.object(outbox, 'get_redis_connection', return_value=self.redis)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+        self.bot = SimpleNamespace(id='bot')
+        outbox.push(self.bot.id, 1, [
+            outbox.make_item(outbox.METHOD_SEND, 'first'),
+            outbox.make_item(outbox.METHOD_SEND, 'second'),
+        ])
+
+    def test_flood_limit_pauses_the_chat(self):
+        with mock.patch.object(outbox, 'take_tokens', return_value=0), \
+                mock.patch.object(outbox, 'send_item', side_effect=telegram.error.RetryAfter(30)):
+            self.assertEqual(outbox.deliver(self.bot, 1), 30)
+
+        with mock.patch.object(outbox, 'take_tokens', return_value=0) as take_tokens, \
+                mock.patch.object(outbox, 'send_item') as send_item:
+            self.assertGreater(outbox.deliver(self.bot, 1), 29)
+        self.assertFalse(send_item.called)
+        self.assertFalse(take_tokens.called)
+
+    def test_held_back_message_takes_no_token(self):
+        with mock.patch.object(self.redis, 'eval', create=True, return_value=5000) as script, \
+                mock.patch.object(outbox, 'send_item') as send_item:
+            self.assertEqual(outbox.deliver(self.bot, 1), 5)
+
+        # both buckets are checked at once, tokens are taken by the script
+        # only when neither of them has to wait
+        self.assertEqual(script.call_count, 1)
+        self.assertEqual(
+            script.call_args[0][1:4],
+            (2, outbox.bucket_key(self.bot.id), outbox.bucket_key(self.bot.id, 1))
+        )
+        self.assertFalse(send_item.called)
+
+    def test_queue_is_delivered_in_order(self):
+        with mock.patch.object(outbox, 'take_tokens', return_value=0), \
+                mock.patch.object(outbox, 'send_item') as send_item:
+            self.assertIsNone(outbox.deliver(self.bot, 1))
+        self.assertEqual(
+            [call[0][2]['text'] for call in send_item.call_args_list],
+            ['first', 'second']
+        )
+
+
+@override_settings(TELEGRAMBOT_UPDATE_MAX_ATTEMPTS=2)
+class ChatQueueTest(TestCase):
+
+    def setUp(self):
+        self.redis = FakeRedis()
+        patcher = mock.patch.object(chatqueue, 'get_redis_connection', return_value=self.redis)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+        for update_id in (1, 2, 3):
+            chatqueue.push('bot', 7, update_id, {'pk': update_id})
+        self.handled = []
+
+    def handler(self, failing):
+        def handle(item):
+            if item['update_id'] in failing:
+                raise ConnectionError
+            self.handled.append(item['update_id'])
+        return handle
+
+    def queued(self):
+        return [
+            json.loads(member.decode('utf-8'))
+            for member in self.redis.zrange(chatqueue.queue_key('bot', 7), 0, -1)
+        ]
+
+    def test_failed_update_stays_queued_and_holds_the_chat(self):
+        with self.assertRaises(chatqueue.RetryLater) as retry:
+            chatqueue.drain('bot', 7, self.handler({2}))
+
+        self.assertEqual(retry.exception.delay, 1)
+        self.assertEqual(self.handled, [1])
+        self.assertEqual(
+            [(item['update_id'], item.get('attempts')) for item in self.queued()],
+            [(2, 1), (3, None)]
+        )
+
+        self.assertEqual(chatqueue.drain('bot', 7, self.handler(set())), 2)
+        self.assertEqual(self.handled, [1, 2, 3])
+        self.assertTrue(chatqueue.is_empty('bot', 7))
+
+    def test_update_is_dropped_after_max_attempts(self):
+        with self.assertRaises(chatqueue.RetryLater):
+            chatqueue.drain('bot', 7, self.handler({2}))
+        chatqueue.drain('bot', 7, self.handler({2}))
+
+        self.assertEqual(self.handled, [1, 3])
+        self.assertTrue(chatqueue.is_empty('bot', 7))
+
+    def test_drain_task_is_scheduled_again(self):
+        with mock.patch.object(tasks.djhuey, 'lock_task'), \
+                mock.patch.object(tasks, 'process_update', side_effect=ConnectionError), \
+                mock.patch.object(tasks.drain_chat, 'schedule') as schedule:
+            tasks.drain_chat.call_local('bot', 7)
+
+        schedule.assert_called_once_with(('bot', 7), delay=1)
+        self.assertEqual(len(self.queued()), 3)
+
+
+class RouterStatsTest(TestCase):
+
+    def setUp(self):
+        self.redis = FakeRedis()
+        patcher = mock.patch.object(router, 'get_redis_connection', return_value=self.redis)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_handler_calls_are_published(self):
+        test_router = router.Router()
+
+        @test_router.command(None, '/start')
+        def start(bot, update, chat_state):
+            pass
+
+        update = SimpleNamespace(callback_query=None, message=SimpleNamespace(text='/start'))
+        chat_state = SimpleNamespace(state=ChatState.STATE_MENU)
+        for i in range(2):
+            self.assertTrue(test_router.dispatch(None, update, chat_state))
+
+        name = '%s.start' % __name__
+        self.assertEqual(test_router.get_stats()[name]['calls'], 2)
+
+        response = self.client.get(reverse('metrics'))
+        self.assertContains(
+            response, 'gamebook_telegrambot_handler_calls_total{handler="%s"} 2' % name
+        )
+
+    def test_redis_errors_do_not_break_handling(self):
+        self.redis.pipeline = mock.Mock(side_effect=ConnectionError)
+        test_router = router.Router()
+        handled = []
+        test_router.fallback(None)(lambda *args: handled.append(args))
+
+        update = SimpleNamespace(callback_query=None, message=SimpleNamespace(text='hi'))
+        self.assertTrue(test_router.dispatch(None, update, SimpleNamespace(state=None)))
+        self.assertEqual(len(handled), 1)
+
+
+def message_update(update_id, message_id=1, text='/start'):
+    return {
+        'update_id': update_id,
+        'message': {
+            'message_id': message_id,
+            'date': 1500000000,
+            'text': text,
+            'from': {'id': 7, 'is_bot': False, 'first_name': 'Player'},
+            'chat': {'id': 7, 'type': 'private', 'first_name': 'Player'},
+        },
+    }
+
+
+def callback_update(update_id, callback_id='c1', message_id=1):
+    data = message_update(update_id, message_id)
+    return {
+        'update_id': update_id,
+        'callback_query': {
+            'id': callback_id,
+            'data': 'g:1',
+            'from': data['message']['from'],
+            'message': data['message'],
+        },
+    }
+
+
+class CreateUpdateTest(TestCase):
+    """Runs the upsert of the configured database, see UpsertPostgresqlTest."""
+
+    def setUp(self):
+        self.bot = Bot.objects.create(token='1:first')
+        self.other_bot = Bot.objects.create(token='2:second')
+
+    def create(self, update_data, bot=None):
+        return ingest.create_update(update_data, bot or self.bot)
+
+    def test_message_update(self):
+        update = self.create(message_update(1))
+
+        stored = Update.objects.get(pk=update.pk)
+        self.assertEqual(stored.message_id, update.message.pk)
+        self.assertEqual(stored.message.bot_id, self.bot.pk)
+        self.assertEqual(stored.message.text, '/start')
+        self.assertEqual(User.objects.get(pk=7).first_name, 'Player')
+
+    def test_repeated_update_is_stored_once(self):
+        first = self.create(message_update(1))
+        second = self.create(message_update(1, text='/games'))
+
+        self.assertEqual(first.pk, second.pk)
+        self.assertEqual(Update.objects.count(), 1)
+        self.assertEqual(Message.objects.get().text, '/games')
+
+    def test_same_message_id_for_two_bots(self):
+        self.create(message_update(1))
+        self.create(message_update(1), self.other_bot)
+
+        self.assertEqual(Message.objects.filter(chat_id=7, message_id=1).count(), 2)
+        for update in Update.objects.select_related('message'):
+            self.assertEqual(update.message.bot_id, update.bot_id)
+
+    def test_callback_query_update(self):
+        message = self.create(message_update(1)).message
+        update = self.create(callback_update(2))
+
+        stored = Update.objects.get(pk=update.pk)
+        self.assertIsNone(stored.message_id)
+        self.assertEqual(stored.callback_query.callback_id, 'c1')
+        self.assertEqual(stored.callback_query.message_id, message.pk)
+        self.assertEqual(CallbackQuery.objects.count(), 1)
+
+
+class RetentionTest(TestCase):
+
+    def setUp(self):
+        self.bot = Bot.objects.create(token='1:first')
+        self.message_update = ingest.create_update(message_update(1), self.bot)
+        # a button under the same message is pressed later
+        self.callback_update = ingest.create_update(callback_update(2), self.bot)
+
+    def test_strip_update_keeps_content_other_rows_refer_to(self):
+        retention.strip_update(self.message_update)
+
+        self.assertTrue(Message.objects.filter(pk=self.message_update.message_id).exists())
+        stored = Update.objects.get(pk=self.callback_update.pk)
+        self.assertEqual(stored.callback_query.message_id, self.message_update.message_id)
+
+    def test_strip_update_deletes_unreferenced_content(self):
+        retention.strip_update(self.callback_update)
+        retention.strip_update(self.message_update)
+
+        self.assertEqual(Message.objects.count(), 0)
+        self.assertEqual(CallbackQuery.objects.count(), 0)
+        self.assertEqual(Update.objects.count(), 2)
+
+    def test_purge_keeps_old_rows_newer_rows_refer_to(self):
+        Message.objects.update(updated_at=timezone.now() - timedelta(days=30))
+
+        deleted = retention.purge_history()
+
+        self.assertEqual(deleted['message'], 0)
+        self.assertEqual(Message.objects.count(), 1)
+
+    def test_update_without_content_is_skipped(self):
+        retention.strip_update(self.callback_update)
+        update = Update.objects.get(pk=self.callback_update.pk)
+
+        self.assertEqual(self.bot._get_chat_and_user(update), (None, None))
+        with mock.patch('telegrambot.handlers.router.dispatch') as dispatch:
+            self.bot.handle_message(update)
+        self.assertFalse(dispatch.called)
+
+
+@override_settings(TELEGRAMBOT_FAST_INGEST=True, ROOT_URLCONF='telegrambot.urls')
+class FastIngestTest(TestCase):
+
+    def setUp(self):
+        cache.clear()
+        self.bot = Bot.objects.create(token='1:first')
+
+    def post(self, update_data, bot_id=None):
+        return self.client.post(
+            reverse('telegrambot_hook', args=[bot_id or self.bot.id]),
+            data=json.dumps(update_data),
+            content_type='application/json'
+        )
+
+    def test_duplicate_update_is_queued_once(self):
+        with mock.patch.object(views, 'enqueue_update') as enqueue_update:
+            self.assertEqual(self.post(message_update(1)).status_code, 200)
+            self.assertEqual(self.post(message_update(1)).status_code, 200)
+        self.assertEqual(enqueue_update.call_count, 1)
+
+    def test_update_is_released_when_queueing_fails(self):
+        with mock.patch.object(views, 'enqueue_update', side_effect=ConnectionError):
+            with self.assertRaises(ConnectionError):
+                self.post(message_update(1))
+
+        with mock.patch.object(views, 'enqueue_update') as enqueue_update:
+            self.post(message_update(1))
+        self.assertEqual(enqueue_update.call_count, 1)
+
+    def test_unknown_and_disabled_bots(self):
+        disabled = Bot.objects.create(token='2:second', enabled=False)
+        with mock.patch.object(views, 'enqueue_update') as enqueue_update:
+            self.assertEqual(self.post(message_update(1), uuid.uuid4()).status_code, 404)
+            self.assertEqual(self.post(message_update(1), disabled.id).status_code, 200)
+        self.assertFalse(enqueue_update.called)
+
+
+class BotCacheTest(TestCase):
+
+    def setUp(self):
+        cache.clear()
+        self.bot = Bot.objects.create(token='1:first')
+
+    def test_saved_bot_is_read_again(self):
+        self.assertTrue(caching.get_or_set(Bot, self.bot.pk).enabled)
+
+        self.bot.enabled = False
+        self.bot.token = '1:rotated'
+        self.bot.save()
+
+        bot = caching.get_or_set(Bot, self.bot.pk)
+        self.assertFalse(bot.enabled)
+        self.assertEqual(bot.token, '1:rotated')
+
+    def test_deleted_bot(self):
+        caching.get_or_set(Bot, self.bot.pk)
+        pk = self.bot.pk
+        self.bot.delete()
+
+        with self.assertRaises(Bot.DoesNotExist):
+            caching.get_or_set(Bot, pk)
+
+    def test_stats_are_published(self):
+        caching.get_or_set(Bot, self.bot.pk)
+        response = self.client.get(reverse('metrics'))
+
+        self.assertEqual(response.status_code, 200)
+        self.assertContains(
+            response,
+            'gamebook_telegrambot_cache_total{model="telegrambot.bot",result="misses"}'
+        )
+
+
+class ClientRegistryTest(TestCase):
+
+    def setUp(self):
+        patcher = mock.patch.object(clients, '_clients', {})
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_one_client_per_token(self):
+        client = clients.get_client('123:first')
+        self.assertIs(clients.get_client('123:first'), client)
+        self.assertIsNot(clients.get_client('456:second'), client)
+        self.assertEqual(client.token, '123:first')
+
+    def test_loading_bots_creates_no_client(self):
+        bot = Bot.objects.create(token='123:first')
+        with mock.patch.object(clients.telegram, 'Bot', wraps=telegram.Bot) as created:
+            first, second = Bot.objects.get(pk=bot.pk), Bot.objects.get(pk=bot.pk)
+            self.assertFalse(created.called)
+
+            self.assertIs(first.api, second.api)
+        self.assertEqual(created.call_count, 1)
+
+    def test_threads_share_the_client(self):
+        found = []
+        threads = [
+            threading.Thread(target=lambda: found.append(clients.get_client('123:first')))
+            for i in range(8)
+        ]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(len(set(map(id, found))), 1)
+
+    def test_invalid_token(self):
+        with self.assertRaises(Exception):
+            Bot(token='invalid').api
+        self.assertEqual(clients._clients, {})
+
+
+@skipUnless(connection.vendor == 'postgresql', "the upsert statement is PostgreSQL only")
+class UpsertPostgresqlTest(CreateUpdateTest):
+
+    def create(self, update_data, bot=None):
+        update, users = ingest.parse_update(update_data, bot or self.bot)
+        ingest._upsert_postgresql(update, users)
+        return update
@@ -1,23 +1,20 @@
 import logging, json
-import telegrambot.caching as caching
-from datetime import datetime
 
-from django.http import HttpResponse
+from django.conf import settings
+from django.http import Http404, HttpResponse, HttpResponseBadRequest
 from django.views import View
 from django.shortcuts import get_object_or_404
 from django.views.decorators.csrf import csrf_exempt
 from django.utils.decorators import method_decorator
-from .models import Bot, User, Chat, Message, Update, CallbackQuery
-from .tasks import handle_update
+from .models import Bot
+from .ingest import create_update, claim_update, release_update, OnlyTextMessages
+from .tasks import enqueue_update
+from . import caching, chatqueue
 
 
 logger = logging.getLogger(__name__)
 
 
-class OnlyTextMessages(Exception):
-    pass
-
-
 @method_decorator(csrf_exempt, name='dispatch')
 class HookView(View):
     def get_bot(self, bot_id):
@@ -31,12 +28,20 @@ class HookView(View):
         return HttpResponse('ok')
 
     def post(self, request, bot_id):
+        if getattr(settings, 'TELEGRAMBOT_FAST_INGEST', False):
+            return self.fast_post(request, bot_id)
+
         bot = self.get_bot(bot_id)
         update_data = json.loads(request.body.decode("utf-8"))
         try:
             update = self.create_update(update_data, bot)
             if bot.enabled:
-                handle_update(update.id, bot.id)
+                enqueue_update(
+                    bot.id,
+                    chatqueue.chat_id_from_update(update),
+                    update.update_id,
+                    {'pk': update.id}
+                )
             else:
                 logger.error("Update %s ignored by disabled bot %s" % (update, bot.token))
         except OnlyTextMessages:
@@ -45,97 +50,45 @@ class HookView(View):
         else:
             return HttpResponse()
 
-    def create_update(self, update_data, bot):
-        """Catch update json and save all this shit"""
-        if 'message' in update_data:
-            try:
-                user = caching.get_or_set(
-                    User,
-                    update_data['message']['from']['id']
-                )
-            except User.DoesNotExist:
-                user, _ = User.objects.get_or_create(**update_data['message']['from'])
-
-            try:
-                chat = caching.get_or_set(
-                    Chat,
-                    update_data['message']['chat']['id']
-                )
-            except Chat.DoesNotExist:
-                chat, _ = Chat.objects.get_or_create(**update_data['message']['chat'])
-
-            if 'text' not in update_data['message']:
-                raise OnlyTextMessages
-
-            message, _ = Message.objects.get_or_create(
-                message_id=update_data['message']['message_id'],
-                from_user=user,
-                date=datetime.fromtimestamp(update_data['message']['date']),
-                chat=chat,
-                text=update_data['message']['text']
-            )
-            update, _ = Update.objects.get_or_create(
-                bot=bot,
-                update_id=update_data['update_id'],
-                message=message
-            )
-        elif 'callback_query' in update_data:
-            # Message may be not present if it is very old
-            if 'message' in update_data['callback_query']:
-                try:
-                    user = caching.get_or_set(
-                        User,
-                        update_data['callback_query']['message']['from']['id']
-                    )
-                except User.DoesNotExist:
-                    user, _ = User.objects.get_or_create(
-                        **update_data['callback_query']['message']['from']
-                    )
-
-                try:
-                    chat = caching.get_or_set(
-                        Chat,
-                        update_data['callback_query']['message']['chat']['id']
-                    )
-                except Chat.DoesNotExist:
-                    chat, _ = Chat.objects.get_or_create(
-                        **update_data['callback_query']['message']['chat']
-                    )
-
-                message, _ = Message.objects.get_or_create(
-                    message_id=update_data['callback_query']['message']['message_id'],
-                    from_user=user,
-                    date=datetime.fromtimestamp(update_data['callback_query']['message']['date']),
-                    chat=chat,
-                    text=update_data['callback_query']['message']['text']
-                )
-            else:
-                message = None
+    def fast_post(self, request, bot_id):
+        """
+        Validate the update, drop duplicates and queue the raw json.
+        The bot is read from the model cache, nothing else touches the
+        database here, saving models is done by the `drain_chat` task.
+        """
+        try:
+            bot = caching.get_or_set(Bot, bot_id)
+        except Bot.DoesNotExist:
+            raise Http404
+        if not bot.enabled or not bot.token:
+            logger.error("Update ignored by disabled bot %s" % bot_id)
+            return HttpResponse()
 
-            try:
-                user = caching.get_or_set(
-                    User,
-                    update_data['callback_query']['from']['id']
-                )
-            except User.DoesNotExist:
-                user, _ = User.objects.get_or_create(**update_data['callback_query']['from'])
+        try:
+            update_data = json.loads(request.body.decode("utf-8"))
+            update_id = int(update_data['update_id'])
+            chat_id = chatqueue.chat_id_from_data(update_data)
+        except (ValueError, TypeError, KeyError):
+            logger.warning("Bad update %s for bot %s" % (request.body, bot_id))
+            return HttpResponseBadRequest()
+
+        if chat_id is None:
+            logger.warning("Update without chat %s for bot %s" % (request.body, bot_id))
+            return HttpResponse()
 
-            callback_query, _ = CallbackQuery.objects.get_or_create(
-                callback_id=update_data['callback_query']['id'],
-                from_user=user,
-                message=message,
-                data=update_data['callback_query']['data']
-            )
+        if not claim_update(bot_id, update_id):
+            logger.debug("Duplicate update %s for bot %s" % (update_id, bot_id))
+            return HttpResponse()
 
-            update, _ = Update.objects.get_or_create(
-                bot=bot,
-                update_id=update_data['update_id'],
-                callback_query=callback_query
-            )
+        try:
+            enqueue_update(bot_id, chat_id, update_id, {'data': update_data})
+        except Exception:
+            # telegram retries the webhook, the retry must not be dropped
+            # as a duplicate of an update that was never queued
+            release_update(bot_id, update_id)
+            raise
 
-        else:
-            logger.error("Not valid message %s" % update_data)
-            raise OnlyTextMessages
+        return HttpResponse()
 
-        caching.set(update)
-        return update
+    def create_update(self, update_data, bot):
+        return create_update(update_data, bot)